@@ -1 +1,40 @@
-print("import sources directory")
+"""Algorithms of the formal languages course.
+
+Submodules are imported on first attribute access (``project.rpq``), so
+``import project`` is cheap and plotting or experiment dependencies are
+loaded only by the code that uses them.
+"""
+import importlib
+
+_SUBMODULES = (
+    "bit_matrix",
+    "boolean_matrix_automata",
+    "cfg",
+    "cfpq",
+    "ecfg",
+    "finite_automata",
+    "graph_cache",
+    "graph_module",
+    "graph_store",
+    "instrumentation",
+    "kron_operator",
+    "out_of_core",
+    "parallel",
+    "query_cache",
+    "query_result",
+    "rpq",
+    "rsm",
+    "server",
+)
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
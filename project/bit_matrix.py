@@ -0,0 +1,305 @@
+from typing import Iterable, Tuple
+
+import numpy as np
+from scipy import sparse
+
+WORD_BITS = 64
+# Upper bound (in words) for temporary buffers gathered during multiplication
+CHUNK_WORDS = 1 << 22
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _number_of_words(columns: int) -> int:
+    return (columns + WORD_BITS - 1) // WORD_BITS
+
+
+def _pack(dense: np.ndarray) -> np.ndarray:
+    rows, columns = dense.shape
+    padded = np.zeros((rows, _number_of_words(columns) * WORD_BITS), dtype=bool)
+    padded[:, :columns] = dense
+    packed = np.packbits(padded, axis=1, bitorder="little")
+    return packed.view("<u8").astype(np.uint64, copy=False)
+
+
+def _unpack(words: np.ndarray, columns: int) -> np.ndarray:
+    as_bytes = np.ascontiguousarray(words.astype("<u8", copy=False)).view(np.uint8)
+    return np.unpackbits(as_bytes, axis=1, count=columns, bitorder="little").astype(
+        bool
+    )
+
+
+def _as_bit_matrix(matrix) -> "BitMatrix":
+    return matrix if isinstance(matrix, BitMatrix) else BitMatrix(matrix)
+
+
+def _popcount(words: np.ndarray) -> int:
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+    return int(_POPCOUNT_TABLE[words.view(np.uint8)].sum(dtype=np.int64))
+
+
+class BitMatrix:
+    """Boolean matrix whose rows are packed into uint64 words.
+
+    Implements the subset of the scipy.sparse interface used by
+    BooleanMatrixAutomata and the CFPQ solvers, so it can be passed
+    anywhere a type of matrix (``tom``/``type_of_matrix``) is expected.
+    Addition is logical OR and ``@`` is the boolean (OR, AND) product.
+
+    The product gathers a row of the right operand per True of the left
+    one, so it pays off for sparse left operands: at 5% density and
+    n = 1000 to 2000 it is about 5-9x faster than dok and 1.4-2.7x faster
+    than csr. With a nearly dense left operand, as in the second product
+    of a chain, it is only 1.0-1.7x faster than dok and at n = 2000
+    slower than csr. See the matrix_product cases of
+    scripts/bench_suite.py.
+    """
+
+    format = "bit"
+    dtype = np.dtype(bool)
+
+    def __init__(self, arg, dtype=bool):
+        if isinstance(arg, tuple):
+            self.shape = (int(arg[0]), int(arg[1]))
+            self.words = np.zeros(
+                (self.shape[0], _number_of_words(self.shape[1])), dtype=np.uint64
+            )
+        elif isinstance(arg, BitMatrix):
+            self.shape = arg.shape
+            self.words = arg.words.copy()
+        elif sparse.issparse(arg):
+            coo = arg.tocoo()
+            mask = coo.data != 0
+            other = BitMatrix.from_coords(coo.shape, coo.row[mask], coo.col[mask])
+            self.shape, self.words = other.shape, other.words
+        else:
+            dense = np.atleast_2d(np.asarray(arg, dtype=bool))
+            self.shape = dense.shape
+            self.words = _pack(dense)
+
+    @classmethod
+    def from_coords(
+        cls, shape: Tuple[int, int], rows: Iterable[int], cols: Iterable[int]
+    ) -> "BitMatrix":
+        """Build matrix with True values at the given (row, column) positions"""
+        matrix = cls(shape)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if rows.size:
+            bits = np.left_shift(np.uint64(1), (cols % WORD_BITS).astype(np.uint64))
+            np.bitwise_or.at(matrix.words, (rows, cols // WORD_BITS), bits)
+        return matrix
+
+    @classmethod
+    def identity(cls, n: int) -> "BitMatrix":
+        indexes = np.arange(n)
+        return cls.from_coords((n, n), indexes, indexes)
+
+    @property
+    def nnz(self) -> int:
+        return _popcount(self.words)
+
+    def count_nonzero(self) -> int:
+        return self.nnz
+
+    def nonzero(self) -> Tuple[np.ndarray, np.ndarray]:
+        rows, word_indexes = np.nonzero(self.words)
+        if rows.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        bits = _unpack(self.words[rows, word_indexes].reshape(-1, 1), WORD_BITS)
+        word_positions, bit_positions = np.nonzero(bits)
+        return (
+            rows[word_positions],
+            word_indexes[word_positions] * WORD_BITS + bit_positions,
+        )
+
+    def toarray(self) -> np.ndarray:
+        return _unpack(self.words, self.shape[1])
+
+    def tocsr(self) -> sparse.csr_matrix:
+        rows, cols = self.nonzero()
+        return sparse.csr_matrix(
+            (np.ones(rows.size, dtype=bool), (rows, cols)), shape=self.shape
+        )
+
+    def tocoo(self) -> sparse.coo_matrix:
+        return self.tocsr().tocoo()
+
+    def copy(self) -> "BitMatrix":
+        return BitMatrix(self)
+
+    def transpose(self) -> "BitMatrix":
+        rows, cols = self.nonzero()
+        return BitMatrix.from_coords((self.shape[1], self.shape[0]), cols, rows)
+
+    @property
+    def T(self) -> "BitMatrix":
+        return self.transpose()
+
+    def _coerce(self, other) -> "BitMatrix":
+        other = _as_bit_matrix(other)
+        if other.shape != self.shape:
+            raise ValueError(f"inconsistent shapes {self.shape} and {other.shape}")
+        return other
+
+    def __iadd__(self, other) -> "BitMatrix":
+        self.words |= self._coerce(other).words
+        return self
+
+    def __add__(self, other) -> "BitMatrix":
+        return self.copy().__iadd__(other)
+
+    def __radd__(self, other) -> "BitMatrix":
+        # Allows the builtin sum() over matrices, which starts from 0
+        if isinstance(other, int) and other == 0:
+            return self.copy()
+        return self.__add__(other)
+
+    __or__ = __add__
+    __ior__ = __iadd__
+
+    def __and__(self, other) -> "BitMatrix":
+        result = self.copy()
+        result.words &= self._coerce(other).words
+        return result
+
+    def __sub__(self, other) -> "BitMatrix":
+        """Set difference: True where self is True and other is False"""
+        result = self.copy()
+        result.words &= ~self._coerce(other).words
+        return result
+
+    def __matmul__(self, other) -> "BitMatrix":
+        other = _as_bit_matrix(other)
+        if self.shape[1] != other.shape[0]:
+            raise ValueError(f"dimension mismatch {self.shape} @ {other.shape}")
+        result = BitMatrix((self.shape[0], other.shape[1]))
+        rows, cols = self.nonzero()
+        if rows.size == 0 or other.words.shape[1] == 0:
+            return result
+        # Row i of the product is OR of rows j of other for every True (i, j)
+        step = max(1, CHUNK_WORDS // other.words.shape[1])
+        for begin in range(0, rows.size, step):
+            chunk_rows = rows[begin : begin + step]
+            chunk_cols = cols[begin : begin + step]
+            starts = np.flatnonzero(
+                np.concatenate(([True], chunk_rows[1:] != chunk_rows[:-1]))
+            )
+            reduced = np.bitwise_or.reduceat(other.words[chunk_cols], starts, axis=0)
+            result.words[chunk_rows[starts]] |= reduced
+        return result
+
+    def kron(self, other) -> "BitMatrix":
+        other = _as_bit_matrix(other)
+        first_rows, first_cols = self.nonzero()
+        second_rows, second_cols = other.nonzero()
+        rows = first_rows[:, None] * other.shape[0] + second_rows[None, :]
+        cols = first_cols[:, None] * other.shape[1] + second_cols[None, :]
+        return BitMatrix.from_coords(
+            (self.shape[0] * other.shape[0], self.shape[1] * other.shape[1]),
+            rows.ravel(),
+            cols.ravel(),
+        )
+
+    def _row_indexes(self, key) -> np.ndarray:
+        return np.atleast_1d(np.arange(self.shape[0])[key])
+
+    def __getitem__(self, key):
+        row_key, col_key = key
+        if np.isscalar(row_key) and np.isscalar(col_key):
+            word = self.words[int(row_key), int(col_key) // WORD_BITS]
+            return bool((word >> np.uint64(int(col_key) % WORD_BITS)) & np.uint64(1))
+        dense = _unpack(self.words[self._row_indexes(row_key)], self.shape[1])
+        return BitMatrix(dense[:, np.atleast_1d(np.arange(self.shape[1])[col_key])])
+
+    def __setitem__(self, key, value):
+        row_key, col_key = key
+        if np.isscalar(row_key) and np.isscalar(col_key):
+            row, col = int(row_key), int(col_key)
+            bit = np.uint64(1) << np.uint64(col % WORD_BITS)
+            if value:
+                self.words[row, col // WORD_BITS] |= bit
+            else:
+                self.words[row, col // WORD_BITS] &= ~bit
+            return
+        rows = self._row_indexes(row_key)
+        dense = _unpack(self.words[rows], self.shape[1])
+        if isinstance(value, BitMatrix):
+            value = value.toarray()
+        elif sparse.issparse(value):
+            value = value.toarray()
+        dense[:, col_key] = value
+        self.words[rows] = _pack(dense)
+
+    def __repr__(self):
+        return f"<{self.shape[0]}x{self.shape[1]} BitMatrix with {self.nnz} True>"
+
+
+def kron(first, second):
+    """Kronecker product, which keeps BitMatrix operands packed"""
+    if isinstance(first, BitMatrix) or isinstance(second, BitMatrix):
+        return _as_bit_matrix(first).kron(second)
+    return sparse.kron(first, second)
+
+
+def block_diag(matrices):
+    """Block diagonal matrix, which keeps BitMatrix operands packed"""
+    matrices = list(matrices)
+    if not any(isinstance(m, BitMatrix) for m in matrices):
+        return sparse.block_diag(matrices)
+    rows, cols = [], []
+    row_shift, col_shift = 0, 0
+    for matrix in matrices:
+        matrix_rows, matrix_cols = _as_bit_matrix(matrix).nonzero()
+        rows.append(matrix_rows + row_shift)
+        cols.append(matrix_cols + col_shift)
+        row_shift += matrix.shape[0]
+        col_shift += matrix.shape[1]
+    return BitMatrix.from_coords(
+        (row_shift, col_shift), np.concatenate(rows), np.concatenate(cols)
+    )
+
+
+def vstack(matrices):
+    """Vertical stack of matrices, which keeps BitMatrix operands packed"""
+    matrices = list(matrices)
+    if not any(isinstance(m, BitMatrix) for m in matrices):
+        return sparse.vstack(matrices)
+    packed = [_as_bit_matrix(m) for m in matrices]
+    result = BitMatrix((sum(m.shape[0] for m in packed), packed[0].shape[1]))
+    result.words = np.vstack([m.words for m in packed])
+    return result
+
+
+def difference(first, second):
+    """Boolean matrix with True where first is True and second is False"""
+    if isinstance(first, BitMatrix) or isinstance(second, BitMatrix):
+        return _as_bit_matrix(first) - second
+    if first.dtype != bool:
+        first = first.astype(bool)
+    if second.dtype != bool:
+        second = second.astype(bool)
+    return (first > second).tocsr()
+
+
+def convert(matrix, type_of_matrix=sparse.csr_matrix):
+    """Boolean copy of the matrix in the given type, so the source stays intact"""
+    if type_of_matrix is BitMatrix:
+        return BitMatrix(matrix)
+    return type_of_matrix(matrix, dtype=bool, copy=True)
+
+
+def from_coords(shape, rows, cols, type_of_matrix=sparse.csr_matrix):
+    """Boolean matrix of the given type with True at (rows[k], cols[k])"""
+    if type_of_matrix is BitMatrix:
+        return BitMatrix.from_coords(shape, rows, cols)
+    data = np.ones(len(rows), dtype=bool)
+    return type_of_matrix(sparse.csr_matrix((data, (rows, cols)), shape=shape))
+
+
+def identity(n: int, type_of_matrix=sparse.dok_matrix):
+    """Boolean identity matrix of the given type"""
+    if type_of_matrix is BitMatrix:
+        return BitMatrix.identity(n)
+    return type_of_matrix(sparse.eye(n, dtype=bool))
@@ -1,176 +1,624 @@
-from typing import Set, Dict
+from copy import copy
+from typing import Set, Dict, Iterable, Mapping, NamedTuple, Sequence, Union
 
+import networkx as nx
+import numpy as np
 from pyformlang.finite_automaton import State, EpsilonNFA
-from scipy.sparse import dok_matrix, kron, block_diag, vstack
+from scipy.sparse import dok_matrix, csr_matrix, eye, kron as sparse_kron
+
+from project.bit_matrix import BitMatrix, kron, difference, convert, from_coords
+from project.graph_cache import (
+    GraphMatrices,
+    LabelMatrices,
+    common_labels,
+    get_graph_matrices,
+    graph_matrices_from_edges,
+)
+from project.instrumentation import get_tracker
+from project.out_of_core import DEFAULT_MEMORY_BUDGET, blocked_transitive_closure
+from project.parallel import MatrixPool
+
+CLOSURE_METHODS = ("linear", "squaring", "naive", "out_of_core")
+
+
+class IndexesStates(Mapping):
+    """Lazy index -> State(index) mapping of a product automaton"""
+
+    def __init__(self, number_of_states: int):
+        self.number_of_states = number_of_states
+
+    def _check(self, index) -> int:
+        if isinstance(index, (int, np.integer)) and 0 <= index < self.number_of_states:
+            return int(index)
+        raise KeyError(index)
+
+    def __getitem__(self, index) -> State:
+        return State(self._check(index))
+
+    def __iter__(self):
+        return iter(range(self.number_of_states))
+
+    def __len__(self):
+        return self.number_of_states
+
+
+class StatesIndexes(IndexesStates):
+    """Lazy State(index) -> index mapping of a product automaton"""
+
+    def __getitem__(self, state) -> int:
+        return self._check(state.value if isinstance(state, State) else state)
+
+    def __iter__(self):
+        return (State(index) for index in range(self.number_of_states))
+
+
+class NodeStates(IndexesStates):
+    """Lazy index -> State(node) mapping of a graph automaton"""
+
+    def __init__(self, nodes: Sequence):
+        super().__init__(len(nodes))
+        self.nodes = nodes
+
+    def __getitem__(self, index) -> State:
+        return State(self.nodes[self._check(index)])
+
+
+class NodeStatesIndexes(Mapping):
+    """Lazy State(node) -> index mapping of a graph automaton"""
+
+    def __init__(self, nodes: Sequence, node_indexes: Mapping):
+        self.nodes = nodes
+        self.node_indexes = node_indexes
+
+    def __getitem__(self, state) -> int:
+        return self.node_indexes[state.value if isinstance(state, State) else state]
+
+    def __iter__(self):
+        return (State(node) for node in self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
 
 
 class BooleanMatrixAutomata:
     number_of_states: int
-    states_indexes: Dict[State, int]
-    indexes_states: Dict[int, State]
-    start_state_indexes: Set[int]
-    final_state_indexes: Set[int]
+    # State values by index, e.g. the node ids of a graph automaton
+    nodes: Sequence
+    states_indexes: Mapping[State, int]
+    indexes_states: Mapping[int, State]
+    start_state_indexes: Union[Set[int], np.ndarray]
+    final_state_indexes: Union[Set[int], np.ndarray]
     type_of_matrix = dok_matrix
     boolean_matrix: Dict[int, type_of_matrix]
 
     def __init__(self, nfa: EpsilonNFA = None, tom=dok_matrix):
+        self.type_of_matrix = tom
         if nfa is None:
             self.number_of_states = 0
+            self.nodes = []
             self.states_indexes = dict()
             self.indexes_states = dict()
             self.start_state_indexes = set()
             self.final_state_indexes = set()
             self.boolean_matrix = dict()
         else:
-            self.number_of_states = len(nfa.states)
-            self.states_indexes = {
-                state: index for (index, state) in enumerate(nfa.states)
-            }
-            self.indexes_states = {
-                index: state for (index, state) in enumerate(nfa.states)
-            }
+            states = list(nfa.states)
+            self.number_of_states = len(states)
+            self.nodes = [state.value for state in states]
+            self.states_indexes = {state: index for (index, state) in enumerate(states)}
+            self.indexes_states = dict(enumerate(states))
             self.start_state_indexes = {i.value for i in nfa.start_states}
             self.final_state_indexes = {i.value for i in nfa.final_states}
             self.boolean_matrix = self.create_boolean_matrix_from_nfa(nfa)
-        self.type_of_matrix = tom
+
+    @classmethod
+    def from_graph_matrices(
+        cls,
+        graph_matrices: GraphMatrices,
+        start_states: Iterable = None,
+        final_states: Iterable = None,
+        tom=dok_matrix,
+        copy: bool = True,
+    ) -> "BooleanMatrixAutomata":
+        """Automaton of a graph from its prepared label matrices
+
+        :param graph_matrices: GraphMatrices
+            Label matrices and node-index mapping, e.g. from graph cache.
+
+        :param start_states: iterable of nodes
+            If None, all nodes are start.
+
+        :param final_states: iterable of nodes
+            If None, all nodes are final.
+
+        :param tom: type of matrix
+
+        :param copy: bool
+            Copy label matrices, so they are not shared with graph_matrices.
+            Without copy, matrices which are already of type tom are used
+            as they are (e.g. read-only memory-mapped ones).
+        """
+        bma = cls(tom=tom)
+        n = graph_matrices.number_of_nodes
+        bma.number_of_states = n
+        bma.nodes = graph_matrices.nodes
+        # No State objects are created per node, start and final states
+        # are kept as arrays of node indexes
+        bma.indexes_states = NodeStates(graph_matrices.nodes)
+        bma.states_indexes = NodeStatesIndexes(
+            graph_matrices.nodes, graph_matrices.node_indexes
+        )
+        bma.start_state_indexes = (
+            np.arange(n) if start_states is None else bma.node_indexes_of(start_states)
+        )
+        bma.final_state_indexes = (
+            np.arange(n) if final_states is None else bma.node_indexes_of(final_states)
+        )
+        matrices = {
+            label: matrix
+            if not copy and isinstance(matrix, tom)
+            else convert(matrix, tom)
+            for label, matrix in graph_matrices.matrices.items()
+        }
+        # x_r labels are transposes of x in tom, shared matrices share
+        # the transposes made for earlier automata of the graph
+        if not copy and isinstance(graph_matrices.matrices, LabelMatrices):
+            bma.boolean_matrix = graph_matrices.matrices.with_type(tom, matrices)
+        else:
+            bma.boolean_matrix = LabelMatrices(matrices, tom)
+        return bma
+
+    @classmethod
+    def from_graph(
+        cls,
+        graph: nx.MultiDiGraph,
+        start_states: Iterable = None,
+        final_states: Iterable = None,
+        tom=dok_matrix,
+    ) -> "BooleanMatrixAutomata":
+        """Automaton of a graph with label matrices built in bulk
+
+        Matrices come from the shared graph cache, the graph is not
+        converted to a pyformlang automaton.
+        """
+        return cls.from_graph_matrices(
+            get_graph_matrices(graph), start_states, final_states, tom
+        )
+
+    @classmethod
+    def from_edges(
+        cls,
+        sources,
+        labels,
+        targets,
+        nodes: Sequence = None,
+        start_states: Iterable = None,
+        final_states: Iterable = None,
+        tom=dok_matrix,
+    ) -> "BooleanMatrixAutomata":
+        """Automaton of a graph given by arrays of (source, label, target) edges
+
+        :param nodes: sequence of node ids giving node indexes,
+            if None the sorted ids of edge ends.
+
+        :param start_states: iterable of node ids
+            If None, all nodes are start.
+
+        :param final_states: iterable of node ids
+            If None, all nodes are final.
+
+        :param tom: type of matrix
+        """
+        return cls.from_graph_matrices(
+            graph_matrices_from_edges(sources, labels, targets, nodes),
+            start_states,
+            final_states,
+            tom,
+            copy=False,
+        )
 
     def create_boolean_matrix_from_nfa(self, nfa: EpsilonNFA):
-        boolean_matrix = {}
+        # Transitions are collected as coordinates and every matrix is built
+        # at once, item assignment is slow for CSR and packed matrices
+        coords = {}
         for initial_state, labels_and_target_states in nfa.to_dict().items():
             for label, target_states in labels_and_target_states.items():
                 if not isinstance(target_states, set):
                     target_states = {target_states}
+                rows, cols = coords.setdefault(label, ([], []))
                 for target_state in target_states:
-                    if label not in boolean_matrix:
-                        boolean_matrix[label] = self.type_of_matrix(
-                            (self.number_of_states, self.number_of_states), dtype=bool
-                        )
-                    boolean_matrix[label][
-                        self.states_indexes[initial_state],
-                        self.states_indexes[target_state],
-                    ] = True
-        return boolean_matrix
+                    rows.append(self.states_indexes[initial_state])
+                    cols.append(self.states_indexes[target_state])
+        shape = (self.number_of_states, self.number_of_states)
+        return {
+            label: from_coords(shape, rows, cols, self.type_of_matrix)
+            for label, (rows, cols) in coords.items()
+        }
 
     def create_nfa_from_boolean_matrix(self):
         nfa = EpsilonNFA()
-        for state in self.start_state_indexes:
-            nfa.add_start_state(State(state))
-        for state in self.final_state_indexes:
-            nfa.add_final_state(State(state))
+        for i in self.state_indexes_of(self.start_state_indexes).tolist():
+            nfa.add_start_state(self.indexes_states[i])
+        for i in self.state_indexes_of(self.final_state_indexes).tolist():
+            nfa.add_final_state(self.indexes_states[i])
         for label, matrix_self in self.boolean_matrix.items():
-            matrix_array = matrix_self.toarray()
-            for initial_state, i in self.states_indexes.items():
-                for target_state, j in self.states_indexes.items():
-                    if matrix_array[i][j]:
-                        nfa.add_transition(initial_state, label, target_state)
+            rows, cols = matrix_self.nonzero()
+            for i, j in zip(rows.tolist(), cols.tolist()):
+                nfa.add_transition(
+                    self.indexes_states[i], label, self.indexes_states[j]
+                )
         return nfa
 
+    def with_states(self, start_states=None, final_states=None):
+        """Automaton sharing label matrices with this one, but with other
+        start and final states. States set to None are kept as is."""
+        bma = copy(self)
+        if start_states is not None:
+            bma.start_state_indexes = self.node_indexes_of(start_states)
+        if final_states is not None:
+            bma.final_state_indexes = self.node_indexes_of(final_states)
+        return bma
+
     def intersect(self, second: "BooleanMatrixAutomata"):
-        bma = BooleanMatrixAutomata()
+        bma = BooleanMatrixAutomata(tom=self.type_of_matrix)
         bma.number_of_states = self.number_of_states * second.number_of_states
+        bma.nodes = range(bma.number_of_states)
 
         bma.boolean_matrix = {
             label: kron(self.boolean_matrix[label], second.boolean_matrix[label])
-            for label in (self.boolean_matrix.keys() & second.boolean_matrix.keys())
+            for label in common_labels(self.boolean_matrix, second.boolean_matrix)
         }
 
-        for (first_state, first_index) in self.states_indexes.items():
-            for (second_state, second_index) in second.states_indexes.items():
-                state_index = first_index * second.number_of_states + second_index
-                bma.states_indexes[State(state_index)] = state_index
-                if (
-                    first_state in self.start_state_indexes
-                    and second_state in second.start_state_indexes
-                ):
-                    bma.start_state_indexes.add(state_index)
-                if (
-                    first_state in self.final_state_indexes
-                    and second_state in second.final_state_indexes
-                ):
-                    bma.final_state_indexes.add(state_index)
+        second_n = second.number_of_states
+        bma.states_indexes = StatesIndexes(bma.number_of_states)
+        bma.indexes_states = IndexesStates(bma.number_of_states)
+        # Index sets of the product are Kronecker products of indicator vectors
+        bma.start_state_indexes = (
+            self.state_indexes_of(self.start_state_indexes)[:, None] * second_n
+            + second.state_indexes_of(second.start_state_indexes)[None, :]
+        ).ravel()
+        bma.final_state_indexes = (
+            self.state_indexes_of(self.final_state_indexes)[:, None] * second_n
+            + second.state_indexes_of(second.final_state_indexes)[None, :]
+        ).ravel()
         return bma
 
-    def transitive_closure(self):
+    def state_indexes_of(self, states: Iterable) -> np.ndarray:
+        """Sorted array of indexes of the given states
+
+        :param states: set of state values or array of state indexes
+            Start or final states in the form kept by this automaton.
+
+        :return indexes: np.ndarray
+        """
+        if isinstance(states, np.ndarray):
+            return np.sort(states.astype(np.int64))
+        indexes = (self.states_indexes.get(State(state)) for state in states)
+        return np.sort(
+            np.fromiter((i for i in indexes if i is not None), dtype=np.int64)
+        )
+
+    def node_indexes_of(self, states: Iterable) -> np.ndarray:
+        """Sorted array of indexes of the given state values, unknown are skipped"""
+        return self.state_indexes_of(list(states))
+
+    def transitive_closure(
+        self,
+        method: str = "linear",
+        instrumentation=None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        directory=None,
+    ):
+        """Transitive closure of the union of all label matrices
+
+        :param method: str
+            "linear" - semi-naive frontier expansion: each round extends
+            the pairs found in the previous round by one transition.
+            "squaring" - semi-naive repeated squaring: each round multiplies
+            only the pairs found in the previous round with the closure.
+            "naive" - squares the whole closure until nnz stops growing.
+            "out_of_core" - frontier expansion by panels of rows, which are
+            written to memory-mapped files, see blocked_transitive_closure.
+
+        :param instrumentation: receiver of per-round records,
+            see project.instrumentation
+
+        :param memory_budget: int
+            Bytes of closure rows held in memory by "out_of_core".
+
+        :param directory: directory of the files of "out_of_core"
+
+        :return closure: boolean matrix of size number_of_states
+        """
+        if method not in CLOSURE_METHODS:
+            raise ValueError(f"Unknown closure method {method!r}")
+        if not self.boolean_matrix:
+            return self.type_of_matrix(
+                (self.number_of_states, self.number_of_states), dtype=bool
+            )
         trans_closure = sum(self.boolean_matrix.values())
-        prev_value = trans_closure.nnz
-        curr_value = 0
 
-        while prev_value != curr_value:
-            trans_closure += trans_closure @ trans_closure
-            prev_value = curr_value
+        if method == "naive":
+            tracker = get_tracker(instrumentation, "transitive_closure")
+            prev_value = None
             curr_value = trans_closure.nnz
+            while prev_value != curr_value:
+                trans_closure += trans_closure @ trans_closure
+                prev_value = curr_value
+                curr_value = trans_closure.nnz
+                tracker.record(trans_closure, curr_value - prev_value)
+            return trans_closure
+
+        if method == "out_of_core":
+            return blocked_transitive_closure(
+                trans_closure, memory_budget, directory, instrumentation
+            )
+        if not isinstance(trans_closure, BitMatrix):
+            trans_closure = trans_closure.tocsr().astype(bool)
+        if method == "squaring":
+            return extend_transitive_closure(
+                type(trans_closure)(trans_closure.shape, dtype=bool),
+                trans_closure,
+                instrumentation,
+            )[0]
+        tracker = get_tracker(instrumentation, "transitive_closure")
+        if not isinstance(trans_closure, BitMatrix):
+            return _linear_closure(trans_closure, tracker)
+        adjacency = trans_closure
+        delta = trans_closure
+        while delta.nnz:
+            delta = difference(delta @ adjacency, trans_closure)
+            trans_closure = trans_closure + delta
+            tracker.record(trans_closure, delta)
         return trans_closure
 
-    def bfs_based_rpq(self, second: "BooleanMatrixAutomata", separately: bool):
-        self_n = self.number_of_states
-        second_n = second.number_of_states
+    def bfs_based_rpq(
+        self,
+        second: "BooleanMatrixAutomata",
+        separately: bool,
+        workers: int = 1,
+        shard_size: int = None,
+        instrumentation=None,
+    ):
+        """Multiple-source BFS based RPQ with regular expression automaton second
+
+        Reachability is kept as a sparse matrix with a block of rows per
+        source (one block for all sources when separately is False): row r
+        of a block holds graph states reachable while the regex automaton is
+        in state r. Each round propagates only the newly reached pairs.
+
+        :param second: BooleanMatrixAutomata
+            Automaton of the regular expression.
 
-        def get_front(start_states=None):
-            front1 = self.type_of_matrix((second_n, self_n + second_n), dtype=bool)
-
-            front_for_self = self.type_of_matrix((1, self_n), dtype=bool)
-            for i in start_states:
-                front_for_self[0, i] = True
-            for ss in second.start_state_indexes:
-                i = second.states_indexes[State(ss)]
-                front1[i, i] = True
-                front1[[i], second_n:] = front_for_self
-            return front1
-
-        def transform_rows(front_part):
-            new_fp = self.type_of_matrix(front_part.shape, dtype=bool)
-            xx, yy = front_part.nonzero()
-            for ii, jj in zip(xx, yy):
-                if jj < second_n:
-                    row_second_part = front_part[[ii], second_n:]
-                    if row_second_part.nnz > 0:
-                        shift = ii - ii % second_n
-                        new_fp[shift + jj, jj] = True
-                        new_fp[[shift + jj], second_n:] += row_second_part
-            return new_fp
-
-        direct_sum = {
-            label: block_diag(
-                (second.boolean_matrix[label], self.boolean_matrix[label])
+        :param separately: bool
+            Compute reachable states for each start state on its own.
+
+        :param workers: int
+            Number of worker processes, 1 computes everything in the calling
+            process. Without shards the workers compute the per-label
+            products of a round, with shards they run whole shards.
+
+        :param shard_size: int
+            Split start states into shards of at most shard_size states,
+            which are searched independently against graph and regex
+            matrices in shared memory. Peak memory is bounded by the size
+            of a shard. None means a single shard.
+
+        :param instrumentation: receiver of per-round records, rounds of
+            shards searched by worker processes are not recorded
+
+        :return answer: dict of start state to list of reachable states
+            if separately, else set of reachable states
+        """
+        sources = self.state_indexes_of(self.start_state_indexes)
+        labels = common_labels(self.boolean_matrix, second.boolean_matrix)
+        matrices = {}
+        for label in labels:
+            matrices["self", label] = _to_csr(self.boolean_matrix[label])
+            matrices["second", label] = _to_csr(second.boolean_matrix[label])
+        is_second_final = np.zeros(second.number_of_states, dtype=bool)
+        is_second_final[second.state_indexes_of(second.final_state_indexes)] = True
+        is_self_final = np.zeros(self.number_of_states, dtype=bool)
+        is_self_final[self.state_indexes_of(self.final_state_indexes)] = True
+
+        def task(shard_sources):
+            return _BfsTask(
+                labels,
+                shard_sources,
+                second.state_indexes_of(second.start_state_indexes),
+                is_second_final,
+                is_self_final,
+                separately,
             )
-            for label in (self.boolean_matrix.keys() & second.boolean_matrix.keys())
-        }
 
-        front = (
-            vstack([get_front({i}) for i in self.start_state_indexes])
-            if separately
-            else get_front(self.start_state_indexes)
-        )
+        with MatrixPool(workers) as pool:
+            tracker = get_tracker(instrumentation, "bfs_based_rpq")
+            if shard_size is None:
+                reached = [_bfs_reachable(matrices, task(sources), pool, tracker)]
+            else:
+                number_of_shards = max(1, -(-len(sources) // shard_size))
+                shards = np.array_split(sources, number_of_shards)
+                if pool.parallel:
+                    reached = pool.map_shared(
+                        _bfs_shard, matrices, [task(shard) for shard in shards]
+                    )
+                else:
+                    reached = [
+                        _bfs_reachable(matrices, task(shard), pool, tracker)
+                        for shard in shards
+                    ]
 
-        visited = self.type_of_matrix(front.shape, dtype=bool)
-        is_first_step = True
-        while True:
-            visited_nnz = visited.nnz
-            for _, matrix in direct_sum.items():
-                new_front_part = front @ matrix if is_first_step else visited @ matrix
-                visited += transform_rows(new_front_part)
-            is_first_step = False
-            if visited_nnz == visited.nnz:
-                break
-
-        answer = set()
-        second_states = list(second.states_indexes.keys())
-        self_states = list(self.states_indexes.keys())
-        x, y = visited.nonzero()
-        for i, j in zip(x, y):
-            if (
-                j >= second_n
-                and second_states[i % second_n] in second.final_state_indexes
-            ):
-                state_index = j - second_n
-                if self_states[state_index] in self.final_state_indexes:
-                    if separately:
-                        answer.add((State(i // second_n), State(state_index)))
-                    else:
-                        answer.add(State(state_index))
-        copy = answer
-        if separately:
-            answer = {}
-            for i in copy:
-                answer.setdefault(i[0], []).append(i[1])
+        if not separately:
+            cols = np.concatenate([cols for _, cols in reached])
+            return {self.indexes_states[j] for j in np.unique(cols).tolist()}
+        answer = {}
+        for i, j in sorted(
+            {
+                pair
+                for rows, cols in reached
+                for pair in zip(rows.tolist(), cols.tolist())
+            }
+        ):
+            answer.setdefault(self.indexes_states[i], []).append(self.indexes_states[j])
         return answer
+
+
+def extend_transitive_closure(closure, added, instrumentation=None):
+    """Transitive closure of closure + added, where closure is already closed
+
+    Semi-naive repeated squaring: each round multiplies only the pairs found
+    in the previous round with the closure, as products of old pairs are
+    already in the closure.
+
+    :param closure: boolean CSR matrix or BitMatrix
+        Transitively closed relation.
+
+    :param added: matrix of the same type and shape
+        Pairs added to the relation.
+
+    :param instrumentation: receiver of per-round records
+
+    :return (closure, found): closure of the extended relation and
+        the pairs which were not in the given closure
+    """
+    tracker = get_tracker(instrumentation, "transitive_closure")
+    delta = difference(added, closure)
+    found = delta
+    closure = closure + delta
+    while delta.nnz:
+        delta = difference(delta @ closure + closure @ delta, closure)
+        found = found + delta
+        closure = closure + delta
+        tracker.record(closure, delta)
+    return closure, found
+
+
+class _BfsTask(NamedTuple):
+    labels: list
+    sources: np.ndarray
+    second_starts: np.ndarray
+    is_second_final: np.ndarray
+    is_self_final: np.ndarray
+    separately: bool
+
+
+def _bfs_shard(matrices, task: _BfsTask):
+    return _bfs_reachable(matrices, task, MatrixPool(1))
+
+
+def _bfs_reachable(matrices, task: _BfsTask, pool: MatrixPool, tracker=None):
+    # Returns arrays of (source, reached final state) index pairs,
+    # sources are not tracked (set to -1) if not task.separately
+    second_n = task.is_second_final.size
+    self_n = task.is_self_final.size
+    sources, second_starts = task.sources, task.second_starts
+    number_of_blocks = len(sources) if task.separately else 1
+
+    if task.separately:
+        front_rows = (
+            np.arange(number_of_blocks)[:, None] * second_n + second_starts
+        ).ravel()
+        front_cols = np.repeat(sources, len(second_starts))
+    else:
+        front_rows = np.repeat(second_starts, len(sources))
+        front_cols = np.tile(sources, len(second_starts))
+    front = csr_matrix(
+        (np.ones(front_rows.size, dtype=bool), (front_rows, front_cols)),
+        shape=(number_of_blocks * second_n, self_n),
+    )
+
+    # Moving the row of regex state r to the rows of its successors
+    # is a product with the transposed regex matrix in every block
+    blocks = eye(number_of_blocks, dtype=bool, format="csr")
+    transitions = {}
+    for i, label in enumerate(task.labels):
+        transitions["second", i] = sparse_kron(
+            blocks, matrices["second", label].T
+        ).tocsr()
+        transitions["self", i] = matrices["self", label]
+    # Workers get the transitions once and a front per round, every
+    # worker sums the steps of a group of labels
+    groups = [
+        group.tolist()
+        for group in np.array_split(np.arange(len(task.labels)), pool.workers)
+        if group.size
+    ]
+
+    visited = csr_matrix(front.shape, dtype=bool)
+    with pool.replicate(transitions) as shared:
+        while front.nnz:
+            shared.advance({"front": front}, accumulate=False)
+            step = csr_matrix(front.shape, dtype=bool)
+            for group_step in shared.map(_bfs_step, groups):
+                step = step + group_step
+            front = difference(step, visited)
+            visited = visited + front
+            if tracker is not None:
+                tracker.record(visited, front)
+
+    rows, cols = visited.nonzero()
+    mask = task.is_second_final[rows % second_n] & task.is_self_final[cols]
+    rows, cols = rows[mask], cols[mask]
+    if not task.separately:
+        return np.full(cols.size, -1, dtype=np.int64), cols
+    return sources[rows // second_n], cols
+
+
+def _bfs_step(replica, labels):
+    front = replica.deltas["front"]
+    step = csr_matrix(front.shape, dtype=bool)
+    for i in labels:
+        # Right to left, as the front is the smallest operand
+        step = step + replica.matrices["second", i] @ (
+            front @ replica.matrices["self", i]
+        )
+    return step
+
+
+def _pair_keys(matrix: csr_matrix) -> np.ndarray:
+    # Sorted unique keys row * n + column of the pairs of the matrix
+    matrix = matrix.tocoo()
+    stored = matrix.data != 0
+    keys = matrix.row[stored].astype(np.int64) * matrix.shape[1] + matrix.col[stored]
+    return np.unique(keys)
+
+
+def _keys_to_csr(keys: np.ndarray, n: int) -> csr_matrix:
+    rows, cols = np.divmod(keys, n)
+    indptr = np.searchsorted(rows, np.arange(n + 1))
+    return csr_matrix((np.ones(len(keys), dtype=bool), cols, indptr), shape=(n, n))
+
+
+def _contains_keys(level: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    positions = np.minimum(np.searchsorted(level, keys), len(level) - 1)
+    return level[positions] == keys
+
+
+def _linear_closure(adjacency: csr_matrix, tracker) -> csr_matrix:
+    # Semi-naive frontier expansion, where pairs found so far are kept as
+    # sorted keys in levels of at least halving size: a round searches
+    # its new pairs in the levels instead of passing over the closure
+    n = adjacency.shape[0]
+    levels = [_pair_keys(adjacency)]
+    front = _keys_to_csr(levels[0], n)
+    while front.nnz:
+        keys = _pair_keys(front @ adjacency)
+        for level in levels:
+            keys = keys[~_contains_keys(level, keys)]
+        front = _keys_to_csr(keys, n)
+        if keys.size:
+            levels.append(keys)
+            while len(levels) > 1 and len(levels[-2]) < 2 * len(levels[-1]):
+                last = levels.pop()
+                # Levels are sorted and disjoint, a merge sort of the two
+                # runs is linear
+                levels[-1] = np.sort(np.concatenate((levels[-1], last)), kind="stable")
+        if tracker.instrumentation.enabled:
+            tracker.record(
+                _keys_to_csr(np.sort(np.concatenate(levels), kind="stable"), n), front
+            )
+    return _keys_to_csr(np.sort(np.concatenate(levels), kind="stable"), n)
+
+
+def _to_csr(matrix) -> csr_matrix:
+    return matrix.tocsr().astype(bool)
@@ -1,40 +1,146 @@
+from collections import Counter, defaultdict, deque
+from functools import reduce
+from operator import add
 from typing import Set
 
+import numpy as np
 from pyformlang.cfg import CFG
 from networkx import MultiDiGraph
-from scipy.sparse import dok_matrix, eye, csr_matrix
+from scipy.sparse import dok_matrix, csr_matrix, diags
 
-from project.boolean_matrix_automata import BooleanMatrixAutomata
-from project.cfg import to_weakened_normal_form
-from project.ecfg import ECFG
-from project.finite_automata import build_nfa_from_graph
-from project.rsm import RecursiveStateMachine
+from project.bit_matrix import (
+    BitMatrix,
+    identity,
+    convert,
+    difference,
+    kron,
+    from_coords,
+)
+from project.boolean_matrix_automata import (
+    BooleanMatrixAutomata,
+    extend_transitive_closure,
+)
+from project.graph_cache import (
+    LabelMatrices,
+    common_labels,
+    get_graph_matrices,
+    inverse_label,
+)
+from project.instrumentation import get_tracker
+from project.kron_operator import KronOperator
+from project.parallel import MatrixPool, Replica, ReplicatedMatrices
+from project.query_cache import (
+    get_normal_form,
+    get_rsm_automaton,
+    get_weakened_normal_form,
+)
+from project.query_result import QueryResult
 
 
-def cfpq_cyk(s: str, cfg: CFG):
+CYK_METHODS = ("auto", "bitset", "matrix")
+# Strings of at least this length are checked by the matrix method in "auto"
+CYK_MATRIX_THRESHOLD = 256
+
+
+def cfpq_cyk(s: str, cfg: CFG, method: str = "auto"):
+    """Check if the string is derivable from the grammar
+
+    :param s: str or sequence of terminal values
+
+    :param cfg: CFG
+
+    :param method: str
+        "bitset" - CYK over per-nonterminal bitsets of span ends and starts,
+        where every diagonal is filled by vectorized word operations.
+        "matrix" - Valiant-style reduction to boolean matrix products:
+        the string is a path graph and spans are found by the semi-naive
+        matrix CFPQ fixpoint.
+        "auto" - "matrix" for strings longer than CYK_MATRIX_THRESHOLD.
+
+    :return bool
+    """
+    if method not in CYK_METHODS:
+        raise ValueError(f"Unknown CYK method {method!r}")
     if not s:
         return cfg.generate_epsilon()
-    cfg = cfg.to_normal_form()
-    n = len(s)
-    m = list(list(set() for _ in range(n)) for _ in range(n))
-    t = list()
-    nt = list()
-    for p in cfg.productions:
+    cnf = get_normal_form(cfg)
+    if method == "auto":
+        method = "matrix" if len(s) >= CYK_MATRIX_THRESHOLD else "bitset"
+    if method == "matrix":
+        return _cyk_matrix(s, cnf)
+    return _cyk_bitset(s, cnf)
+
+
+def _cnf_index(cnf: CFG):
+    nonterms = sorted({v.value for v in cnf.variables} | {cnf.start_symbol.value})
+    nonterm_ids = {nonterm: i for i, nonterm in enumerate(nonterms)}
+    heads_by_term = defaultdict(list)
+    heads_by_body = defaultdict(list)
+    for p in cnf.productions:
         if len(p.body) == 1:
-            t.append(p)
-        if len(p.body) == 2:
-            nt.append(p)
+            heads_by_term[p.body[0].value].append(nonterm_ids[p.head.value])
+        elif len(p.body) == 2:
+            body = (nonterm_ids[p.body[0].value], nonterm_ids[p.body[1].value])
+            heads_by_body[body].append(nonterm_ids[p.head.value])
+    return nonterm_ids, heads_by_term, heads_by_body
+
+
+def _cyk_bitset(s, cnf: CFG):
+    nonterm_ids, heads_by_term, heads_by_body = _cnf_index(cnf)
+    n = len(s)
+    words = n // 64 + 1
+    one = np.uint64(1)
+    # ends[A][y] has bit x + 1 set if A derives s[y..x], starts[A][x] has bit y
+    ends = np.zeros((len(nonterm_ids), n, words), dtype=np.uint64)
+    starts = np.zeros((len(nonterm_ids), n, words), dtype=np.uint64)
+    present = np.zeros(len(nonterm_ids), dtype=bool)
+
+    def mark(nonterm, ys, xs):
+        ends[nonterm, ys, (xs + 1) // 64] |= one << ((xs + 1) % 64).astype(np.uint64)
+        starts[nonterm, xs, ys // 64] |= one << (ys % 64).astype(np.uint64)
+        present[nonterm] = True
+
     for i, c in enumerate(s):
-        m[i][i] = set(p.head for p in t if p.body[0].value == c)
-    for z in range(1, n):
-        for y in range(n - z):
-            x = z + y
-            for i in range(y, x):
-                j = i + 1
-                for p in nt:
-                    if p.body[0] in m[y][i] and p.body[1] in m[j][x]:
-                        m[y][x].add(p.head)
-    return cfg.start_symbol in m[0][n - 1]
+        for head in heads_by_term.get(c, ()):
+            mark(head, np.array([i]), np.array([i]))
+
+    for length in range(2, n + 1):
+        ys = np.arange(n - length + 1)
+        xs = ys + length - 1
+        found = {}
+        for (left, right), heads in heads_by_body.items():
+            if not (present[left] and present[right]):
+                continue
+            # A -> B C spans s[y..x] if B ends at i and C starts at i + 1
+            hit = np.bitwise_and(ends[left, ys], starts[right, xs]).any(axis=1)
+            for head in heads:
+                found[head] = found[head] | hit if head in found else hit
+        for head, hit in found.items():
+            if hit.any():
+                mark(head, ys[hit], xs[hit])
+
+    start = nonterm_ids[cnf.start_symbol.value]
+    return bool((ends[start, 0, n // 64] >> np.uint64(n % 64)) & one)
+
+
+def _cyk_matrix(s, cnf: CFG):
+    n = len(s) + 1
+    terms = defaultdict(list)
+    for i, c in enumerate(s):
+        terms[c].append(i)
+    matrices = {v.value: csr_matrix((n, n), dtype=bool) for v in cnf.variables}
+    matrices.setdefault(cnf.start_symbol.value, csr_matrix((n, n), dtype=bool))
+    bodies_by_head = defaultdict(set)
+    for p in cnf.productions:
+        if len(p.body) == 1 and p.body[0].value in terms:
+            positions = np.array(terms[p.body[0].value])
+            matrices[p.head.value] = matrices[p.head.value] + from_coords(
+                (n, n), positions, positions + 1
+            )
+        elif len(p.body) == 2:
+            bodies_by_head[p.head.value].add((p.body[0].value, p.body[1].value))
+    _close_matrices(matrices, bodies_by_head)
+    return bool(matrices[cnf.start_symbol.value][0, n - 1])
 
 
 def cfpg_by_hellings(
@@ -47,55 +153,95 @@ def cfpg_by_hellings(
         start_nodes = graph.nodes
     if final_nodes is None:
         final_nodes = graph.nodes
-    start_symbol = cfg.start_symbol.value
 
     result = {
         (x, y)
-        for (label, x, y) in eval_hellings(graph, cfg)
-        if x in start_nodes and y in final_nodes and label == start_symbol
+        for (x, y) in eval_hellings_result(graph, cfg).to_set(cfg.start_symbol.value)
+        if x in start_nodes and y in final_nodes
     }
     return result
 
 
-def eval_hellings(graph: MultiDiGraph, cfg: CFG):
-    r = set(tuple())
-    wcnf = to_weakened_normal_form(cfg)
-    eps_nonterm = {p.head.value for p in wcnf.productions if not p.body}
-    terms_prod = {p for p in wcnf.productions if len(p.body) == 1}
-    nonterm_prod = {p for p in wcnf.productions if len(p.body) == 2}
+def eval_hellings(graph: MultiDiGraph, cfg: CFG, instrumentation=None):
+    return eval_hellings_result(graph, cfg, instrumentation).to_triples()
 
-    r = {(label, x, x) for x in graph.nodes for label in eps_nonterm} | {
-        (p.head.value, v, u)
-        for (v, u, label) in graph.edges(data="label")
-        for p in terms_prod
-        if p.body[0].value == label
-    }
-    m = r.copy()
+
+def eval_hellings_result(
+    graph: MultiDiGraph, cfg: CFG, instrumentation=None
+) -> QueryResult:
+    """Hellings CFPQ with the answer kept as one CSR matrix per nonterminal
+
+    :param instrumentation: receiver of per-round records, a round
+        processes the triples which were in the worklist at its start
+
+    :return result: QueryResult
+    """
+    wcnf = get_weakened_normal_form(cfg)
+    nonterms = sorted({v.value for v in wcnf.variables} | {wcnf.start_symbol.value})
+    nonterm_ids = {nonterm: i for i, nonterm in enumerate(nonterms)}
+
+    # Binary productions A -> B C indexed by each side of the body
+    by_left = defaultdict(list)
+    by_right = defaultdict(list)
+    for p in wcnf.productions:
+        if len(p.body) == 2:
+            head = nonterm_ids[p.head.value]
+            left = nonterm_ids[p.body[0].value]
+            right = nonterm_ids[p.body[1].value]
+            by_left[left].append((right, head))
+            by_right[right].append((left, head))
+
+    graph_matrices = get_graph_matrices(graph)
+    nodes = graph_matrices.nodes
+    # incoming[u][A] = {v | (A, v, u) in r}, outgoing[v][A] = {u | (A, v, u) in r}
+    incoming = defaultdict(lambda: defaultdict(set))
+    outgoing = defaultdict(lambda: defaultdict(set))
+    r = set()
+    m = deque()
+
+    def add(nonterm, v, u):
+        if (nonterm, v, u) not in r:
+            r.add((nonterm, v, u))
+            incoming[u][nonterm].add(v)
+            outgoing[v][nonterm].add(u)
+            m.append((nonterm, v, u))
+
+    for p in wcnf.productions:
+        if not p.body:
+            for x in range(len(nodes)):
+                add(nonterm_ids[p.head.value], x, x)
+        elif len(p.body) == 1 and p.body[0].value in graph_matrices.matrices:
+            matrix = graph_matrices.matrices[p.body[0].value]
+            for v, u in zip(*matrix.nonzero()):
+                add(nonterm_ids[p.head.value], int(v), int(u))
+
+    tracker = get_tracker(instrumentation, "eval_hellings")
     while m:
-        label1, v1, u1 = m.pop()
-        r_changes = set()
-        for (label2, v2, _) in (t for t in r if t[2] == v1):
-            for triple in (
-                (p.head.value, v2, u1)
-                for p in nonterm_prod
-                if (p.head.value, v2, u1) not in r
-                and p.body[0].value == label2
-                and p.body[1].value == label1
-            ):
-                m.add(triple)
-                r_changes.add(triple)
-        for (label2, _, u2) in (t for t in r if t[1] == u1):
-            for triple in (
-                (p.head.value, v1, u2)
-                for p in nonterm_prod
-                if (p.head.value, v1, u2) not in r
-                and p.body[0].value == label1
-                and p.body[1].value == label2
-            ):
-                m.add(triple)
-                r_changes.add(triple)
-        r |= r_changes
-    return r
+        for _ in range(len(m)):
+            nonterm1, v1, u1 = m.popleft()
+            # (nonterm2, v2, v1) and (nonterm1, v1, u1) give (head, v2, u1)
+            for nonterm2, head in by_right[nonterm1]:
+                for v2 in tuple(incoming[v1].get(nonterm2, ())):
+                    add(head, v2, u1)
+            # (nonterm1, v1, u1) and (nonterm2, u1, u2) give (head, v1, u2)
+            for nonterm2, head in by_left[nonterm1]:
+                for u2 in tuple(outgoing[u1].get(nonterm2, ())):
+                    add(head, v1, u2)
+        tracker.record(r, len(m))
+
+    pairs_by_nonterm = defaultdict(lambda: ([], []))
+    for nonterm, v, u in r:
+        rows, cols = pairs_by_nonterm[nonterms[nonterm]]
+        rows.append(v)
+        cols.append(u)
+    n = len(nodes)
+    return QueryResult.from_matrices(
+        nodes,
+        {
+            nonterm: from_coords((n, n), rows, cols)
+            for nonterm, (rows, cols) in pairs_by_nonterm.items()
+        },
+    )
 
 
 def cfpg_by_matrix(
@@ -103,60 +249,504 @@ def cfpg_by_matrix(
     cfg: CFG,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    type_of_matrix=dok_matrix,
+    workers: int = 1,
 ):
-    if start_nodes is None:
-        start_nodes = graph.nodes
+    """Pairs of start and final nodes connected by a path derived from
+    the start symbol of cfg, all nodes if start or final nodes are None
+
+    type_of_matrix applies in both cases: with start_nodes the rows of the
+    start nodes are computed by eval_matrix_from_sources_result, otherwise
+    the whole relation by eval_matrix_result.
+    """
     if final_nodes is None:
         final_nodes = graph.nodes
-    start_symbol = cfg.start_symbol.value
+
+    if start_nodes is None:
+        query_result = eval_matrix_result(graph, cfg, type_of_matrix, workers)
+        start_nodes = graph.nodes
+    else:
+        query_result = eval_matrix_from_sources_result(
+            graph, cfg, start_nodes, type_of_matrix, workers
+        )
 
     result = {
         (x, y)
-        for (label, x, y) in eval_matrix(graph, cfg)
-        if x in start_nodes and y in final_nodes and label == start_symbol
+        for (x, y) in query_result.to_set(cfg.start_symbol.value)
+        if x in start_nodes and y in final_nodes
     }
     return result
 
 
-def eval_matrix(graph: MultiDiGraph, cfg: CFG):
-    n = graph.number_of_nodes()
+def eval_matrix(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    type_of_matrix=dok_matrix,
+    workers: int = 1,
+    instrumentation=None,
+):
+    return eval_matrix_result(
+        graph, cfg, type_of_matrix, workers, instrumentation
+    ).to_triples()
+
+
+def eval_matrix_result(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    type_of_matrix=dok_matrix,
+    workers: int = 1,
+    instrumentation=None,
+) -> QueryResult:
+    """Matrix CFPQ with the answer kept as one CSR matrix per nonterminal
+
+    :param workers: int
+        Number of processes computing products of a fixpoint round,
+        1 computes them in the calling process.
+
+    :param instrumentation: receiver of per-round records,
+        see project.instrumentation
+
+    :return result: QueryResult
+    """
+    graph_matrices = get_graph_matrices(graph)
+    nodes = graph_matrices.nodes
+    # Fixpoint is computed on CSR (or packed bits) whatever the input type is
+    work_type = BitMatrix if type_of_matrix is BitMatrix else csr_matrix
+
+    matrices, bodies_by_head = _wcnf_matrices(
+        graph_matrices, get_weakened_normal_form(cfg), work_type
+    )
+    with MatrixPool(workers) as pool:
+        _close_matrices(
+            matrices,
+            bodies_by_head,
+            pool,
+            get_tracker(instrumentation, "eval_matrix"),
+        )
+
+    return QueryResult.from_matrices(nodes, matrices)
+
+
+def eval_matrix_from_sources(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    start_nodes: Set[int],
+    type_of_matrix=dok_matrix,
+    workers: int = 1,
+    instrumentation=None,
+):
+    """Matrix CFPQ restricted to paths which start in start_nodes
 
-    wcnf = to_weakened_normal_form(cfg)
-    eps_nonterm = {p.head.value for p in wcnf.productions if not p.body}
-    terms_prod = {p for p in wcnf.productions if len(p.body) == 1}
-    nonterm_prod = {p for p in wcnf.productions if len(p.body) == 2}
+    :return triples: set of (nonterminal, start node, node)
+    """
+    return eval_matrix_from_sources_result(
+        graph, cfg, start_nodes, type_of_matrix, workers, instrumentation
+    ).to_triples()
+
+
+def eval_matrix_from_sources_result(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    start_nodes: Set[int],
+    type_of_matrix=dok_matrix,
+    workers: int = 1,
+    instrumentation=None,
+) -> QueryResult:
+    """Matrix CFPQ restricted to paths which start in start_nodes
+
+    Rows of nonterminal matrices are computed only for source vertices.
+    Sources start as start_nodes and grow with the vertices where a path of
+    the left nonterminal of a binary production ends, so the work is
+    proportional to the part of the graph explored from start_nodes.
+
+    :param type_of_matrix: as in eval_matrix_result, rows are computed on
+        packed bits for BitMatrix and on CSR for any other type
+
+    :return result: QueryResult
+        Rows of nodes which are not in start_nodes are empty.
+    """
+    graph_matrices = get_graph_matrices(graph)
+    nodes = graph_matrices.nodes
+    n = graph_matrices.number_of_nodes
+    work_type = BitMatrix if type_of_matrix is BitMatrix else csr_matrix
+
+    bases, bodies_by_head = _wcnf_matrices(
+        graph_matrices, get_weakened_normal_form(cfg), work_type
+    )
+    left_nonterms = {left for bodies in bodies_by_head.values() for left, _ in bodies}
+    matrices = {nonterm: work_type((n, n), dtype=bool) for nonterm in bases}
+    start_indexes = [
+        graph_matrices.node_indexes[v]
+        for v in start_nodes
+        if v in graph_matrices.node_indexes
+    ]
+    is_source = np.zeros(n, dtype=bool)
+    pending = np.zeros(n, dtype=bool)
+    pending[start_indexes] = True
+    deltas = {}
+    tracker = get_tracker(instrumentation, "eval_matrix")
+
+    with MatrixPool(workers) as pool, pool.replicate(matrices) as shared:
+        while deltas or pending.any():
+            if pending.any():
+                is_source |= pending
+                new_rows = _row_selection(pending, work_type)
+                for nonterm, base in bases.items():
+                    delta = difference(new_rows @ base, matrices[nonterm])
+                    if delta.nnz:
+                        matrices[nonterm] = matrices[nonterm] + delta
+                        deltas[nonterm] = (
+                            deltas[nonterm] + delta if nonterm in deltas else delta
+                        )
+            pending = np.zeros(n, dtype=bool)
+            for nonterm in left_nonterms & deltas.keys():
+                pending[deltas[nonterm].nonzero()[1]] = True
+            pending &= ~is_source
+            # Deltas hold every pair added since the last round
+            shared.advance(deltas)
+            deltas = _semi_naive_step(matrices, deltas, bodies_by_head, shared)
+            tracker.record(matrices, deltas)
+
+    is_start = np.zeros(n, dtype=bool)
+    is_start[start_indexes] = True
+    start_rows = _row_selection(is_start, work_type)
+    return QueryResult.from_matrices(
+        nodes, {nonterm: start_rows @ matrix for nonterm, matrix in matrices.items()}
+    )
 
+
+def _row_selection(mask: np.ndarray, work_type):
+    # Diagonal matrix keeping the rows of the mask in a product
+    indexes = np.flatnonzero(mask)
+    return from_coords((mask.size, mask.size), indexes, indexes, work_type)
+
+
+def _wcnf_matrices(graph_matrices, wcnf: CFG, work_type):
+    # Matrices of terminal and epsilon productions of every nonterminal
+    # and bodies of binary productions grouped by head
+    n = graph_matrices.number_of_nodes
     matrices = {
-        nonterm.value: dok_matrix((n, n), dtype=bool) for nonterm in wcnf.variables
+        nonterm.value: work_type((n, n), dtype=bool) for nonterm in wcnf.variables
     }
+    bodies_by_head = defaultdict(set)
+    for p in wcnf.productions:
+        if not p.body:
+            matrices[p.head.value] += identity(n, work_type)
+        elif len(p.body) == 1 and p.body[0].value in graph_matrices.matrices:
+            matrices[p.head.value] += convert(
+                graph_matrices.matrices[p.body[0].value], work_type
+            )
+        elif len(p.body) == 2:
+            bodies_by_head[p.head.value].add((p.body[0].value, p.body[1].value))
+    return matrices, bodies_by_head
+
+
+def _close_matrices(matrices, bodies_by_head, pool: MatrixPool = None, tracker=None):
+    deltas = {nonterm: matrix for nonterm, matrix in matrices.items() if matrix.nnz}
+    pool = MatrixPool(1) if pool is None else pool
+    # Workers get the matrices once, then only the deltas of a round
+    with pool.replicate(matrices, deltas) as shared:
+        while deltas:
+            deltas = _semi_naive_step(matrices, deltas, bodies_by_head, shared)
+            shared.advance(deltas)
+            if tracker is not None:
+                tracker.record(matrices, deltas)
+    return matrices
+
+
+def _semi_naive_step(
+    matrices, deltas, bodies_by_head, shared: ReplicatedMatrices = None
+):
+    # With M = M_old + dM, the new part of M_B @ M_C is covered by
+    # dM_B @ M_C + M_B @ dM_C, as M_old_B @ M_old_C is already in M_A.
+    # Only nonterminals with non-empty delta are kept in deltas.
+    # Heads of a round are independent, so they may go to the workers of
+    # shared, which hold matrices and deltas and return only new pairs.
+    tasks = [
+        (head, sorted(bodies))
+        for head, bodies in sorted(bodies_by_head.items())
+        if any(left in deltas or right in deltas for left, right in bodies)
+    ]
+    if shared is None:
+        replica = Replica(matrices, deltas)
+        head_deltas = [_head_delta(replica, task) for task in tasks]
+    else:
+        head_deltas = shared.map(_head_delta, tasks)
+
+    new_deltas = {}
+    for (head, _), delta in zip(tasks, head_deltas):
+        if delta.nnz:
+            new_deltas[head] = delta
+    for head, delta in new_deltas.items():
+        matrices[head] = matrices[head] + delta
+    return new_deltas
+
+
+def _head_delta(replica: Replica, task):
+    # New pairs of the head, products are summed in a fixed order
+    head, bodies = task
+    matrices, deltas = replica.matrices, replica.deltas
+    products = []
+    for left, right in bodies:
+        if left in deltas:
+            products.append(deltas[left] @ matrices[right])
+        if right in deltas:
+            products.append(matrices[left] @ deltas[right])
+    return difference(reduce(add, products), matrices[head])
+
+
+class DynamicCfpq:
+    """Matrix CFPQ index of a graph maintained under edge updates.
+
+    Nonterminal matrices are kept closed under the productions of the
+    grammar. Inserted edges are propagated semi-naively from the terminal
+    productions. Deleted edges are handled by delete and rederive: every
+    pair whose derivation may use a deleted edge is removed, then pairs
+    which still have a derivation are inserted back.
+
+    :param graph: networkx.MultiDiGraph
+        Initial graph, it is not changed by the updates of the index.
+
+    :param cfg: CFG
+    """
 
-    for i, j, label in graph.edges(data="label"):
-        for nonterm in (
-            tp.head.value for tp in terms_prod if tp.body[0].value == label
-        ):
-            matrices[nonterm][i, j] = True
-
-    for i in range(n):
-        for nonterm in eps_nonterm:
-            matrices[nonterm][i, i] = True
-
-    while True:
-        changed = False
-        for nonterm in nonterm_prod:
-            nnz = matrices[nonterm.head.value].count_nonzero()
-            matrices[nonterm.head.value] += (
-                matrices[nonterm.body[0].value] @ matrices[nonterm.body[1].value]
+    def __init__(self, graph: MultiDiGraph, cfg: CFG):
+        wcnf = get_weakened_normal_form(cfg)
+        graph_matrices = get_graph_matrices(graph)
+        self.start_symbol = cfg.start_symbol.value
+        self.nodes = list(graph_matrices.nodes)
+        self.node_indexes = dict(graph_matrices.node_indexes)
+        # Cached graph matrices are shared, so the index works on copies
+        self.label_matrices = LabelMatrices(
+            {label: matrix.copy() for label, matrix in graph_matrices.matrices.items()},
+            csr_matrix,
+        )
+        self.edge_counts = Counter(
+            (self.node_indexes[u], self.node_indexes[v], label)
+            for u, v, label in graph.edges(data="label")
+        )
+
+        self.matrices, self.bodies_by_head = _wcnf_matrices(
+            graph_matrices, wcnf, csr_matrix
+        )
+        n = len(self.nodes)
+        self.matrices.setdefault(self.start_symbol, csr_matrix((n, n), dtype=bool))
+        self.epsilon_heads = set()
+        self.heads_by_term = defaultdict(set)
+        for p in wcnf.productions:
+            if not p.body:
+                self.epsilon_heads.add(p.head.value)
+            elif len(p.body) == 1:
+                self.heads_by_term[p.body[0].value].add(p.head.value)
+        _close_matrices(self.matrices, self.bodies_by_head)
+
+    @property
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def add_edge(self, u, v, label):
+        self.add_edges([(u, v, label)])
+
+    def remove_edge(self, u, v, label):
+        self.remove_edges([(u, v, label)])
+
+    def add_edges(self, edges):
+        """Insert edges and propagate the pairs they derive
+
+        :param edges: iterable of (u, v, label)
+            Unknown nodes are added to the index.
+        """
+        new_pairs = defaultdict(lambda: ([], []))
+        new_edges = defaultdict(lambda: ([], []))
+        for u, v, label in edges:
+            i, j = self._add_node(u, new_pairs), self._add_node(v, new_pairs)
+            self.edge_counts[i, j, label] += 1
+            # Parallel edges with the same label derive nothing new
+            if self.edge_counts[i, j, label] == 1:
+                _append_pair(new_edges[label], i, j)
+                for head in self.heads_by_term.get(label, ()):
+                    _append_pair(new_pairs[head], i, j)
+
+        replaced_pairs = defaultdict(lambda: ([], []))
+        for label, pair in new_edges.items():
+            matrix = self._pairs_matrix(pair)
+            if self.label_matrices.inverse_of(label) is not None:
+                # The first x_r edge replaces the transpose of x, as in
+                # a graph given with x_r edges
+                rows, cols = self.label_matrices[label].nonzero()
+                self._add_term_pairs(label, rows, cols, replaced_pairs)
+            elif label in self.label_matrices:
+                matrix = self.label_matrices[label] + matrix
+            self.label_matrices[label] = matrix
+        self._add_inverse_pairs(new_edges, new_pairs)
+        self._delete(
+            {head: self._pairs_matrix(pair) for head, pair in replaced_pairs.items()}
+        )
+        self._insert(
+            {head: self._pairs_matrix(pair) for head, pair in new_pairs.items()}
+        )
+
+    def remove_edges(self, edges):
+        """Delete edges and the pairs which are not derivable without them
+
+        :param edges: iterable of (u, v, label)
+
+        :raises ValueError: if the index has no such edge
+        """
+        removed_pairs = defaultdict(lambda: ([], []))
+        removed_edges = defaultdict(lambda: ([], []))
+        for u, v, label in edges:
+            key = (self.node_indexes.get(u), self.node_indexes.get(v), label)
+            if not self.edge_counts.get(key):
+                raise ValueError(f"No edge ({u!r}, {v!r}) labeled {label!r}")
+            self.edge_counts[key] -= 1
+            if not self.edge_counts[key]:
+                del self.edge_counts[key]
+                _append_pair(removed_edges[label], key[0], key[1])
+                for head in self.heads_by_term.get(label, ()):
+                    _append_pair(removed_pairs[head], key[0], key[1])
+
+        for label, pair in removed_edges.items():
+            self.label_matrices[label] = difference(
+                self.label_matrices[label], self._pairs_matrix(pair)
             )
-            if matrices[nonterm.head.value].count_nonzero() != nnz:
-                changed = True
-        if not changed:
-            break
-
-    return {
-        (nonterm, i, j)
-        for nonterm, matrix in matrices.items()
-        for i, j in zip(*matrix.nonzero())
-    }
+        self._add_inverse_pairs(removed_edges, removed_pairs)
+        # A label without edges is not in the graph, so x_r without edges
+        # is the transpose of x again
+        restored_pairs = defaultdict(lambda: ([], []))
+        for label in removed_edges:
+            if not self.label_matrices[label].nnz:
+                del self.label_matrices[label]
+                if label in self.label_matrices:
+                    rows, cols = self.label_matrices[label].nonzero()
+                    self._add_term_pairs(label, rows, cols, restored_pairs)
+        self._delete(
+            {head: self._pairs_matrix(pair) for head, pair in removed_pairs.items()}
+        )
+        self._insert(
+            {head: self._pairs_matrix(pair) for head, pair in restored_pairs.items()}
+        )
+
+    def _add_inverse_pairs(self, edges, pairs):
+        # Edges of x are reversed edges of x_r when x_r is a transpose
+        for label, (rows, cols) in edges.items():
+            inverse = inverse_label(label)
+            if self.label_matrices.inverse_of(inverse) == label:
+                self._add_term_pairs(inverse, cols, rows, pairs)
+
+    def _add_term_pairs(self, term, rows, cols, pairs):
+        for head in self.heads_by_term.get(term, ()):
+            pairs[head][0].extend(rows)
+            pairs[head][1].extend(cols)
+
+    def query(
+        self, start_nodes: Set = None, final_nodes: Set = None, nonterm=None
+    ) -> Set:
+        """Pairs of nodes connected by a path derivable from nonterm
+
+        :param nonterm: nonterminal value, the start symbol if None
+
+        :return pairs: set of (start node, final node)
+        """
+        pairs = self.result().to_set(self.start_symbol if nonterm is None else nonterm)
+        return {
+            (x, y)
+            for (x, y) in pairs
+            if (start_nodes is None or x in start_nodes)
+            and (final_nodes is None or y in final_nodes)
+        }
+
+    def has_path(self, u, v, nonterm=None) -> bool:
+        if u not in self.node_indexes or v not in self.node_indexes:
+            return False
+        matrix = self.matrices.get(self.start_symbol if nonterm is None else nonterm)
+        return matrix is not None and bool(
+            matrix[self.node_indexes[u], self.node_indexes[v]]
+        )
+
+    def result(self) -> QueryResult:
+        """Current pairs of every nonterminal"""
+        return QueryResult.from_matrices(self.nodes, self.matrices)
+
+    def _add_node(self, node, new_pairs) -> int:
+        if node in self.node_indexes:
+            return self.node_indexes[node]
+        index = len(self.nodes)
+        self.nodes.append(node)
+        self.node_indexes[node] = index
+        for matrix in (*self.matrices.values(), *self.label_matrices.values()):
+            matrix.resize((index + 1, index + 1))
+        for head in self.epsilon_heads:
+            _append_pair(new_pairs[head], index, index)
+        return index
+
+    def _pairs_matrix(self, pair) -> csr_matrix:
+        n = self.number_of_nodes
+        return from_coords((n, n), *pair)
+
+    def _insert(self, pairs_by_head):
+        deltas = {}
+        for head, matrix in pairs_by_head.items():
+            delta = difference(matrix, self.matrices[head])
+            if delta.nnz:
+                self.matrices[head] = self.matrices[head] + delta
+                deltas[head] = delta
+        while deltas:
+            deltas = _semi_naive_step(self.matrices, deltas, self.bodies_by_head)
+
+    def _delete(self, pairs_by_head):
+        # Over-delete: semi-naively collect every existing pair which has
+        # a derivation using an already deleted pair
+        deleted = {}
+        for head, matrix in pairs_by_head.items():
+            delta = matrix.multiply(self.matrices[head]).tocsr()
+            if delta.nnz:
+                deleted[head] = delta
+        deltas = dict(deleted)
+        while deltas:
+            new_deltas = {}
+            for head, bodies in self.bodies_by_head.items():
+                products = []
+                for left, right in bodies:
+                    if left in deltas:
+                        products.append(deltas[left] @ self.matrices[right])
+                    if right in deltas:
+                        products.append(self.matrices[left] @ deltas[right])
+                if products:
+                    delta = reduce(add, products).multiply(self.matrices[head]).tocsr()
+                    if head in deleted:
+                        delta = difference(delta, deleted[head])
+                    if delta.nnz:
+                        new_deltas[head] = delta
+            for head, delta in new_deltas.items():
+                deleted[head] = deleted[head] + delta if head in deleted else delta
+            deltas = new_deltas
+        for head, matrix in deleted.items():
+            self.matrices[head] = difference(self.matrices[head], matrix)
+
+        # Rederive: deleted pairs with a one step derivation from the rest,
+        # all other derivable pairs follow from them by insertion
+        n = self.number_of_nodes
+        rederived = {}
+        for head, matrix in deleted.items():
+            rows = diags(np.diff(matrix.indptr) > 0, format="csr", dtype=bool)
+            candidates = [
+                rows @ self.label_matrices[term]
+                for term, heads in self.heads_by_term.items()
+                if head in heads and term in self.label_matrices
+            ]
+            if head in self.epsilon_heads:
+                candidates.append(rows)
+            for left, right in self.bodies_by_head.get(head, ()):
+                candidates.append((rows @ self.matrices[left]) @ self.matrices[right])
+            if candidates:
+                rederived[head] = reduce(add, candidates).multiply(matrix).tocsr()
+        self._insert(rederived)
+
+
+def _append_pair(pair, i, j):
+    pair[0].append(i)
+    pair[1].append(j)
 
 
 def cfpg_by_tensor_product(
@@ -164,61 +754,157 @@ def cfpg_by_tensor_product(
     cfg: CFG,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    type_of_matrix=dok_matrix,
 ):
-    # return eval_tensor_product(graph, cfg)
     if start_nodes is None:
         start_nodes = graph.nodes
     if final_nodes is None:
         final_nodes = graph.nodes
-    start_symbol = cfg.start_symbol.value
 
+    query_result = eval_tensor_product_result(graph, cfg, type_of_matrix)
     result = {
         (x, y)
-        for (label, x, y) in eval_tensor_product(graph, cfg)
-        if x in start_nodes and y in final_nodes and label == start_symbol
+        for (x, y) in query_result.to_set(cfg.start_symbol.value)
+        if x in start_nodes and y in final_nodes
     }
     return result
 
 
-def eval_tensor_product(graph: MultiDiGraph, cfg: CFG):
-    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph))
-    bma_rsm = BooleanMatrixAutomata(
-        RecursiveStateMachine.from_ecfg(ECFG.from_cfg(cfg)).minimize().to_nfa()
-    )
-    loop_matrix = eye(bma_graph.number_of_states, dtype=bool, format="dok")
+def eval_tensor_product(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    type_of_matrix=dok_matrix,
+    instrumentation=None,
+    implicit: bool = False,
+):
+    return eval_tensor_product_result(
+        graph, cfg, type_of_matrix, instrumentation, implicit
+    ).to_triples()
+
+
+def eval_tensor_product_result(
+    graph: MultiDiGraph,
+    cfg: CFG,
+    type_of_matrix=dok_matrix,
+    instrumentation=None,
+    implicit: bool = False,
+) -> QueryResult:
+    """Tensor CFPQ with the answer kept as one CSR matrix per label
+
+    Relations hold both terminal labels and nonterminals of the grammar.
+
+    :param instrumentation: receiver of per-round records, rounds of the
+        closure of the product are recorded as transitive_closure ones
+
+    :param implicit: bool
+        Never build the product of the RSM and the graph: only states
+        reachable from (RSM start, node) are searched through KronOperator,
+        instead of closing the whole product.
+
+    :return result: QueryResult
+    """
+    # Product and closure are kept on CSR (or packed bits) and updated
+    # incrementally with the nonterminal edges found in the last round
+    work_type = BitMatrix if type_of_matrix is BitMatrix else csr_matrix
+    bma_graph = BooleanMatrixAutomata.from_graph(graph, tom=work_type)
+    bma_rsm = get_rsm_automaton(cfg)
+    graph_n = bma_graph.number_of_states
+    rsm_n = bma_rsm.number_of_states
     for nonterm in cfg.get_nullable_symbols():
-        if nonterm.value not in bma_graph.boolean_matrix:
-            bma_graph.boolean_matrix[nonterm.value] = loop_matrix
-        else:
-            bma_graph.boolean_matrix[nonterm.value] += loop_matrix
-    tc_nnz = 0
-    while True:
-        transitive_closure = bma_rsm.intersect(bma_graph).transitive_closure()
-        if transitive_closure.nnz == tc_nnz:
-            break
-        tc_nnz = transitive_closure.nnz
-        for (i, j) in list(zip(*transitive_closure.nonzero())):
-            graph_n_of_states = bma_graph.number_of_states
-            graph_i = i % graph_n_of_states
-            graph_j = j % graph_n_of_states
-            rsm_i = i // graph_n_of_states
-            rsm_j = j // graph_n_of_states
-            state_i = bma_rsm.indexes_states[rsm_i]
-            state_j = bma_rsm.indexes_states[rsm_j]
-            nonterm = state_i.value[0]
-            if (
-                state_i in bma_rsm.start_state_indexes
-                and state_j in bma_rsm.final_state_indexes
-            ):
-                if nonterm.value not in bma_graph.boolean_matrix.keys():
-                    bma_graph.boolean_matrix[nonterm] = dok_matrix(
-                        (bma_graph.number_of_states, bma_graph.number_of_states),
-                        dtype=bool,
-                    )
-                bma_graph.boolean_matrix[nonterm][graph_i, graph_j] = True
-
-    return {
-        (nonterm, bma_graph.indexes_states[i], bma_graph.indexes_states[j])
-        for nonterm, matrix in bma_graph.boolean_matrix.items()
-        for i, j in zip(*matrix.nonzero())
+        loop_matrix = identity(graph_n, work_type)
+        if nonterm.value in bma_graph.boolean_matrix:
+            loop_matrix = loop_matrix + bma_graph.boolean_matrix[nonterm.value]
+        bma_graph.boolean_matrix[nonterm.value] = loop_matrix
+
+    rsm_matrices = {
+        label: convert(matrix, work_type)
+        for label, matrix in bma_rsm.boolean_matrix.items()
     }
+    boxes = sorted({state.value[0].value for state in bma_rsm.states_indexes})
+    rsm_boxes = np.array(
+        [boxes.index(bma_rsm.indexes_states[i].value[0].value) for i in range(rsm_n)],
+        dtype=np.int64,
+    )
+    is_rsm_start = np.zeros(rsm_n, dtype=bool)
+    is_rsm_start[bma_rsm.state_indexes_of(bma_rsm.start_state_indexes)] = True
+    is_rsm_final = np.zeros(rsm_n, dtype=bool)
+    is_rsm_final[bma_rsm.state_indexes_of(bma_rsm.final_state_indexes)] = True
+
+    def tensor(graph_matrices):
+        product = work_type((rsm_n * graph_n, rsm_n * graph_n), dtype=bool)
+        for label in common_labels(graph_matrices, rsm_matrices):
+            product = product + kron(rsm_matrices[label], graph_matrices[label])
+        return product if isinstance(product, BitMatrix) else product.tocsr()
+
+    closure = work_type((rsm_n * graph_n, rsm_n * graph_n), dtype=bool)
+
+    def found_by_closure(added):
+        nonlocal closure
+        closure, found = extend_transitive_closure(
+            closure, tensor(added), instrumentation
+        )
+        return found.nonzero()
+
+    rsm_starts = bma_rsm.state_indexes_of(bma_rsm.start_state_indexes)
+    sources = (rsm_starts[:, None] * graph_n + np.arange(graph_n)[None, :]).ravel()
+    visited = None
+
+    def operator(graph_matrices):
+        labels = common_labels(graph_matrices, rsm_matrices)
+        return KronOperator(
+            [(rsm_matrices[label], graph_matrices[label]) for label in labels],
+            rsm_n,
+            graph_n,
+        )
+
+    def found_by_search(added):
+        # A new path from a source takes a new edge first from the source
+        # or from a state reached before, the rest may use any edge
+        nonlocal visited
+        full = operator(bma_graph.boolean_matrix)
+        start = full.states(sources)
+        if visited is None:
+            visited = csr_matrix(start.shape, dtype=bool)
+        front = difference(operator(added).step(start + visited), visited)
+        found = front
+        visited = visited + front
+        while front.nnz:
+            front = difference(full.step(front), visited)
+            found = found + front
+            visited = visited + front
+        source_rows, cols = full.to_rows(found).nonzero()
+        return sources[source_rows], cols
+
+    tracker = get_tracker(instrumentation, "eval_tensor_product")
+    added = bma_graph.boolean_matrix
+    while added:
+        if implicit:
+            rows, cols = found_by_search(added)
+        else:
+            rows, cols = found_by_closure(added)
+        rsm_rows = rows // graph_n
+        mask = is_rsm_start[rsm_rows] & is_rsm_final[cols // graph_n]
+        rows, cols, rsm_rows = rows[mask], cols[mask], rsm_rows[mask]
+        added = {}
+        for box in np.unique(rsm_boxes[rsm_rows]).tolist():
+            in_box = rsm_boxes[rsm_rows] == box
+            edges = from_coords(
+                (graph_n, graph_n),
+                rows[in_box] % graph_n,
+                cols[in_box] % graph_n,
+                work_type,
+            )
+            nonterm = boxes[box]
+            if nonterm in bma_graph.boolean_matrix:
+                edges = difference(edges, bma_graph.boolean_matrix[nonterm])
+                if not edges.nnz:
+                    continue
+                bma_graph.boolean_matrix[nonterm] = (
+                    bma_graph.boolean_matrix[nonterm] + edges
+                )
+            else:
+                bma_graph.boolean_matrix[nonterm] = edges
+            added[nonterm] = edges
+        tracker.record(bma_graph.boolean_matrix, added)
+
+    return QueryResult.from_matrices(bma_graph.nodes, bma_graph.boolean_matrix)
@@ -0,0 +1,410 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping, Sequence
+from typing import Dict, List, NamedTuple, Union
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project.bit_matrix import convert
+
+# Label x_r is an x edge traversed backwards
+INVERSE_SUFFIX = "_r"
+
+
+def _label_name(label):
+    # Automata built by pyformlang label transitions with Symbol objects
+    name = getattr(label, "value", label)
+    return name if isinstance(name, str) else None
+
+
+def inverse_label(label):
+    """Label of the same edges traversed backwards: x <-> x_r"""
+    name = _label_name(label)
+    if name is not None and name.endswith(INVERSE_SUFFIX):
+        return name[: -len(INVERSE_SUFFIX)]
+    return f"{label if name is None else name}{INVERSE_SUFFIX}"
+
+
+class LabelMatrices(MutableMapping):
+    """Label -> matrix mapping where x_r is resolved as the transpose of x.
+
+    Only stored labels are iterated and counted. A missing label x_r (a
+    string or a pyformlang Symbol) whose x is stored is the transpose of
+    x: for scipy matrices without type_of_matrix this is the zero-copy
+    view x.T (CSC over the arrays of a CSR x). With type_of_matrix the
+    transpose is converted to it once, in the orientation the products of
+    the caller need. Transposes are cached with the matrix they were made
+    from and its shape, so storing another matrix under x or resizing x
+    drops them. Other changes of x in place must store it again.
+
+    :param matrices: dict of stored label matrices, it is used as it is
+
+    :param type_of_matrix: type of resolved transposes, None keeps .T
+
+    :param transposes: cache shared with another LabelMatrices
+    """
+
+    def __init__(
+        self, matrices: Dict = None, type_of_matrix=None, transposes: Dict = None
+    ):
+        self._matrices = {} if matrices is None else matrices
+        self.type_of_matrix = type_of_matrix
+        self._transposes = {} if transposes is None else transposes
+
+    def inverse_of(self, label):
+        """Stored label whose transpose is the label, None if the label is
+        stored itself or is not resolved"""
+        name = _label_name(label)
+        if (
+            name is not None
+            and name.endswith(INVERSE_SUFFIX)
+            and label not in self._matrices
+        ):
+            base = inverse_label(name)
+            if base in self._matrices:
+                return base
+        return None
+
+    def __getitem__(self, label):
+        if label in self._matrices:
+            return self._matrices[label]
+        base = self.inverse_of(label)
+        if base is None:
+            raise KeyError(label)
+        return self.transpose(base)
+
+    def transpose(self, label, type_of_matrix=None):
+        """Cached transpose of a stored label matrix
+
+        :param type_of_matrix: type of the transpose, the type given to
+            the mapping if None
+        """
+        type_of_matrix = type_of_matrix or self.type_of_matrix
+        matrix = self._matrices[label]
+        key = label, type_of_matrix
+        cached = self._transposes.get(key)
+        # Matrices resized in place (e.g. by DynamicCfpq) keep their identity
+        if (
+            cached is not None
+            and cached[0] is matrix
+            and cached[1].shape == matrix.shape[::-1]
+        ):
+            return cached[1]
+        transposed = matrix.T
+        if type_of_matrix is not None and not isinstance(transposed, type_of_matrix):
+            transposed = convert(transposed, type_of_matrix)
+        self._transposes[key] = matrix, transposed
+        return transposed
+
+    def __contains__(self, label) -> bool:
+        return label in self._matrices or self.inverse_of(label) is not None
+
+    def __setitem__(self, label, matrix):
+        self._matrices[label] = matrix
+
+    def __delitem__(self, label):
+        del self._matrices[label]
+
+    def __iter__(self):
+        return iter(self._matrices)
+
+    def __len__(self) -> int:
+        return len(self._matrices)
+
+    def __repr__(self) -> str:
+        return f"LabelMatrices({self._matrices!r})"
+
+    def with_type(self, type_of_matrix, matrices: Dict = None) -> "LabelMatrices":
+        """Mapping of other stored matrices (these by default) sharing the
+        transpose cache, with transposes of type_of_matrix"""
+        return LabelMatrices(
+            dict(self._matrices) if matrices is None else matrices,
+            type_of_matrix,
+            self._transposes,
+        )
+
+
+def common_labels(first: Mapping, second: Mapping) -> List:
+    """Labels of both mappings, with x_r resolved by LabelMatrices, in a
+    stable order"""
+    labels = {label for label in first if label in second}
+    labels |= {label for label in second if label in first}
+    return sorted(labels, key=repr)
+
+
+class GraphMatrices(NamedTuple):
+    """Per-label boolean adjacency matrices of a graph with node-index mapping.
+
+    Matrices are LabelMatrices, so x_r labels are transposed x matrices.
+    """
+
+    nodes: Sequence
+    node_indexes: Mapping
+    matrices: LabelMatrices
+
+    @property
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+
+# Two independent sums make accidental collisions of fingerprints unlikely
+_FINGERPRINT_SEEDS = (0x9E3779B97F4A7C15, 0xD1B54A32D192ED03)
+_INT64_RANGE = range(-(2**63), 2**63)
+
+
+def _value_key(value) -> int:
+    # hash() maps -1 and -2 to the same value and True to hash(1), so
+    # int64 ids are their own keys and other values are hashed with their
+    # type, parts of tuples by their keys
+    if type(value) is int and value in _INT64_RANGE:
+        return value
+    if type(value) is int:
+        return hash(("int", str(value)))
+    if type(value) is tuple:
+        return hash(("tuple",) + tuple(map(_value_key, value)))
+    return hash((type(value).__qualname__, value))
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _mixed_sum(keys: np.ndarray, seed: int) -> int:
+    # Mixed keys of the rows (node or edge), summed modulo 2**64, so equal
+    # multisets give equal sums whatever their order is
+    mixed = np.full(len(keys), seed, dtype=np.uint64)
+    for column in keys.astype(np.uint64).T:
+        mixed = _mix(mixed ^ column)
+    return int(mixed.sum(dtype=np.uint64))
+
+
+def graph_fingerprint(graph: nx.MultiDiGraph) -> str:
+    """Hash of the node set and the labeled edge multiset of the graph
+
+    Nodes, labels and (source, target, label) edges get 64-bit keys, which
+    are mixed and summed, so nothing is sorted or converted to str and
+    a cache hit costs a small part of building the matrices. Keys of int
+    nodes and labels are their values, so distinct ids never share a key
+    as -1 and -2 share hash(). Keys of other values are Python hashes
+    tagged with the type. Python salts hashes of str per process,
+    fingerprints are compared within one process only.
+
+    :param graph: networkx.MultiDiGraph
+
+    :return fingerprint: str
+    """
+    node_keys = {node: _value_key(node) for node in graph.nodes}
+    label_keys = {}
+    edge_keys = []
+    # Adjacency is walked directly: number_of_edges() and edge views of
+    # a multigraph cost more than the keys themselves
+    for u, neighbors in graph.adjacency():
+        u_key = node_keys[u]
+        for v, edges in neighbors.items():
+            v_key = node_keys[v]
+            for data in edges.values():
+                label = data.get("label")
+                if label not in label_keys:
+                    label_keys[label] = _value_key(label)
+                edge_keys += (u_key, v_key, label_keys[label])
+
+    nodes = np.fromiter(node_keys.values(), np.int64, len(node_keys))[:, None]
+    edges = np.array(edge_keys, dtype=np.int64).reshape(-1, 3)
+    parts = [len(nodes), len(edges)]
+    for seed in _FINGERPRINT_SEEDS:
+        parts += [_mixed_sum(nodes, seed), _mixed_sum(edges, seed)]
+    return "-".join(f"{part:x}" for part in parts)
+
+
+class NodeIndexes(Mapping):
+    """Node id -> index mapping built on the first lookup"""
+
+    def __init__(self, nodes: Sequence):
+        self._nodes = nodes
+        self._indexes = None
+
+    def _mapping(self) -> dict:
+        if self._indexes is None:
+            self._indexes = {node: index for index, node in enumerate(self._nodes)}
+        return self._indexes
+
+    def __getitem__(self, node) -> int:
+        return self._mapping()[node]
+
+    def __iter__(self):
+        return iter(self._mapping())
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+
+def build_graph_matrices(graph: nx.MultiDiGraph) -> GraphMatrices:
+    """Build boolean adjacency matrix for every edge label of the graph
+
+    :param graph: networkx.MultiDiGraph
+
+    :return graph_matrices: GraphMatrices
+    """
+    nodes = list(graph.nodes)
+    node_indexes = {node: index for index, node in enumerate(nodes)}
+    m = graph.number_of_edges()
+    sources, targets, labels = zip(*graph.edges(data="label")) if m else ((), (), ())
+    rows = np.fromiter(map(node_indexes.__getitem__, sources), np.int64, m)
+    cols = np.fromiter(map(node_indexes.__getitem__, targets), np.int64, m)
+    matrices = _label_matrices(rows, cols, labels, len(nodes))
+    return GraphMatrices(nodes, node_indexes, matrices)
+
+
+def graph_matrices_from_edges(
+    sources, labels, targets, nodes: Sequence = None
+) -> GraphMatrices:
+    """Build label matrices from arrays of edges (sources[k], labels[k], targets[k])
+
+    :param sources: array of source node ids
+
+    :param labels: array of edge labels
+
+    :param targets: array of target node ids
+
+    :param nodes: sequence of node ids, its order gives node indexes.
+        If None, nodes are the sorted ids of edge ends.
+
+    :raises ValueError: if an edge end is not in nodes
+
+    :return graph_matrices: GraphMatrices
+    """
+    sources, targets = np.asarray(sources), np.asarray(targets)
+    m = len(sources)
+    if nodes is None:
+        nodes, inverse = np.unique(
+            np.concatenate((sources, targets)), return_inverse=True
+        )
+        rows, cols = inverse[:m], inverse[m:]
+        node_indexes = NodeIndexes(nodes)
+    elif isinstance(nodes, np.ndarray) and nodes.dtype.kind in "iu":
+        sorter = np.argsort(nodes, kind="stable")
+        rows, cols = (
+            _searchsorted_indexes(nodes, sorter, ends) for ends in (sources, targets)
+        )
+        node_indexes = NodeIndexes(nodes)
+    else:
+        node_indexes = {node: index for index, node in enumerate(nodes)}
+        try:
+            rows, cols = (
+                np.fromiter(map(node_indexes.__getitem__, ends.tolist()), np.int64, m)
+                for ends in (sources, targets)
+            )
+        except KeyError as error:
+            raise ValueError(f"Node {error.args[0]!r} is not in nodes") from None
+    matrices = _label_matrices(rows, cols, labels, len(nodes))
+    return GraphMatrices(nodes, node_indexes, matrices)
+
+
+def _searchsorted_indexes(nodes, sorter, ends) -> np.ndarray:
+    if not len(ends):
+        return np.empty(0, dtype=np.int64)
+    if not len(nodes):
+        raise ValueError("Edge ends are not in nodes")
+    positions = np.searchsorted(nodes, ends, sorter=sorter)
+    indexes = sorter[np.minimum(positions, len(nodes) - 1)]
+    if np.any(nodes[indexes] != ends):
+        raise ValueError("Edge ends are not in nodes")
+    return indexes
+
+
+def _label_matrices(rows, cols, labels, n: int) -> LabelMatrices:
+    # Edges are grouped by label with one stable sort, then every
+    # label slice goes through a single COO -> CSR conversion
+    # Python labels keep their types, only typed arrays are grouped by numpy
+    if not isinstance(labels, np.ndarray) or labels.dtype == object:
+        label_ids = {}
+        codes = np.fromiter(
+            (label_ids.setdefault(label, len(label_ids)) for label in labels),
+            np.int64,
+            len(labels),
+        )
+        unique_labels = list(label_ids)
+    else:
+        unique_labels, codes = np.unique(labels, return_inverse=True)
+        unique_labels = unique_labels.tolist()
+    order = np.argsort(codes, kind="stable")
+    bounds = np.concatenate(
+        ([0], np.cumsum(np.bincount(codes, minlength=len(unique_labels))))
+    )
+    rows, cols = np.asarray(rows)[order], np.asarray(cols)[order]
+    matrices = {}
+    for code, label in enumerate(unique_labels):
+        begin, end = bounds[code], bounds[code + 1]
+        matrices[label] = csr_matrix(
+            (np.ones(end - begin, dtype=bool), (rows[begin:end], cols[begin:end])),
+            shape=(n, n),
+            dtype=bool,
+        )
+    return LabelMatrices(matrices)
+
+
+class GraphMatrixCache:
+    """LRU cache of GraphMatrices keyed by graph fingerprint.
+
+    Cached matrices are shared between callers and must not be modified.
+    The cache is safe to use from several threads.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, GraphMatrices]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, graph: nx.MultiDiGraph) -> GraphMatrices:
+        key = graph_fingerprint(graph)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        graph_matrices = build_graph_matrices(graph)
+        if self.maxsize > 0:
+            with self._lock:
+                graph_matrices = self._entries.setdefault(key, graph_matrices)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return graph_matrices
+
+    def invalidate(self, graph: nx.MultiDiGraph = None):
+        """Drop cached matrices of the graph, or of all graphs if it is None"""
+        with self._lock:
+            if graph is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(graph_fingerprint(graph), None)
+
+    def __contains__(self, graph: nx.MultiDiGraph) -> bool:
+        key = graph_fingerprint(graph)
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+graph_matrix_cache = GraphMatrixCache()
+
+
+def get_graph_matrices(graph: Union[nx.MultiDiGraph, GraphMatrices]) -> GraphMatrices:
+    """Matrices of the graph from the shared graph_matrix_cache
+
+    Already built GraphMatrices (e.g. a memory-mapped graph file) are
+    returned as they are, so solvers accept them in place of a graph.
+    """
+    if isinstance(graph, GraphMatrices):
+        return graph
+    return graph_matrix_cache.get(graph)
@@ -1,7 +1,17 @@
+import os
+import pathlib
 from typing import Tuple, NamedTuple
 import networkx as nx
 from cfpq_data import *
 
+from project.graph_cache import GraphMatrices
+from project.graph_store import convert_csv_graph, load_graph_matrices
+
+# Converted graphs are stored here, can be changed by the environment variable
+GRAPH_STORE_DIR = pathlib.Path(
+    os.getenv("GRAPH_STORE_DIR", pathlib.Path.home() / ".cache" / "cfpq-graphs")
+)
+
 
 class GraphInfo(NamedTuple):
     """Stores information about the number of nodes, edges, and various labels."""
@@ -49,6 +59,31 @@ def get_graph_by_name(name: str) -> nx.MultiDiGraph:
     return cfpq_data.graph_from_csv(path_to_graph)
 
 
+def get_graph_matrices_by_name(name: str, store_dir=None) -> GraphMatrices:
+    """Loads label matrices of the graph from the binary graph store.
+
+    Graph is downloaded and converted from CSV on the first request only,
+    later requests memory-map the stored file.
+
+    :param name : str
+        Name of the graph.
+
+    :param store_dir : path to the directory with converted graphs,
+        GRAPH_STORE_DIR if None.
+
+    :return graph_matrices : GraphMatrices
+        Memory-mapped label matrices with node-index mapping.
+    """
+    store_dir = pathlib.Path(GRAPH_STORE_DIR if store_dir is None else store_dir)
+    path = store_dir / f"{name}.cfpqg"
+    if not path.exists():
+        store_dir.mkdir(parents=True, exist_ok=True)
+        converted = path.with_suffix(".tmp")
+        convert_csv_graph(cfpq_data.download(name), converted)
+        os.replace(converted, path)
+    return load_graph_matrices(path)
+
+
 def get_graph_info(name: str):
     """Loads graph and returns it.
 
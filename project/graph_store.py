@@ -0,0 +1,200 @@
+import json
+import os
+import struct
+from collections.abc import Sequence
+from typing import Union
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.graph_cache import (
+    GraphMatrices,
+    LabelMatrices,
+    NodeIndexes,
+    build_graph_matrices,
+)
+
+GRAPH_FORMAT_MAGIC = b"CFPQGRPH"
+GRAPH_FORMAT_VERSION = 1
+# Arrays start at multiples of ALIGNMENT bytes of the file
+ALIGNMENT = 64
+# magic, version, length of JSON header
+_PREAMBLE = struct.Struct("<8sII")
+
+PathLike = Union[str, os.PathLike]
+
+
+class GraphFormatError(ValueError):
+    """File is not a graph in the binary format or has unsupported version"""
+
+
+class _StringNodes(Sequence):
+    """Node ids decoded on access from UTF-8 blob and offsets"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        begin, end = self._offsets[index], self._offsets[index + 1]
+        return self._blob[begin:end].tobytes().decode()
+
+
+def save_graph_matrices(graph_matrices: GraphMatrices, path: PathLike):
+    """Write label matrices and node table in the binary graph format
+
+    File layout: preamble (magic, version, header length), JSON header
+    describing every array (offset, dtype, shape), then the arrays,
+    each aligned to ALIGNMENT bytes. Node ids must be all int or all str,
+    labels must be JSON values.
+
+    :param graph_matrices: GraphMatrices
+
+    :param path: path of the file
+    """
+    arrays = {}
+    nodes = list(graph_matrices.nodes)
+    if all(isinstance(node, (int, np.integer)) for node in nodes):
+        node_kind = "int"
+        arrays["nodes"] = np.asarray(nodes, dtype=np.int64)
+    elif all(isinstance(node, str) for node in nodes):
+        node_kind = "str"
+        encoded = [node.encode() for node in nodes]
+        arrays["nodes.blob"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        arrays["nodes.offsets"] = np.concatenate(
+            ([0], np.cumsum([len(node) for node in encoded], dtype=np.int64))
+        )
+    else:
+        raise TypeError("Node ids must be all int or all str")
+
+    labels = list(graph_matrices.matrices)
+    for number, label in enumerate(labels):
+        matrix = csr_matrix(graph_matrices.matrices[label], dtype=bool)
+        matrix.sum_duplicates()
+        # Index dtypes are kept as scipy chose them, so loading does not cast
+        arrays[f"{number}.indptr"] = matrix.indptr
+        arrays[f"{number}.indices"] = matrix.indices
+        arrays[f"{number}.data"] = matrix.data
+
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {
+            "offset": offset,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(
+        {
+            "number_of_nodes": len(nodes),
+            "node_kind": node_kind,
+            "labels": labels,
+            "arrays": layout,
+        }
+    ).encode()
+    data_start = -(-(_PREAMBLE.size + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path, "wb") as file:
+        file.write(
+            _PREAMBLE.pack(GRAPH_FORMAT_MAGIC, GRAPH_FORMAT_VERSION, len(header))
+        )
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(data_start + layout[name]["offset"])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+
+
+def save_graph(graph: nx.MultiDiGraph, path: PathLike):
+    """Convert the graph to the binary graph format"""
+    save_graph_matrices(build_graph_matrices(graph), path)
+
+
+def convert_csv_graph(csv_path: PathLike, path: PathLike):
+    """One-time conversion of a CSV edge list (cfpq_data format)"""
+    # cfpq_data is slow to import and is needed only for conversion
+    import cfpq_data
+
+    save_graph(cfpq_data.graph_from_csv(csv_path), path)
+
+
+def load_graph_matrices(path: PathLike) -> GraphMatrices:
+    """Memory-map a graph in the binary graph format
+
+    Label matrices are CSR over read-only memory maps of the file,
+    nothing is parsed or copied until it is used.
+
+    :param path: path of the file
+
+    :raises GraphFormatError: if the file has wrong magic or version
+
+    :return graph_matrices: GraphMatrices
+    """
+    with open(path, "rb") as file:
+        preamble = file.read(_PREAMBLE.size)
+        if len(preamble) != _PREAMBLE.size:
+            raise GraphFormatError(f"{path} is too short")
+        magic, version, header_length = _PREAMBLE.unpack(preamble)
+        if magic != GRAPH_FORMAT_MAGIC:
+            raise GraphFormatError(f"{path} is not a graph file")
+        if version != GRAPH_FORMAT_VERSION:
+            raise GraphFormatError(
+                f"{path} has format version {version}, "
+                f"supported is {GRAPH_FORMAT_VERSION}"
+            )
+        header = json.loads(file.read(header_length))
+    data_start = -(-(_PREAMBLE.size + header_length) // ALIGNMENT) * ALIGNMENT
+
+    def array(name):
+        spec = header["arrays"][name]
+        shape = tuple(spec["shape"])
+        if not np.prod(shape):
+            return np.empty(shape, dtype=np.dtype(spec["dtype"]))
+        return np.memmap(
+            path,
+            dtype=np.dtype(spec["dtype"]),
+            mode="r",
+            offset=data_start + spec["offset"],
+            shape=shape,
+        )
+
+    n = header["number_of_nodes"]
+    if header["node_kind"] == "int":
+        nodes = array("nodes")
+    else:
+        nodes = _StringNodes(array("nodes.blob"), array("nodes.offsets"))
+    matrices = LabelMatrices(
+        {
+            label: csr_matrix(
+                (
+                    array(f"{number}.data"),
+                    array(f"{number}.indices"),
+                    array(f"{number}.indptr"),
+                ),
+                shape=(n, n),
+                copy=False,
+            )
+            for number, label in enumerate(header["labels"])
+        }
+    )
+    return GraphMatrices(nodes, NodeIndexes(nodes), matrices)
+
+
+def load_graph_automata(
+    path: PathLike, start_states=None, final_states=None
+) -> BooleanMatrixAutomata:
+    """BooleanMatrixAutomata over the memory-mapped CSR label matrices"""
+    return BooleanMatrixAutomata.from_graph_matrices(
+        load_graph_matrices(path), start_states, final_states, csr_matrix, copy=False
+    )
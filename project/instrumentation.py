@@ -0,0 +1,269 @@
+"""Per-iteration instrumentation of the fixpoint solvers.
+
+Solvers take an ``instrumentation`` argument: None (nothing is measured),
+an Instrumentation, or a callable receiving every IterationRecord. Each
+round of a fixpoint loop reports its time, the size of the result and of
+the delta found in the round, the matrix format and the bytes held by the
+result. With the default, trackers are shared no-op objects, so nothing
+is measured or allocated per round.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+from scipy import sparse
+
+from project.bit_matrix import BitMatrix
+
+
+class IterationRecord(NamedTuple):
+    """Measurements of one round of a fixpoint loop"""
+
+    solver: str
+    iteration: int
+    # Seconds of the round, measuring is not included
+    time: float
+    # Pairs in the result after the round and pairs found in the round
+    nnz: int
+    delta_nnz: int
+    matrix_format: str
+    # Bytes held by the result after the round
+    nbytes: int
+
+
+class Instrumentation:
+    """Receiver of iteration records.
+
+    This base class is disabled: its trackers do nothing and nothing is
+    measured. Subclasses set enabled and override on_iteration.
+    """
+
+    enabled = False
+
+    def on_iteration(self, record: IterationRecord):
+        pass
+
+    def tracker(self, solver: str) -> "IterationTracker":
+        """Tracker of the rounds of one run of the solver"""
+        if not self.enabled:
+            return _NULL_TRACKER
+        return IterationTracker(self, solver)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+NO_INSTRUMENTATION = Instrumentation()
+
+
+class IterationTracker:
+    """Measures the rounds of a solver run and passes records on"""
+
+    def __init__(self, instrumentation: Instrumentation, solver: str):
+        self.instrumentation = instrumentation
+        self.solver = solver
+        self.iteration = 0
+        self._round_start = time.perf_counter()
+
+    def record(self, result, delta):
+        """Report a finished round
+
+        :param result: result after the round, a matrix, a dict of
+            matrices, a set of pairs or a number of pairs
+
+        :param delta: what the round found, of the same kinds
+        """
+        elapsed = time.perf_counter() - self._round_start
+        nnz, matrix_format, nbytes = measure(result)
+        self.instrumentation.on_iteration(
+            IterationRecord(
+                self.solver,
+                self.iteration,
+                elapsed,
+                nnz,
+                measure(delta)[0],
+                matrix_format,
+                nbytes,
+            )
+        )
+        self.iteration += 1
+        self._round_start = time.perf_counter()
+
+
+class _NullTracker(IterationTracker):
+    def __init__(self):
+        super().__init__(NO_INSTRUMENTATION, "")
+
+    def record(self, result, delta):
+        pass
+
+
+_NULL_TRACKER = _NullTracker()
+
+
+def measure(value) -> Tuple[int, str, int]:
+    """(pairs, format, bytes) of a matrix, dict of matrices, set or count"""
+    if value is None:
+        return 0, "none", 0
+    if isinstance(value, (int, np.integer)):
+        return int(value), "count", 0
+    if isinstance(value, Mapping):
+        parts = [measure(matrix) for matrix in value.values()]
+        formats = sorted({matrix_format for _, matrix_format, _ in parts})
+        return (
+            sum(nnz for nnz, _, _ in parts),
+            "+".join(formats) or "none",
+            sum(nbytes for _, _, nbytes in parts),
+        )
+    if isinstance(value, (set, frozenset)):
+        return len(value), "set", sys.getsizeof(value)
+    if isinstance(value, BitMatrix):
+        return value.nnz, "bit", value.words.nbytes
+    if sparse.issparse(value):
+        arrays = ("data", "indices", "indptr", "row", "col")
+        nbytes = sum(
+            getattr(value, name).nbytes
+            for name in arrays
+            if isinstance(getattr(value, name, None), np.ndarray)
+        )
+        return value.nnz, value.format, nbytes or sys.getsizeof(value)
+    if isinstance(value, np.ndarray):
+        return int(np.count_nonzero(value)), "dense", value.nbytes
+    raise TypeError(f"Cannot measure {type(value).__name__}")
+
+
+class IterationStats(Instrumentation):
+    """Keeps all records in memory, e.g. for tests or notebooks"""
+
+    enabled = True
+
+    def __init__(self):
+        self.records: List[IterationRecord] = []
+        self._lock = threading.Lock()
+
+    def on_iteration(self, record: IterationRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per solver: rounds, total time, largest delta and final size"""
+        by_solver = defaultdict(list)
+        for record in self.records:
+            by_solver[record.solver].append(record)
+        return {
+            solver: {
+                "iterations": len(records),
+                "time": sum(record.time for record in records),
+                "max_delta_nnz": max(record.delta_nnz for record in records),
+                "nnz": records[-1].nnz,
+                "max_nbytes": max(record.nbytes for record in records),
+            }
+            for solver, records in by_solver.items()
+        }
+
+
+class CallbackInstrumentation(Instrumentation):
+    """Calls function(record) for every record"""
+
+    enabled = True
+
+    def __init__(self, function: Callable[[IterationRecord], Any]):
+        self.function = function
+
+    def on_iteration(self, record: IterationRecord):
+        self.function(record)
+
+
+class JsonLinesLog(Instrumentation):
+    """Writes every record as a JSON line with wall-clock timestamp,
+    process and thread, fields of extra are added to every line
+
+    :param file: path, or a text stream which is not closed by close()
+
+    :param extra: dict of JSON values, e.g. query id or host
+    """
+
+    enabled = True
+
+    def __init__(self, file, extra: Dict[str, Any] = None):
+        self._owned = isinstance(file, (str, os.PathLike))
+        self.file = open(file, "a") if self._owned else file
+        self.extra = extra or {}
+        self._lock = threading.Lock()
+
+    def on_iteration(self, record: IterationRecord):
+        line = json.dumps(
+            {
+                "timestamp": time.time(),
+                "pid": os.getpid(),
+                "thread": threading.get_ident(),
+                **self.extra,
+                **record._asdict(),
+            }
+        )
+        with self._lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self._owned and not self.file.closed:
+            self.file.close()
+
+
+class ChromeTrace(Instrumentation):
+    """Collects rounds as complete events of the Chrome trace event format
+    (chrome://tracing, Perfetto) and writes them to path on close"""
+
+    enabled = True
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        self.events: List[Dict[str, Any]] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def on_iteration(self, record: IterationRecord):
+        end = time.perf_counter() - self._origin
+        event = {
+            "name": record.solver,
+            "ph": "X",
+            "ts": (end - record.time) * 1e6,
+            "dur": record.time * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": record._asdict(),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def close(self):
+        with open(self.path, "w") as file:
+            json.dump({"traceEvents": self.events}, file)
+
+
+def get_instrumentation(instrumentation) -> Instrumentation:
+    """Instrumentation of a solver argument: None, Instrumentation or callable"""
+    if instrumentation is None:
+        return NO_INSTRUMENTATION
+    if isinstance(instrumentation, Instrumentation):
+        return instrumentation
+    if callable(instrumentation):
+        return CallbackInstrumentation(instrumentation)
+    raise TypeError(f"Not an instrumentation: {instrumentation!r}")
+
+
+def get_tracker(instrumentation, solver: str) -> IterationTracker:
+    """Tracker of a solver run for a solver argument"""
+    return get_instrumentation(instrumentation).tracker(solver)
@@ -0,0 +1,168 @@
+from typing import Any, Dict, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix, eye, kron as sparse_kron
+
+from project.bit_matrix import difference
+from project.graph_cache import common_labels
+from project.instrumentation import get_tracker
+
+
+def _to_csr(matrix) -> csr_matrix:
+    return matrix.tocsr().astype(bool)
+
+
+class KronOperator:
+    """Sum of Kronecker products A_1 ⊗ B_1 + ... + A_m ⊗ B_m, never built.
+
+    The product state (i, j) has index i * second_n + j, as in kron of
+    BooleanMatrixAutomata.intersect. With x reshaped to the first_n x
+    second_n matrix X, (A ⊗ B) x is A X B^T and x (A ⊗ B) is A^T X B
+    (the vec-trick), so only the factors are multiplied.
+
+    Sets of product states reached from k sources are kept in a layout
+    matrix: the factor with more states ("big") indexes rows, and columns
+    hold source * small_n + state of the other factor. A step from all
+    sources at once is then big^T @ F @ (I_k ⊗ small) per term, where
+    only the small factor is repeated k times.
+
+    :param factors: pairs (A, B) of boolean matrices, A of size first_n,
+        B of size second_n
+
+    :param first_n: number of states of the first factors
+
+    :param second_n: number of states of the second factors
+    """
+
+    def __init__(self, factors: Sequence[Tuple[Any, Any]], first_n: int, second_n: int):
+        self.first_n = first_n
+        self.second_n = second_n
+        self.big_first = first_n >= second_n
+        self.factors = [(_to_csr(a), _to_csr(b)) for a, b in factors]
+        # Transposes of the big factors are made once, in the orientation
+        # of the left product, small ones are repeated per number of sources
+        self._steps = []
+        for a, b in self.factors:
+            big, small = (a, b) if self.big_first else (b, a)
+            self._steps.append((big.T.tocsr(), small))
+        self._blocks: Dict[int, list] = {}
+
+    @classmethod
+    def from_automata(cls, first, second) -> "KronOperator":
+        """Operator of first.intersect(second) over their common labels"""
+        labels = common_labels(first.boolean_matrix, second.boolean_matrix)
+        return cls(
+            [
+                (first.boolean_matrix[label], second.boolean_matrix[label])
+                for label in labels
+            ],
+            first.number_of_states,
+            second.number_of_states,
+        )
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        n = self.first_n * self.second_n
+        return n, n
+
+    @property
+    def _small_n(self) -> int:
+        return self.second_n if self.big_first else self.first_n
+
+    @property
+    def _big_n(self) -> int:
+        return self.first_n if self.big_first else self.second_n
+
+    def __matmul__(self, x: np.ndarray) -> np.ndarray:
+        """(sum A ⊗ B) @ x for a vector or a 2-D array of columns"""
+        x = np.asarray(x)
+        n1, n2 = self.first_n, self.second_n
+        columns = x.reshape(n1, n2, -1)
+        c = columns.shape[2]
+        result = np.zeros(columns.shape, dtype=np.result_type(x, np.int64))
+        for a, b in self.factors:
+            # A X B^T for every column X: B on the second axis, then A
+            right = b @ columns.transpose(1, 0, 2).reshape(n2, n1 * c)
+            right = right.reshape(n2, n1, c).transpose(1, 0, 2)
+            result += (a @ right.reshape(n1, n2 * c)).reshape(n1, n2, c)
+        return result.reshape(x.shape)
+
+    def rmatmul(self, x: np.ndarray) -> np.ndarray:
+        """x @ (sum A ⊗ B) for a vector or a 2-D array of rows"""
+        x = np.asarray(x)
+        n1, n2 = self.first_n, self.second_n
+        rows = x.reshape(-1, n1, n2)
+        r = rows.shape[0]
+        result = np.zeros(rows.shape, dtype=np.result_type(x, np.int64))
+        for a, b in self.factors:
+            # A^T X B for every row X: B on the last axis, then A^T
+            right = (b.T @ rows.reshape(r * n1, n2).T).T.reshape(r, n1, n2)
+            left = a.T @ right.transpose(1, 0, 2).reshape(n1, r * n2)
+            result += left.reshape(n1, r, n2).transpose(1, 0, 2)
+        return result.reshape(x.shape)
+
+    def to_sparse(self) -> csr_matrix:
+        """The product as a matrix, for tests and small operands only"""
+        product = csr_matrix(self.shape, dtype=bool)
+        for a, b in self.factors:
+            product = product + sparse_kron(a, b, format="csr")
+        return product.astype(bool)
+
+    def states(self, sources: np.ndarray) -> csr_matrix:
+        """Layout of the product states sources[k] reached from source k"""
+        sources = np.asarray(sources, dtype=np.int64)
+        firsts, seconds = np.divmod(sources, self.second_n)
+        bigs, smalls = (firsts, seconds) if self.big_first else (seconds, firsts)
+        k = len(sources)
+        return csr_matrix(
+            (
+                np.ones(k, dtype=bool),
+                (bigs, np.arange(k, dtype=np.int64) * self._small_n + smalls),
+            ),
+            shape=(self._big_n, k * self._small_n),
+        )
+
+    def step(self, states: csr_matrix) -> csr_matrix:
+        """Layout of the product states one transition after states"""
+        k = states.shape[1] // self._small_n
+        if k not in self._blocks:
+            blocks = eye(k, dtype=bool, format="csr")
+            # Only the last number of sources is kept, it rarely changes
+            self._blocks = {
+                k: [
+                    sparse_kron(blocks, small, format="csr") for _, small in self._steps
+                ]
+            }
+        result = csr_matrix(states.shape, dtype=bool)
+        for (big_transposed, _), block in zip(self._steps, self._blocks[k]):
+            result = result + big_transposed @ (states @ block)
+        return result.astype(bool)
+
+    def to_rows(self, states: csr_matrix) -> csr_matrix:
+        """Layout turned into one row of reached product states per source"""
+        states = states.tocoo()
+        sources, smalls = np.divmod(states.col.astype(np.int64), self._small_n)
+        bigs = states.row.astype(np.int64)
+        firsts, seconds = (bigs, smalls) if self.big_first else (smalls, bigs)
+        k = states.shape[1] // self._small_n
+        return csr_matrix(
+            (
+                np.ones(len(sources), dtype=bool),
+                (sources, firsts * self.second_n + seconds),
+            ),
+            shape=(k, self.shape[1]),
+        )
+
+    def reachable(self, sources: np.ndarray, instrumentation=None) -> csr_matrix:
+        """Product states reachable from every source by non-empty paths
+
+        :return rows: boolean CSR matrix, row k holds states of sources[k]
+        """
+        tracker = get_tracker(instrumentation, "kron_reachable")
+        front = self.step(self.states(sources))
+        visited = front
+        while front.nnz:
+            front = difference(self.step(front), visited)
+            visited = visited + front
+            tracker.record(visited, front)
+        return self.to_rows(visited)
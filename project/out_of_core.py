@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project.bit_matrix import BitMatrix, difference
+from project.instrumentation import get_tracker
+
+# Bytes of closure rows kept in memory at once by default
+DEFAULT_MEMORY_BUDGET = int(os.getenv("CLOSURE_MEMORY_BUDGET", 256 * 2**20))
+# Rows of the first panel, later panels are sized from the measured rows
+FIRST_PANEL_ROWS = 64
+# Peak memory of a panel relative to its closure rows: the rows, the front
+# and the product of the front with the adjacency matrix
+_PANEL_PEAK_FACTOR = 3
+
+
+def _nbytes(matrix: csr_matrix) -> int:
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def blocked_transitive_closure(
+    adjacency,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    directory=None,
+    instrumentation=None,
+) -> csr_matrix:
+    """Transitive closure computed by panels of rows, kept on disk
+
+    Rows of the closure are computed a panel at a time by semi-naive
+    frontier expansion from the rows of adjacency and appended to files,
+    so at most one panel is held in memory. Panel height is chosen from
+    the bytes per row of the previous panels to keep a panel within
+    memory_budget. The adjacency matrix itself is not counted and is read
+    as it is (it may be memory-mapped too).
+
+    :param adjacency: square boolean matrix (scipy sparse or BitMatrix)
+
+    :param memory_budget: int
+        Bytes of closure rows (with temporaries) held in memory at once.
+
+    :param directory: directory of the temporary files, the system
+        temporary directory if None
+
+    :param instrumentation: receiver of per-round records
+
+    :return closure: CSR matrix over read-only memory maps of the files.
+        Files are unlinked once mapped, the disk space is freed when the
+        matrix is garbage collected.
+    """
+    if isinstance(adjacency, BitMatrix):
+        adjacency = adjacency.tocsr()
+    adjacency = csr_matrix(adjacency, dtype=bool)
+    adjacency.sum_duplicates()
+    n = adjacency.shape[0]
+    # Every index fits the dtype whatever the number of pairs is, scipy
+    # would copy the arrays to make indices and indptr of one dtype
+    index_dtype = np.int32 if n * n < 2**31 else np.int64
+    tracker = get_tracker(instrumentation, "transitive_closure")
+
+    workdir = tempfile.mkdtemp(prefix="closure-", dir=directory)
+    try:
+        indptr = np.zeros(n + 1, dtype=index_dtype)
+        nnz = 0
+        with open(os.path.join(workdir, "indices"), "wb") as indices_file:
+            begin, panel_rows = 0, FIRST_PANEL_ROWS
+            while begin < n:
+                end = min(n, begin + panel_rows)
+                panel = adjacency[begin:end]
+                front = panel
+                while front.nnz:
+                    front = difference(front @ adjacency, panel)
+                    panel = panel + front
+                    tracker.record(panel, front)
+                panel.sort_indices()
+
+                indices_file.write(panel.indices.astype(index_dtype).tobytes())
+                indptr[begin + 1 : end + 1] = nnz + panel.indptr[1:]
+                nnz += panel.nnz
+                row_bytes = _PANEL_PEAK_FACTOR * _nbytes(panel) / (end - begin)
+                panel_rows = max(1, int(memory_budget // max(row_bytes, 1)))
+                begin = end
+
+        with open(os.path.join(workdir, "data"), "wb") as data_file:
+            chunk = np.ones(min(nnz, 1 << 24), dtype=bool).tobytes()
+            for start in range(0, nnz, len(chunk) or 1):
+                data_file.write(chunk[: nnz - start])
+
+        def mapped(name, dtype):
+            if not nnz:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(
+                os.path.join(workdir, name), dtype=dtype, mode="r", shape=(nnz,)
+            )
+
+        return csr_matrix(
+            (mapped("data", bool), mapped("indices", index_dtype), indptr),
+            shape=(n, n),
+            copy=False,
+        )
+    finally:
+        # Mapped files stay readable after unlinking on POSIX systems,
+        # elsewhere the directory is left for the system to clean
+        shutil.rmtree(workdir, ignore_errors=True)
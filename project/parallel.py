@@ -0,0 +1,305 @@
+import os
+from itertools import repeat
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project.bit_matrix import BitMatrix
+
+
+class _SharedArrays:
+    """Shared memory segments holding numpy arrays, owned by the caller.
+
+    An array is described to other processes by a picklable
+    (segment name, dtype, shape) spec, so matrices are never pickled.
+    """
+
+    def __init__(self):
+        self._segments = []
+        self._specs = {}
+
+    def share(self, array: np.ndarray) -> Tuple[str, str, Tuple[int, ...]]:
+        from multiprocessing import shared_memory
+
+        key = id(array)
+        if key not in self._specs:
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=segment.buf)[...] = array
+            self._segments.append(segment)
+            # Array is referenced to keep its id unique while it is shared
+            self._specs[key] = (array, (segment.name, array.dtype.str, array.shape))
+        return self._specs[key][1]
+
+    def share_matrix(self, matrix):
+        if isinstance(matrix, BitMatrix):
+            return "bit", matrix.shape, (self.share(matrix.words),)
+        matrix = matrix.tocsr()
+        arrays = (matrix.data, matrix.indices, matrix.indptr)
+        return "csr", matrix.shape, tuple(self.share(array) for array in arrays)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments.clear()
+        self._specs.clear()
+
+    def __enter__(self) -> "_SharedArrays":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach_matrix(spec, segments):
+    from multiprocessing import shared_memory
+
+    kind, shape, array_specs = spec
+    arrays = []
+    for name, dtype, array_shape in array_specs:
+        segment = shared_memory.SharedMemory(name=name)
+        segments.append(segment)
+        arrays.append(np.ndarray(array_shape, np.dtype(dtype), buffer=segment.buf))
+    if kind == "bit":
+        matrix = BitMatrix.__new__(BitMatrix)
+        matrix.shape, matrix.words = shape, arrays[0]
+        return matrix
+    return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def _shared_task_worker(function, specs, task):
+    segments = []
+    try:
+        matrices = {key: _attach_matrix(spec, segments) for key, spec in specs.items()}
+        return function(matrices, task)
+    finally:
+        for segment in segments:
+            segment.close()
+
+
+def _fork_context():
+    # Workers of replicated matrices get them as arguments at start, which
+    # are inherited without a copy only by forked processes. Imported
+    # here, as serial callers should not pay for multiprocessing
+    import multiprocessing
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork")
+
+
+# Rounds whose deltas hold fewer pairs are computed in the calling
+# process: sending them to workers costs more than the products
+PARALLEL_MIN_NNZ = 50_000
+
+
+class Replica:
+    """Matrices of a ReplicatedMatrices as seen by a task function
+
+    :param matrices: dict of matrices with all accumulated deltas added
+
+    :param deltas: dict of the deltas of the current round
+    """
+
+    def __init__(self, matrices: Dict, deltas: Dict):
+        self.matrices = matrices
+        self.deltas = deltas
+
+
+def _replica_worker(connection, matrices):
+    # Serves rounds until None: (updates, deltas, function, tasks), where
+    # deltas None are the last update
+    replica = Replica(matrices, {})
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        updates, deltas, function, tasks = message
+        for update in updates:
+            for key, delta in update.items():
+                matrix = replica.matrices.get(key)
+                replica.matrices[key] = delta if matrix is None else matrix + delta
+        replica.deltas = updates[-1] if deltas is None else deltas
+        try:
+            connection.send((True, [function(replica, task) for task in tasks]))
+        except Exception as error:
+            connection.send((False, error))
+    connection.close()
+
+
+class ReplicatedMatrices:
+    """Matrices of a fixpoint replicated in worker processes.
+
+    Workers are started on the first round worth running in parallel and
+    get the matrices once, at start. Later they receive only the deltas
+    of the rounds since their last round, and tasks run there as
+    function(replica, task), so results should be small (e.g. only new
+    pairs). Rounds with deltas of fewer than min_parallel_nnz pairs, or
+    with a single task, run in the calling process.
+
+    Workers are forked, so they share the matrices with the calling
+    process instead of getting pickled copies. Where fork is not
+    available (e.g. Windows) every round runs in the calling process.
+
+    The caller keeps matrices up to date itself: deltas given to advance
+    with accumulate are already added to them.
+
+    :param pool: MatrixPool, its number of workers is used
+
+    :param matrices: dict of matrices, used as it is
+
+    :param deltas: dict of deltas of the first round, e.g. matrices
+    """
+
+    def __init__(self, pool: "MatrixPool", matrices: Dict, deltas: Dict = None):
+        self.pool = pool
+        self.matrices = matrices
+        self.deltas = {} if deltas is None else deltas
+        self._connections = []
+        self._processes = []
+        # Accumulated deltas which the workers have not got yet
+        self._pending = []
+
+    def advance(self, deltas: Dict, accumulate: bool = True):
+        """Start a round with the given deltas
+
+        :param accumulate: deltas were added to the matrices, otherwise
+            they are only the deltas of this round (e.g. a BFS front)
+        """
+        self.deltas = deltas
+        if accumulate and self._processes:
+            self._pending.append(deltas)
+
+    def map(self, function: Callable, tasks: Sequence) -> List:
+        """Results of function(replica, task) for every task in task order,
+        function must be a module-level function (picklable)"""
+        nnz = sum(delta.nnz for delta in self.deltas.values())
+        if not self.pool.parallel or len(tasks) < 2 or nnz < self.pool.min_parallel_nnz:
+            replica = Replica(self.matrices, self.deltas)
+            return [function(replica, task) for task in tasks]
+        if not self._processes and not self._start():
+            replica = Replica(self.matrices, self.deltas)
+            return [function(replica, task) for task in tasks]
+        updates, self._pending = self._pending, []
+        deltas = None if updates and updates[-1] is self.deltas else self.deltas
+        # Every worker gets the updates, tasks are dealt round-robin
+        workers = len(self._connections)
+        for k, connection in enumerate(self._connections):
+            connection.send((updates, deltas, function, tasks[k::workers]))
+        results = [None] * len(tasks)
+        errors = []
+        for k, connection in enumerate(self._connections):
+            ok, value = connection.recv()
+            if ok:
+                results[k::workers] = value
+            else:
+                errors.append(value)
+        if errors:
+            raise errors[0]
+        return results
+
+    def _start(self) -> bool:
+        context = _fork_context()
+        if context is None:
+            return False
+        for _ in range(self.pool.workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=_replica_worker,
+                args=(worker_connection, self.matrices),
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+        # Workers start with the current matrices
+        self._pending = []
+        return True
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections.clear()
+        self._processes.clear()
+
+    def __enter__(self) -> "ReplicatedMatrices":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MatrixPool:
+    """Pool of worker processes for independent boolean matrix products.
+
+    Operands of map_shared are passed to workers through shared memory,
+    replicated matrices are inherited by forked workers. Results are
+    returned in the order of the tasks, so merging them is deterministic.
+    With a single worker products are computed in the calling process.
+
+    :param workers: number of worker processes, None means os.cpu_count()
+
+    :param min_parallel_nnz: rounds of replicated matrices with smaller
+        deltas run in the calling process, PARALLEL_MIN_NNZ if None
+    """
+
+    def __init__(self, workers: int = None, min_parallel_nnz: int = None):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.min_parallel_nnz = (
+            PARALLEL_MIN_NNZ if min_parallel_nnz is None else min_parallel_nnz
+        )
+        self._executor = None
+
+    @property
+    def parallel(self) -> bool:
+        return self.workers > 1
+
+    def map_shared(
+        self, function: Callable, matrices: Dict[Any, Any], tasks: Sequence
+    ) -> List:
+        """Results of function(matrices, task) for every task in task order
+
+        Matrices are put into shared memory once for all tasks, function
+        must be a module-level function (picklable).
+        """
+        if not self.parallel or len(tasks) < 2:
+            return [function(matrices, task) for task in tasks]
+        with _SharedArrays() as shared:
+            specs = {key: shared.share_matrix(m) for key, m in matrices.items()}
+            return list(
+                self._get_executor().map(
+                    _shared_task_worker, repeat(function), repeat(specs), tasks
+                )
+            )
+
+    def replicate(self, matrices: Dict, deltas: Dict = None) -> ReplicatedMatrices:
+        """Matrices of a fixpoint shared with the workers once, see
+        ReplicatedMatrices"""
+        return ReplicatedMatrices(self, matrices, deltas)
+
+    def _get_executor(self):
+        # Imported here, as serial callers should not pay for multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "MatrixPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
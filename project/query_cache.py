@@ -0,0 +1,170 @@
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+from scipy.sparse import dok_matrix
+
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfg import to_weakened_normal_form
+from project.ecfg import ECFG
+from project.finite_automata import build_minimal_dfa_from_regex
+from project.rsm import RecursiveStateMachine
+
+# Part of every key, entries of other versions are never read
+CACHE_FORMAT_VERSION = 1
+
+
+def regex_text(regex: Regex) -> str:
+    """Canonical text of the regex: its parse tree, not the source string"""
+    return f"{type(regex).__name__}\0{regex}"
+
+
+def cfg_text(cfg: CFG) -> str:
+    """Canonical text of the grammar: start symbol and sorted productions"""
+
+    def symbol(s) -> str:
+        return f"{type(s).__name__}:{s.value!r}"
+
+    productions = sorted(
+        f"{symbol(p.head)} -> {' '.join(map(symbol, p.body))}" for p in cfg.productions
+    )
+    return "\n".join([symbol(cfg.start_symbol), *productions])
+
+
+class QueryCache:
+    """Two-tier cache of compiled query artifacts.
+
+    Entries are kept in an in-memory LRU and, if directory is set, pickled
+    to directory/<key>.pickle, where key is a hash of the artifact kind and
+    the canonical query text. Cached objects are shared between callers and
+    must not be modified. The cache may be shared by threads, an artifact
+    built concurrently by two of them is stored once.
+
+    :param maxsize: int
+        Number of entries in memory.
+
+    :param directory: path of the on-disk tier, None disables it
+    """
+
+    def __init__(self, maxsize: int = 128, directory=None):
+        self.maxsize = maxsize
+        self.directory = None if directory is None else pathlib.Path(directory)
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(kind: str, text: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{CACHE_FORMAT_VERSION}\0{kind}\0{text}".encode())
+        return digest.hexdigest()
+
+    def get(self, kind: str, text: str, build: Callable[[], Any]) -> Any:
+        """Cached artifact of the kind for the query text, built on a miss"""
+        key = self.key(kind, text)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        # Built without the lock, so a slow build does not block other queries
+        value = self._load(key)
+        if value is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            value = build()
+            self._store(key, value)
+        if self.maxsize > 0:
+            with self._lock:
+                value = self._entries.setdefault(key, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.pickle"
+
+    def _load(self, key: str):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Unreadable entry (e.g. written by other code) is rebuilt
+            return None
+
+    def _store(self, key: str, value):
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file first, so readers never see a partial entry
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, self._path(key))
+
+    def clear(self, disk: bool = False):
+        """Drop entries from memory, and from the directory if disk is True"""
+        with self._lock:
+            self._entries.clear()
+        if disk and self.directory is not None and self.directory.exists():
+            for path in self.directory.glob("*.pickle"):
+                path.unlink()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+query_cache = QueryCache(directory=os.getenv("QUERY_CACHE_DIR"))
+
+
+def get_regex_automaton(
+    regex: Regex, type_of_matrix=dok_matrix
+) -> BooleanMatrixAutomata:
+    """Boolean matrix automaton of the minimal DFA of the regex"""
+    return query_cache.get(
+        f"dfa:{type_of_matrix.__module__}.{type_of_matrix.__qualname__}",
+        regex_text(regex),
+        lambda: BooleanMatrixAutomata(
+            build_minimal_dfa_from_regex(regex), type_of_matrix
+        ),
+    )
+
+
+def get_normal_form(cfg: CFG) -> CFG:
+    """Chomsky normal form of the grammar"""
+    return query_cache.get("cnf", cfg_text(cfg), cfg.to_normal_form)
+
+
+def get_weakened_normal_form(cfg: CFG) -> CFG:
+    """Weakened Chomsky normal form of the grammar"""
+    return query_cache.get("wcnf", cfg_text(cfg), lambda: to_weakened_normal_form(cfg))
+
+
+def get_rsm_automaton(cfg: CFG) -> BooleanMatrixAutomata:
+    """Boolean matrix automaton of the minimized recursive state machine"""
+    return query_cache.get(
+        "rsm",
+        cfg_text(cfg),
+        lambda: BooleanMatrixAutomata(
+            RecursiveStateMachine.from_ecfg(ECFG.from_cfg(cfg)).minimize().to_nfa()
+        ),
+    )
@@ -0,0 +1,108 @@
+from typing import Any, Dict, Iterator, NamedTuple, Set, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+class QueryResult(NamedTuple):
+    """Reachable pairs of RPQ or CFPQ as boolean CSR matrices.
+
+    Every relation (one per nonterminal for CFPQ, a single one under key
+    None for RPQ) is a matrix over node indexes, nodes[i] is the id of the
+    node with index i. Pairs are turned into Python objects only on request.
+    """
+
+    nodes: np.ndarray
+    relations: Dict[Any, csr_matrix]
+
+    @classmethod
+    def from_matrices(cls, nodes, matrices: Dict[Any, Any]) -> "QueryResult":
+        """Result over the given node ids from boolean matrices of any type"""
+        return cls(
+            node_array(nodes),
+            {key: matrix.tocsr().astype(bool) for key, matrix in matrices.items()},
+        )
+
+    def _relation(self, key) -> csr_matrix:
+        if key is None and key not in self.relations and len(self.relations) == 1:
+            return next(iter(self.relations.values()))
+        if key not in self.relations:
+            # Relation without any pair, e.g. a nonterminal deriving nothing
+            return csr_matrix((len(self.nodes), len(self.nodes)), dtype=bool)
+        return self.relations[key]
+
+    def index_pairs(self, key=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Arrays of start and final node indexes of the relation"""
+        return self._relation(key).nonzero()
+
+    def pairs(self, key=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Arrays of start and final node ids of the relation"""
+        rows, cols = self.index_pairs(key)
+        return self.nodes[rows], self.nodes[cols]
+
+    def iter_pairs(
+        self, key=None, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield arrays of start and final node ids, about chunk_size pairs
+        at a time, without materializing all pairs at once"""
+        matrix = self._relation(key)
+        indptr = matrix.indptr
+        row = 0
+        while row < matrix.shape[0]:
+            # Last row which keeps the chunk within chunk_size (at least one row)
+            end = np.searchsorted(indptr, indptr[row] + chunk_size, side="right") - 1
+            end = min(max(end, row + 1), matrix.shape[0])
+            begin_nnz, end_nnz = indptr[row], indptr[end]
+            if end_nnz > begin_nnz:
+                rows = np.repeat(np.arange(row, end), np.diff(indptr[row : end + 1]))
+                cols = matrix.indices[begin_nnz:end_nnz]
+                yield self.nodes[rows], self.nodes[cols]
+            row = end
+
+    def restricted(
+        self, key=None, start_indexes=None, final_indexes=None
+    ) -> "QueryResult":
+        """Result with the single relation of the key, keeping only pairs
+        from start_indexes to final_indexes (None keeps all nodes)"""
+        matrix = self._relation(key)
+        n = len(self.nodes)
+        if start_indexes is not None:
+            matrix = _index_mask(n, start_indexes) @ matrix
+        if final_indexes is not None:
+            matrix = matrix @ _index_mask(n, final_indexes)
+        return QueryResult(self.nodes, {key: matrix.tocsr()})
+
+    def to_set(self, key=None) -> Set[Tuple[Any, Any]]:
+        """Set of (start node, final node) pairs of the relation"""
+        starts, finals = self.pairs(key)
+        return set(zip(starts.tolist(), finals.tolist()))
+
+    def to_triples(self) -> Set[Tuple[Any, Any, Any]]:
+        """Set of (key, start node, final node) over all relations"""
+        return {
+            (key, start, final)
+            for key in self.relations
+            for start, final in self.to_set(key)
+        }
+
+    @property
+    def nnz(self) -> int:
+        return sum(matrix.nnz for matrix in self.relations.values())
+
+
+def node_array(nodes) -> np.ndarray:
+    """Node ids as an array that can be indexed by index arrays"""
+    nodes = list(nodes)
+    if all(isinstance(node, (int, np.integer)) for node in nodes):
+        return np.array(nodes, dtype=np.int64)
+    array = np.empty(len(nodes), dtype=object)
+    array[:] = nodes
+    return array
+
+
+def _index_mask(n: int, indexes) -> csr_matrix:
+    mask = np.zeros(n, dtype=bool)
+    mask[np.asarray(indexes, dtype=np.int64)] = True
+    return diags(mask, format="csr", dtype=bool)
@@ -1,27 +1,210 @@
+import time
+from typing import List, NamedTuple, Set, Tuple
+
+import numpy as np
+
 from project.finite_automata import *
 from project.boolean_matrix_automata import *
+from project.kron_operator import KronOperator
+from project.query_cache import get_regex_automaton
+from project.query_result import QueryResult
+
+
+class RpqBatchResult(NamedTuple):
+    """Answers of a batch of RPQ queries with setup and per-query timings."""
+
+    results: List[Set[Tuple[int, int]]]
+    setup_time: float
+    query_times: List[float]
+
+    @property
+    def mean_query_time(self) -> float:
+        return sum(self.query_times) / len(self.query_times) if self.query_times else 0
+
+    def timing_report(self) -> str:
+        return (
+            f"setup: {self.setup_time:.6f}s, "
+            f"queries: {len(self.query_times)}, "
+            f"total query: {sum(self.query_times):.6f}s, "
+            f"mean query: {self.mean_query_time:.6f}s"
+        )
+
+
+def rpq(
+    graph,
+    regex,
+    start_states=None,
+    final_states=None,
+    type_of_matrix=dok_matrix,
+    instrumentation=None,
+    closure_method: str = "linear",
+):
+    return rpq_result(
+        graph,
+        regex,
+        start_states,
+        final_states,
+        type_of_matrix,
+        instrumentation,
+        closure_method,
+    ).to_set()
+
 
+def rpq_result(
+    graph,
+    regex,
+    start_states=None,
+    final_states=None,
+    type_of_matrix=dok_matrix,
+    instrumentation=None,
+    closure_method: str = "linear",
+) -> QueryResult:
+    """Regular path query with the answer kept as a boolean CSR matrix
 
-def rpq(graph, regex, start_states=None, final_states=None, type_of_matrix=dok_matrix):
-    bool_matrix_for_graph = BooleanMatrixAutomata(
-        build_nfa_from_graph(graph, start_states, final_states), type_of_matrix
+    :param graph: networkx.MultiDiGraph
+
+    :param regex: Regex
+
+    :param start_states: set of start nodes, None means all nodes
+
+    :param final_states: set of final nodes, None means all nodes
+
+    :param type_of_matrix: type of label matrices
+
+    :param instrumentation: receiver of per-round records of the closure
+
+    :param closure_method: method of BooleanMatrixAutomata.transitive_closure,
+        "out_of_core" keeps the closure of the product on disk, "implicit"
+        never builds the product: states reachable from start states are
+        searched through KronOperator
+
+    :return result: QueryResult
+        Single relation of (start node, final node) pairs.
+    """
+    bool_matrix_for_graph = BooleanMatrixAutomata.from_graph(
+        graph, start_states, final_states, type_of_matrix
     )
-    bool_matrix_for_regex = BooleanMatrixAutomata(
-        build_minimal_dfa_from_regex(regex), type_of_matrix
+    return rpq_result_by_automata(
+        bool_matrix_for_graph, regex, instrumentation, closure_method
     )
-    intersection = bool_matrix_for_graph.intersect(bool_matrix_for_regex)
-    tc = intersection.transitive_closure()
-    row, col = tc.nonzero()
-    rpq_ans = set()
-    for start, fin in zip(row, col):
-        if (
-            start in intersection.start_state_indexes
-            and fin in intersection.final_state_indexes
-        ):
-            rpq_ans.add(
-                (
-                    start // bool_matrix_for_regex.number_of_states,
-                    fin // bool_matrix_for_regex.number_of_states,
-                )
+
+
+def rpq_batch(graph, queries, type_of_matrix=dok_matrix) -> RpqBatchResult:
+    """Evaluate many regular path queries against one graph
+
+    Label matrices of the graph are built once and shared by all queries.
+
+    :param graph: networkx.MultiDiGraph
+
+    :param queries: list of Regex or (Regex, start_states, final_states)
+        Start or final states set to None mean all nodes of the graph.
+
+    :param type_of_matrix: type of label matrices
+
+    :return result: RpqBatchResult
+        Answers in the order of queries, setup time and time of each query.
+    """
+    setup_start = time.perf_counter()
+    bool_matrix_for_graph = BooleanMatrixAutomata.from_graph(graph, tom=type_of_matrix)
+    setup_time = time.perf_counter() - setup_start
+
+    results, query_times = [], []
+    for query in queries:
+        regex, start_states, final_states = (
+            query if isinstance(query, tuple) else (query, None, None)
+        )
+        query_start = time.perf_counter()
+        results.append(
+            rpq_by_automata(
+                bool_matrix_for_graph.with_states(start_states, final_states), regex
             )
-    return rpq_ans
+        )
+        query_times.append(time.perf_counter() - query_start)
+    return RpqBatchResult(results, setup_time, query_times)
+
+
+def rpq_by_automata(bool_matrix_for_graph: BooleanMatrixAutomata, regex):
+    return rpq_result_by_automata(bool_matrix_for_graph, regex).to_set()
+
+
+def rpq_result_by_automata(
+    bool_matrix_for_graph: BooleanMatrixAutomata,
+    regex,
+    instrumentation=None,
+    closure_method: str = "linear",
+) -> QueryResult:
+    type_of_matrix = bool_matrix_for_graph.type_of_matrix
+    bool_matrix_for_regex = get_regex_automaton(regex, type_of_matrix)
+    regex_n = bool_matrix_for_regex.number_of_states
+    graph_n = bool_matrix_for_graph.number_of_states
+    if closure_method == "implicit":
+        row, col = _reachable_by_operator(
+            bool_matrix_for_graph, bool_matrix_for_regex, instrumentation
+        )
+    else:
+        row, col = _reachable_by_closure(
+            bool_matrix_for_graph.intersect(bool_matrix_for_regex),
+            closure_method,
+            instrumentation,
+        )
+    relation = csr_matrix(
+        (np.ones(row.size, dtype=bool), (row // regex_n, col // regex_n)),
+        shape=(graph_n, graph_n),
+        dtype=bool,
+    )
+    return QueryResult.from_matrices(bool_matrix_for_graph.nodes, {None: relation})
+
+
+def _reachable_by_closure(
+    intersection: BooleanMatrixAutomata, closure_method: str, instrumentation=None
+):
+    # (start, final) pairs of product state indexes in the closure
+    tc = intersection.transitive_closure(closure_method, instrumentation)
+    is_final = np.zeros(intersection.number_of_states, dtype=bool)
+    is_final[intersection.final_state_indexes] = True
+    if isinstance(tc, BitMatrix):
+        row, col = tc.nonzero()
+        is_start = np.zeros(intersection.number_of_states, dtype=bool)
+        is_start[intersection.start_state_indexes] = True
+        mask = is_start[row] & is_final[col]
+        return row[mask], col[mask]
+    # Only rows of start states are read, so a closure kept on disk
+    # is never loaded as a whole
+    starts = np.unique(np.asarray(intersection.start_state_indexes, np.int64))
+    start_rows, col = tc.tocsr()[starts].nonzero()
+    mask = is_final[col]
+    return starts[start_rows[mask]], col[mask]
+
+
+def _reachable_by_operator(
+    bool_matrix_for_graph: BooleanMatrixAutomata,
+    bool_matrix_for_regex: BooleanMatrixAutomata,
+    instrumentation=None,
+):
+    # (start, final) pairs of product state indexes, as found in the closure
+    # of the intersection, without building the intersection
+    regex_n = bool_matrix_for_regex.number_of_states
+    graph_starts = bool_matrix_for_graph.state_indexes_of(
+        bool_matrix_for_graph.start_state_indexes
+    )
+    regex_starts = bool_matrix_for_regex.state_indexes_of(
+        bool_matrix_for_regex.start_state_indexes
+    )
+    sources = (graph_starts[:, None] * regex_n + regex_starts[None, :]).ravel()
+    operator = KronOperator.from_automata(bool_matrix_for_graph, bool_matrix_for_regex)
+    source_rows, col = operator.reachable(sources, instrumentation).nonzero()
+
+    is_graph_final = np.zeros(bool_matrix_for_graph.number_of_states, dtype=bool)
+    is_graph_final[
+        bool_matrix_for_graph.state_indexes_of(
+            bool_matrix_for_graph.final_state_indexes
+        )
+    ] = True
+    is_regex_final = np.zeros(regex_n, dtype=bool)
+    is_regex_final[
+        bool_matrix_for_regex.state_indexes_of(
+            bool_matrix_for_regex.final_state_indexes
+        )
+    ] = True
+    mask = is_graph_final[col // regex_n] & is_regex_final[col % regex_n]
+    return sources[source_rows[mask]], col[mask]
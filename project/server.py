@@ -0,0 +1,481 @@
+"""Persistent local query service, started by ``python -m project``.
+
+Graphs are loaded once and kept with their label matrices and automata,
+compiled queries stay in the shared query cache, so a request pays only
+for the query itself. Requests and responses are JSON lines, read from
+stdin (answers to stdout) or from connections to a Unix socket.
+
+Request: {"id": any, "op": name, ...arguments}. Operations:
+
+- load: {"name", and one of "path" (binary graph file), "csv" (cfpq_data
+  CSV), "dataset" (cfpq_data graph name), "edges" ([[u, label, v], ...])}
+- rpq: {"graph", "regex", optional "start", "final", "limit", "count_only"}
+- cfpq: {"graph", "grammar", optional "start_symbol" ("S"), "algorithm"
+  ("matrix", "tensor" or "hellings"), "start", "final", "limit", "count_only"}
+- reload: {optional "graphs" (names, all if missing), "queries" (bool)}
+- unload: {"name"}
+- graphs, stats, ping, shutdown
+
+Response: {"id", "ok", "result" or "error", "time": {"queued", "run"}}.
+Requests are handled concurrently, so responses of one stream may come
+in another order than requests, "id" matches them.
+"""
+import argparse
+import io
+import json
+import os
+import pathlib
+import signal
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple
+
+import numpy as np
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix
+
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import (
+    eval_hellings_result,
+    eval_matrix_from_sources_result,
+    eval_matrix_result,
+    eval_tensor_product_result,
+)
+from project.graph_cache import (
+    GraphMatrices,
+    build_graph_matrices,
+    graph_matrices_from_edges,
+)
+from project.graph_store import load_graph_matrices
+from project.query_cache import query_cache
+from project.query_result import QueryResult
+from project.rpq import rpq_result_by_automata
+
+CFPQ_ALGORITHMS = ("matrix", "tensor", "hellings")
+# RPQ from at most this share of the nodes searches from the start nodes
+# alone instead of computing the closure of the whole product
+RPQ_SEARCH_START_SHARE = 0.1
+GRAPH_SOURCES = ("path", "csv", "dataset", "edges")
+
+
+class RequestError(ValueError):
+    """Request is malformed or refers to an unknown graph or node"""
+
+
+class LoadedGraph(NamedTuple):
+    """Graph kept by the server, replaced as a whole on reload"""
+
+    name: str
+    source: Dict[str, Any]
+    graph_matrices: GraphMatrices
+    automaton: BooleanMatrixAutomata
+    loaded_at: float
+    load_time: float
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "source": {k: v for k, v in self.source.items() if k != "edges"},
+            "nodes": self.graph_matrices.number_of_nodes,
+            "edges": int(sum(m.nnz for m in self.graph_matrices.matrices.values())),
+            "labels": sorted(map(str, self.graph_matrices.matrices)),
+            "loaded_at": self.loaded_at,
+            "load_time": self.load_time,
+        }
+
+
+def load_source(source: Dict[str, Any]) -> GraphMatrices:
+    """Label matrices of the graph described by a load request"""
+    if "path" in source:
+        return load_graph_matrices(source["path"])
+    if "csv" in source:
+        # cfpq_data is slow to import and is needed only for these sources
+        import cfpq_data
+
+        return build_graph_matrices(cfpq_data.graph_from_csv(source["csv"]))
+    if "dataset" in source:
+        from project.graph_module import get_graph_matrices_by_name
+
+        return get_graph_matrices_by_name(source["dataset"])
+    if "edges" in source:
+        edges = source["edges"]
+        if not edges:
+            return graph_matrices_from_edges([], [], [])
+        sources, labels, targets = zip(*edges)
+        return graph_matrices_from_edges(sources, list(labels), targets)
+    raise RequestError(f"graph source needs one of: {', '.join(GRAPH_SOURCES)}")
+
+
+class QueryServer:
+    """Graph registry and request handler of the query service.
+
+    :param workers: number of threads handling requests
+
+    :param matrix_workers: number of processes of the matrix CFPQ,
+        1 computes it in the handling thread
+    """
+
+    def __init__(self, workers: int = 4, matrix_workers: int = 1):
+        self.workers = workers
+        self.matrix_workers = matrix_workers
+        self._graphs: Dict[str, LoadedGraph] = {}
+        # Guards the registry only, queries run on the entry they looked up,
+        # so a reload never waits for or breaks requests in flight
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="query")
+        self._stopped = threading.Event()
+        self._socket_server = None
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self._operations: Dict[str, Callable[[dict], Any]] = {
+            "load": self._load,
+            "unload": self._unload,
+            "reload": self._reload,
+            "rpq": self._rpq,
+            "cfpq": self._cfpq,
+            "graphs": lambda request: self.graph_infos(),
+            "stats": lambda request: self.stats(),
+            "ping": lambda request: "pong",
+            "shutdown": self._shutdown,
+        }
+
+    # Graph registry
+
+    def load_graph(self, name: str, source: Dict[str, Any]) -> LoadedGraph:
+        """Load the graph and register it under the name, replacing the
+        previous graph of that name once the new one is ready"""
+        start = time.perf_counter()
+        graph_matrices = load_source(source)
+        automaton = BooleanMatrixAutomata.from_graph_matrices(
+            graph_matrices, tom=csr_matrix, copy=False
+        )
+        loaded = LoadedGraph(
+            name,
+            dict(source),
+            graph_matrices,
+            automaton,
+            time.time(),
+            time.perf_counter() - start,
+        )
+        with self._lock:
+            self._graphs[name] = loaded
+        return loaded
+
+    def reload(self, names: List[str] = None) -> List[str]:
+        """Load graphs from their sources again, all of them if names is None
+
+        Every graph is swapped in only after it is loaded, requests started
+        before keep the old matrices until they finish.
+        """
+        with self._lock:
+            if names is None:
+                names = sorted(self._graphs)
+            sources = {name: self.graph(name).source for name in names}
+        for name, source in sources.items():
+            self.load_graph(name, source)
+        return list(sources)
+
+    def graph(self, name: str) -> LoadedGraph:
+        graph = self._graphs.get(name)
+        if graph is None:
+            raise RequestError(f"unknown graph {name!r}")
+        return graph
+
+    def graph_infos(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            graphs = list(self._graphs.values())
+        return [graph.info() for graph in graphs]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "uptime": time.time() - self.started_at,
+            "workers": self.workers,
+            "graphs": len(self._graphs),
+            "requests": self.requests,
+            "errors": self.errors,
+            "query_cache": {
+                "entries": len(query_cache),
+                "hits": query_cache.hits,
+                "disk_hits": query_cache.disk_hits,
+                "misses": query_cache.misses,
+            },
+        }
+
+    # Requests
+
+    def handle(self, request: Any, received_at: float = None) -> Dict[str, Any]:
+        """Response to a decoded request, errors are reported in it
+
+        :param request: dict, or RequestError if the line was not JSON
+
+        :param received_at: time.perf_counter() when the request was read
+        """
+        start = time.perf_counter()
+        queued = 0.0 if received_at is None else start - received_at
+        request_id = request.get("id") if isinstance(request, dict) else None
+        response: Dict[str, Any] = {"id": request_id, "ok": True}
+        try:
+            response["result"] = self._dispatch(request)
+        except RequestError as error:
+            response["ok"], response["error"] = False, str(error)
+        except Exception as error:
+            response["ok"] = False
+            response["error"] = f"{type(error).__name__}: {error}"
+        response["time"] = {"queued": queued, "run": time.perf_counter() - start}
+        with self._lock:
+            self.requests += 1
+            self.errors += not response["ok"]
+        return response
+
+    def _dispatch(self, request):
+        if isinstance(request, RequestError):
+            raise request
+        if not isinstance(request, dict):
+            raise RequestError("request must be a JSON object")
+        operation = self._operations.get(request.get("op"))
+        if operation is None:
+            raise RequestError(f"unknown op {request.get('op')!r}")
+        return operation(request)
+
+    def _load(self, request):
+        name = _argument(request, "name")
+        source = {key: request[key] for key in GRAPH_SOURCES if key in request}
+        return self.load_graph(name, source).info()
+
+    def _unload(self, request):
+        name = _argument(request, "name")
+        with self._lock:
+            self.graph(name)
+            del self._graphs[name]
+        return name
+
+    def _reload(self, request):
+        if request.get("queries"):
+            query_cache.clear()
+        return self.reload(request.get("graphs"))
+
+    def _rpq(self, request):
+        graph = self._lookup(request)
+        regex = Regex(_argument(request, "regex"))
+        start, final = request.get("start"), request.get("final")
+        # The automaton skips unknown nodes, so they are reported first
+        for nodes in (start, final):
+            if nodes is not None:
+                _node_indexes(graph, nodes)
+        automaton = graph.automaton.with_states(start, final)
+        search = (
+            start is not None
+            and len(start) <= RPQ_SEARCH_START_SHARE * automaton.number_of_states
+        )
+        result = rpq_result_by_automata(
+            automaton, regex, closure_method="implicit" if search else "linear"
+        )
+        return _answer(graph, result, None, request)
+
+    def _cfpq(self, request):
+        graph = self._lookup(request)
+        algorithm = request.get("algorithm", "matrix")
+        if algorithm not in CFPQ_ALGORITHMS:
+            raise RequestError(f"algorithm must be one of {', '.join(CFPQ_ALGORITHMS)}")
+        cfg = CFG.from_text(
+            _argument(request, "grammar"), Variable(request.get("start_symbol", "S"))
+        )
+        graph_matrices = graph.graph_matrices
+        if algorithm == "hellings":
+            result = eval_hellings_result(graph_matrices, cfg)
+        elif algorithm == "tensor":
+            result = eval_tensor_product_result(graph_matrices, cfg, csr_matrix)
+        elif request.get("start") is not None:
+            # Only rows of the start nodes are computed
+            _node_indexes(graph, request["start"])
+            result = eval_matrix_from_sources_result(
+                graph_matrices, cfg, request["start"], csr_matrix, self.matrix_workers
+            )
+        else:
+            result = eval_matrix_result(
+                graph_matrices, cfg, csr_matrix, self.matrix_workers
+            )
+        return _answer(graph, result, cfg.start_symbol.value, request)
+
+    def _lookup(self, request) -> LoadedGraph:
+        name = _argument(request, "graph")
+        with self._lock:
+            return self.graph(name)
+
+    def _shutdown(self, request):
+        self.shutdown()
+        return "bye"
+
+    # Transports
+
+    def serve_stream(self, reader, writer):
+        """Answer JSON lines of reader on writer until EOF or shutdown
+
+        Requests are handled by the worker threads, every response is
+        written as one line as soon as it is ready. Shutdown is answered
+        after the requests read before it.
+        """
+        write_lock = threading.Lock()
+        futures = []
+
+        def respond(request, received_at):
+            response = self.handle(request, received_at)
+            text = json.dumps(response, default=_to_json) + "\n"
+            with write_lock:
+                writer.write(text)
+                writer.flush()
+
+        for line in reader:
+            if not line.strip():
+                continue
+            received_at = time.perf_counter()
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as error:
+                request = RequestError(f"invalid JSON: {error}")
+            if isinstance(request, dict) and request.get("op") == "shutdown":
+                for future in futures:
+                    future.result()
+                respond(request, received_at)
+                return
+            futures.append(self._executor.submit(respond, request, received_at))
+            futures = [future for future in futures if not future.done()]
+            if self._stopped.is_set():
+                break
+        for future in futures:
+            future.result()
+
+    def serve_unix_socket(self, path: str):
+        """Accept connections on a Unix socket until shutdown, every
+        connection is a stream of requests"""
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reader = io.TextIOWrapper(self.rfile, encoding="utf-8")
+                writer = io.TextIOWrapper(
+                    self.wfile, encoding="utf-8", write_through=True
+                )
+                server.serve_stream(reader, writer)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as socket_server:
+            socket_server.daemon_threads = True
+            self._socket_server = socket_server
+            try:
+                if not self._stopped.is_set():
+                    socket_server.serve_forever()
+            finally:
+                self._socket_server = None
+                os.unlink(path)
+
+    def shutdown(self):
+        """Stop accepting requests, the ones already read are answered"""
+        self._stopped.set()
+        if self._socket_server is not None:
+            # serve_forever waits for shutdown, so it is not called in place
+            threading.Thread(target=self._socket_server.shutdown).start()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self) -> "QueryServer":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _argument(request: dict, name: str):
+    if name not in request:
+        raise RequestError(f"{request.get('op')} request needs {name!r}")
+    return request[name]
+
+
+def _node_indexes(graph: LoadedGraph, nodes) -> np.ndarray:
+    node_indexes = graph.graph_matrices.node_indexes
+    missing = [node for node in nodes if node not in node_indexes]
+    if missing:
+        raise RequestError(f"unknown nodes of graph {graph.name!r}: {missing[:10]}")
+    return np.fromiter((node_indexes[node] for node in nodes), dtype=np.int64)
+
+
+def _answer(graph: LoadedGraph, result: QueryResult, key, request) -> Dict[str, Any]:
+    """Pairs of the relation between requested start and final nodes"""
+    start, final = request.get("start"), request.get("final")
+    result = result.restricted(
+        key,
+        None if start is None else _node_indexes(graph, start),
+        None if final is None else _node_indexes(graph, final),
+    )
+    answer = {"count": result.nnz}
+    if request.get("count_only"):
+        return answer
+    starts, finals = result.pairs(key)
+    limit = request.get("limit")
+    if limit is not None:
+        starts, finals = starts[:limit], finals[:limit]
+    answer["pairs"] = [list(pair) for pair in zip(starts.tolist(), finals.tolist())]
+    answer["truncated"] = len(answer["pairs"]) < answer["count"]
+    return answer
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    return str(value)
+
+
+def _graph_argument(text: str):
+    name, separator, path = text.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError("graph must be NAME=PATH")
+    return name, {"csv" if path.endswith(".csv") else "path": path}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m project", description="Local RPQ/CFPQ query service."
+    )
+    parser.add_argument(
+        "--socket", help="path of a Unix socket to listen on, stdin if not set"
+    )
+    parser.add_argument(
+        "--graph",
+        action="append",
+        default=[],
+        type=_graph_argument,
+        metavar="NAME=PATH",
+        help="graph to load at start (binary graph file, or CSV by suffix)",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="request threads")
+    parser.add_argument(
+        "--matrix-workers", type=int, default=1, help="processes of matrix CFPQ"
+    )
+    parser.add_argument("--query-cache", help="directory of compiled queries")
+    args = parser.parse_args(argv)
+
+    if args.query_cache is not None:
+        query_cache.directory = pathlib.Path(args.query_cache)
+
+    with QueryServer(args.workers, args.matrix_workers) as server:
+        for name, source in args.graph:
+            server.load_graph(name, source)
+        if hasattr(signal, "SIGHUP"):
+            # Loading may take long, so it is not done in the signal handler
+            signal.signal(
+                signal.SIGHUP,
+                lambda signum, frame: threading.Thread(target=server.reload).start(),
+            )
+        if args.socket is None:
+            server.serve_stream(sys.stdin, sys.stdout)
+        else:
+            server.serve_unix_socket(args.socket)
@@ -0,0 +1,89 @@
+"""Compare loading a graph from CSV with loading its binary graph file.
+
+Cold load evicts the binary file from the page cache first, warm load
+reads it again right after. Every load touches all label arrays, so lazy
+memory maps are not measured as free.
+"""
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+import cfpq_data
+
+import shared
+
+sys.path.insert(0, str(shared.ROOT))
+
+from project.graph_cache import build_graph_matrices
+from project.graph_store import convert_csv_graph, load_graph_matrices
+
+
+def touch(graph_matrices) -> int:
+    return sum(
+        int(matrix.indptr[-1]) + int(matrix.indices.sum())
+        for matrix in graph_matrices.matrices.values()
+    )
+
+
+def evict(path: pathlib.Path):
+    with open(path, "rb") as file:
+        os.fsync(file.fileno())
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def measure(load, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        touch(load())
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--csv", type=pathlib.Path, help="graph in cfpq_data CSV")
+    parser.add_argument("--nodes", type=int, default=200_000)
+    parser.add_argument("--edge-probability", type=float, default=0.00002)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = pathlib.Path(directory)
+        csv_path = args.csv
+        if csv_path is None:
+            graph = cfpq_data.fast_labeled_binomial_graph(
+                args.nodes, args.edge_probability, labels=("a", "b", "c"), seed=42
+            )
+            csv_path = cfpq_data.graph_to_csv(graph, directory / "graph.csv")
+        binary_path = directory / "graph.cfpqg"
+
+        start = time.perf_counter()
+        convert_csv_graph(csv_path, binary_path)
+        convert_time = time.perf_counter() - start
+
+        csv_time = measure(
+            lambda: build_graph_matrices(cfpq_data.graph_from_csv(csv_path)),
+            args.repeat,
+        )
+
+        def cold_load():
+            evict(binary_path)
+            return load_graph_matrices(binary_path)
+
+        cold_time = measure(cold_load, args.repeat)
+        warm_time = measure(lambda: load_graph_matrices(binary_path), args.repeat)
+
+        print(f"csv file:        {os.path.getsize(csv_path) / 2**20:10.2f} MiB")
+        print(f"binary file:     {os.path.getsize(binary_path) / 2**20:10.2f} MiB")
+        print(f"one-time convert:{convert_time:10.4f} s")
+        print(f"csv load:        {csv_time:10.4f} s")
+        print(f"binary cold load:{cold_time:10.4f} s")
+        print(f"binary warm load:{warm_time:10.4f} s")
+
+
+if __name__ == "__main__":
+    main()
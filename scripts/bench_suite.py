@@ -0,0 +1,328 @@
+"""Offline benchmark suite of the RPQ and CFPQ algorithms.
+
+Graphs are generated with cfpq_data (two cycles graphs of growing size),
+nothing is downloaded. Every case is run --repeat times with cold graph
+and query caches, wall times are summarized as min / median / mean /
+stdev / max, peak memory is measured in one extra run under tracemalloc
+(numpy and scipy arrays are included), result size is the number of
+pairs (or whether the word is accepted for CYK).
+
+Results are written as JSON. With --baseline, cases are compared with a
+stored run: a case regresses if its median time grows by more than
+--threshold (relative) and --min-delta seconds, or its result size
+changes. The exit code is 1 if anything regressed.
+
+    python scripts/bench_suite.py --output bench.json
+    python scripts/bench_suite.py --baseline bench.json
+"""
+import argparse
+import datetime
+import functools
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple
+
+import cfpq_data
+import numpy as np
+import scipy
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix, dok_matrix
+from scipy.sparse import random as sparse_random
+
+import shared
+
+sys.path.insert(0, str(shared.ROOT))
+
+from project.bit_matrix import BitMatrix, convert
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import (
+    cfpg_by_hellings,
+    cfpg_by_matrix,
+    cfpg_by_tensor_product,
+    cfpq_cyk,
+)
+from project.graph_cache import (
+    build_graph_matrices,
+    graph_fingerprint,
+    graph_matrix_cache,
+)
+from project.query_cache import get_regex_automaton, query_cache
+from project.rpq import rpq
+
+BENCH_FORMAT_VERSION = 1
+GRAMMARS = {
+    "dyck": "S -> a S b S | $",
+    "same_generation": "S -> a S b | a b",
+}
+MATRIX_TYPES = {"dok": dok_matrix, "csr": csr_matrix, "bit": BitMatrix}
+MATRIX_DENSITY = 0.05
+REGEXES = {
+    "star_concat": "a* b*",
+    "any_then_a": "(a | b)* a",
+}
+
+
+class Case(NamedTuple):
+    """Benchmark case, run returns the result size"""
+
+    name: str
+    algorithm: str
+    size: int
+    run: Callable[[], int]
+    # Prepares inputs of run outside of the measured time
+    setup: Callable[[], object] = None
+
+
+def two_cycles(size: int):
+    return cfpq_data.labeled_two_cycles_graph(size, size, labels=("a", "b"))
+
+
+@functools.lru_cache(maxsize=1)
+def large_two_cycles(size: int):
+    # Built only when a case of the size runs, kept for the next case
+    return two_cycles(1000 * size)
+
+
+@functools.lru_cache(maxsize=len(MATRIX_TYPES))
+def random_operands(size: int, type_name: str):
+    # Three 40 * size square matrices of MATRIX_DENSITY, same for every type
+    n = 40 * size
+    return tuple(
+        convert(
+            sparse_random(n, n, MATRIX_DENSITY, "csr", random_state=seed) > 0,
+            MATRIX_TYPES[type_name],
+        )
+        for seed in range(3)
+    )
+
+
+def dyck_word(size: int) -> str:
+    # Nested and concatenated brackets, size letters in total
+    half = size // 4
+    return "a" * half + "b" * half + "ab" * (size // 2 - half)
+
+
+def make_cases(sizes: List[int]) -> List[Case]:
+    cases = []
+    for size in sizes:
+        graph = two_cycles(size)
+        # Single products of sparse operands and a chain, whose second
+        # product has a nearly dense left operand
+        for type_name in MATRIX_TYPES:
+            setup = functools.partial(random_operands, size, type_name)
+            cases.append(
+                Case(
+                    f"matrix_product/single/{type_name}/{size}",
+                    "matrix_product",
+                    size,
+                    lambda setup=setup: (setup()[0] @ setup()[1]).nnz,
+                    setup,
+                )
+            )
+            cases.append(
+                Case(
+                    f"matrix_product/chain/{type_name}/{size}",
+                    "matrix_product",
+                    size,
+                    lambda setup=setup: ((setup()[0] @ setup()[1]) @ setup()[2]).nnz,
+                    setup,
+                )
+            )
+        # A cache hit costs a fingerprint of the graph, a miss a build too
+        cases.append(
+            Case(
+                f"graph_cache/build/{size}",
+                "graph_cache",
+                size,
+                lambda size=size: len(
+                    build_graph_matrices(large_two_cycles(size)).nodes
+                ),
+                functools.partial(large_two_cycles, size),
+            )
+        )
+        cases.append(
+            Case(
+                f"graph_cache/fingerprint/{size}",
+                "graph_cache",
+                size,
+                lambda size=size: len(graph_fingerprint(large_two_cycles(size))),
+                functools.partial(large_two_cycles, size),
+            )
+        )
+        for name, text in REGEXES.items():
+            cases.append(
+                Case(
+                    f"rpq/{name}/{size}",
+                    "rpq",
+                    size,
+                    lambda graph=graph, text=text: len(
+                        rpq(graph, Regex(text), type_of_matrix=csr_matrix)
+                    ),
+                )
+            )
+
+            def bfs(graph=graph, text=text, size=size):
+                bma_graph = BooleanMatrixAutomata.from_graph(
+                    graph, start_states=range(0, size, 4), tom=csr_matrix
+                )
+                bma_regex = get_regex_automaton(Regex(text), csr_matrix)
+                return len(bma_graph.bfs_based_rpq(bma_regex, separately=True))
+
+            cases.append(Case(f"bfs_based_rpq/{name}/{size}", "bfs", size, bfs))
+
+        for name, text in GRAMMARS.items():
+            for algorithm, solver in (
+                ("hellings", cfpg_by_hellings),
+                ("matrix", cfpg_by_matrix),
+                ("tensor", cfpg_by_tensor_product),
+            ):
+                cases.append(
+                    Case(
+                        f"cfpg_by_{algorithm}/{name}/{size}",
+                        algorithm,
+                        size,
+                        lambda graph=graph, text=text, solver=solver: len(
+                            solver(graph, CFG.from_text(text, Variable("S")))
+                        ),
+                    )
+                )
+            word = dyck_word(4 * size)
+            cases.append(
+                Case(
+                    f"cfpq_cyk/{name}/{size}",
+                    "cyk",
+                    size,
+                    lambda word=word, text=text: int(
+                        cfpq_cyk(word, CFG.from_text(text, Variable("S")))
+                    ),
+                )
+            )
+    return cases
+
+
+def clear_caches():
+    graph_matrix_cache.invalidate()
+    query_cache.clear()
+
+
+def measure(case: Case, repeat: int, warm: bool) -> Dict:
+    if case.setup is not None:
+        case.setup()
+    times, sizes = [], set()
+    for _ in range(repeat):
+        if not warm:
+            clear_caches()
+        start = time.perf_counter()
+        sizes.add(case.run())
+        times.append(time.perf_counter() - start)
+
+    if not warm:
+        clear_caches()
+    tracemalloc.start()
+    try:
+        case.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    if len(sizes) != 1:
+        raise RuntimeError(f"{case.name} gives different results: {sorted(sizes)}")
+    return {
+        "name": case.name,
+        "algorithm": case.algorithm,
+        "size": case.size,
+        "result_size": sizes.pop(),
+        "peak_memory": peak,
+        "time": {
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.fmean(times),
+            "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+            "max": max(times),
+            "repeat": len(times),
+        },
+    }
+
+
+def compare(results: List[Dict], baseline: Dict, threshold: float, min_delta: float):
+    """Regressions of results against the baseline run"""
+    stored = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = stored.get(result["name"])
+        if old is None:
+            continue
+        old_time, new_time = old["time"]["median"], result["time"]["median"]
+        if new_time > old_time * (1 + threshold) and new_time - old_time > min_delta:
+            regressions.append(
+                f"{result['name']}: median {old_time:.4f}s -> {new_time:.4f}s"
+            )
+        if result["result_size"] != old["result_size"]:
+            regressions.append(
+                f"{result['name']}: result size "
+                f"{old['result_size']} -> {result['result_size']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", default="10,25,50", help="comma-separated sizes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="run cases containing this")
+    parser.add_argument("--warm", action="store_true", help="keep caches warm")
+    parser.add_argument("--output", help="JSON file of results, stdout if not set")
+    parser.add_argument("--baseline", help="JSON file of a stored run")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--min-delta", type=float, default=0.002)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for case in make_cases(sizes):
+        if args.filter in case.name:
+            results.append(measure(case, args.repeat, args.warm))
+            print(
+                f"{case.name:40} {results[-1]['time']['median']:10.4f} s",
+                file=sys.stderr,
+            )
+
+    report = {
+        "format_version": BENCH_FORMAT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+        },
+        "settings": {"sizes": sizes, "repeat": args.repeat, "warm": args.warm},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(
+                results, json.load(file), args.threshold, args.min_delta
+            )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import cfpq_data
+import numpy as np
+import pytest
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import PythonRegex, Regex
+from scipy.sparse import csr_matrix, kron
+
+from project.bit_matrix import BitMatrix, block_diag, vstack
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import cfpg_by_matrix, cfpg_by_tensor_product
+from project.finite_automata import build_minimal_dfa_from_regex, build_nfa_from_graph
+from project.rpq import rpq
+
+
+def random_dense(shape, density, seed):
+    return np.random.default_rng(seed).random(shape) < density
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (7, 65), (70, 130), (130, 3)])
+def test_matrix_operations(shape):
+    a = random_dense(shape, 0.2, 0)
+    b = random_dense((shape[1], shape[0]), 0.2, 1)
+    c = random_dense(shape, 0.3, 2)
+    bit_a, bit_b, bit_c = BitMatrix(a), BitMatrix(csr_matrix(b)), BitMatrix(c)
+
+    assert np.array_equal(bit_a.toarray(), a)
+    assert bit_a.nnz == np.count_nonzero(a)
+    assert np.array_equal(np.transpose(bit_a.nonzero()), np.argwhere(a))
+    assert np.array_equal((bit_a @ bit_b).toarray(), (a.astype(int) @ b) > 0)
+    assert np.array_equal((bit_a + bit_c).toarray(), a | c)
+    assert np.array_equal((bit_a - bit_c).toarray(), a & ~c)
+    assert np.array_equal(bit_a.T.toarray(), a.T)
+    assert np.array_equal(
+        bit_a.kron(bit_c).toarray(), kron(csr_matrix(a), csr_matrix(c)).toarray()
+    )
+    assert np.array_equal(bit_a.tocsr().toarray(), a)
+
+
+def test_item_access_and_stacking():
+    bit = BitMatrix((3, 100))
+    bit[1, 70] = True
+    bit[[2], 64:] = bit[[1], 64:]
+    assert bit[2, 70] and not bit[0, 70]
+    assert bit.nnz == 2
+    bit[1, 70] = False
+    assert bit.nnz == 1
+    assert vstack([bit, bit]).shape == (6, 100)
+    assert block_diag([bit, BitMatrix.identity(2)]).nnz == 3
+
+
+def test_rpq_on_bit_matrix():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 7, labels=("a", "b"))
+    regex = PythonRegex("aa|aaa|(bb)*")
+    states = set(range(12))
+    assert rpq(graph, regex, {0}, states, BitMatrix) == rpq(graph, regex, {0}, states)
+
+
+def test_bfs_based_rpq_on_bit_matrix():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+    regex = Regex("(a*|b)")
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph), BitMatrix)
+    bma_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(regex), BitMatrix)
+    assert bma_graph.bfs_based_rpq(bma_regex, False) == {0, 1, 2, 3, 4, 5, 6}
+
+
+@pytest.mark.parametrize("cfg_text", ["S -> a S b S | $", "S -> a S | P\nP -> b P | b"])
+def test_cfpq_on_bit_matrix(cfg_text):
+    graph = cfpq_data.labeled_two_cycles_graph(2, 1, labels=("a", "b"))
+    cfg = CFG.from_text(cfg_text, Variable("S"))
+    expected = cfpg_by_matrix(graph, cfg)
+    assert cfpg_by_matrix(graph, cfg, type_of_matrix=BitMatrix) == expected
+    assert cfpg_by_tensor_product(graph, cfg, type_of_matrix=BitMatrix) == expected
@@ -0,0 +1,233 @@
+import random
+
+import cfpq_data
+import networkx as nx
+import numpy as np
+import pytest
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import PythonRegex, Regex
+from scipy.sparse import csr_matrix
+
+from project.bit_matrix import BitMatrix
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import (
+    DynamicCfpq,
+    cfpg_by_hellings,
+    cfpg_by_matrix,
+    cfpg_by_tensor_product,
+)
+from project.graph_cache import (
+    GraphMatrixCache,
+    LabelMatrices,
+    build_graph_matrices,
+    graph_fingerprint,
+    graph_matrices_from_edges,
+    graph_matrix_cache,
+)
+from project.rpq import rpq, rpq_by_automata, rpq_result_by_automata
+
+
+def test_fingerprint_depends_on_labeled_edges():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    same_graph = graph.copy()
+    assert graph_fingerprint(graph) == graph_fingerprint(same_graph)
+
+    same_graph.add_edge(1, 2, label="a")
+    assert graph_fingerprint(graph) != graph_fingerprint(same_graph)
+
+    relabeled = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "c"))
+    assert graph_fingerprint(graph) != graph_fingerprint(relabeled)
+
+    # Insertion order does not matter, multiplicity of edges does
+    reordered = nx.MultiDiGraph()
+    reordered.add_nodes_from(reversed(list(graph.nodes)))
+    reordered.add_edges_from(
+        (u, v, {"label": label})
+        for u, v, label in reversed(list(graph.edges(data="label")))
+    )
+    assert graph_fingerprint(graph) == graph_fingerprint(reordered)
+    reordered.add_edge(0, 1, label=graph.edges[0, 1, 0]["label"])
+    assert graph_fingerprint(graph) != graph_fingerprint(reordered)
+
+
+def test_fingerprint_of_nodes_with_equal_hashes():
+    # hash(-1) == hash(-2) and hash(True) == hash(1)
+    first, second, flag = nx.MultiDiGraph(), nx.MultiDiGraph(), nx.MultiDiGraph()
+    first.add_edge(-1, 0, label="a")
+    second.add_edge(-2, 0, label="a")
+    flag.add_edge(True, 0, label="a")
+    one = nx.MultiDiGraph()
+    one.add_edge(1, 0, label="a")
+    assert graph_fingerprint(first) != graph_fingerprint(second)
+    assert graph_fingerprint(flag) != graph_fingerprint(one)
+    assert rpq(first, Regex("a")) == {(-1, 0)}
+    assert rpq(second, Regex("a")) == {(-2, 0)}
+
+
+def test_lru_eviction_and_invalidation():
+    cache = GraphMatrixCache(maxsize=2)
+    graphs = [
+        cfpq_data.labeled_two_cycles_graph(n, 2, labels=("a", "b")) for n in (2, 3, 4)
+    ]
+    first = cache.get(graphs[0])
+    assert cache.get(graphs[0]) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first.matrices["a"].nnz == 3
+
+    cache.get(graphs[1])
+    cache.get(graphs[0])
+    cache.get(graphs[2])
+    assert graphs[0] in cache and graphs[2] in cache
+    assert graphs[1] not in cache
+
+    cache.invalidate(graphs[0])
+    assert graphs[0] not in cache and len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_second_query_reuses_graph_matrices():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 7, labels=("a", "b"))
+    graph_matrix_cache.invalidate(graph)
+    first = rpq(graph, PythonRegex("a*b"))
+    hits = graph_matrix_cache.hits
+    assert rpq(graph, PythonRegex("a*b")) == first
+    assert graph_matrix_cache.hits == hits + 1
+
+
+def test_matrices_from_edge_arrays():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    sources, targets, labels = map(np.array, zip(*graph.edges(data="label")))
+    expected = build_graph_matrices(graph)
+
+    for nodes in (None, np.array(expected.nodes), list(expected.nodes)):
+        from_edges = graph_matrices_from_edges(sources, labels, targets, nodes)
+        for label, matrix in expected.matrices.items():
+            rows, cols = from_edges.matrices[label].nonzero()
+            pairs = set(zip(rows.tolist(), cols.tolist()))
+            assert {
+                (
+                    from_edges.node_indexes[expected.nodes[i]],
+                    from_edges.node_indexes[expected.nodes[j]],
+                )
+                for i, j in zip(*matrix.nonzero())
+            } == pairs
+
+    with pytest.raises(ValueError):
+        graph_matrices_from_edges(sources, labels, targets, nodes=np.arange(3))
+
+
+def test_rpq_on_automaton_from_edges():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 7, labels=("a", "b"))
+    sources, targets, labels = zip(*graph.edges(data="label"))
+    bma = BooleanMatrixAutomata.from_edges(
+        sources, labels, targets, start_states={0, 2}, tom=csr_matrix
+    )
+    assert list(bma.start_state_indexes) == [0, 2]
+    regex = PythonRegex("a*b")
+    assert rpq_by_automata(bma, regex) == rpq(graph, regex, {0, 2})
+
+
+def test_rpq_result_uses_graph_nodes():
+    graph_matrices = graph_matrices_from_edges(
+        ["x", "y", "z"], ["a", "a", "b"], ["y", "z", "x"]
+    )
+    bma = BooleanMatrixAutomata.from_graph_matrices(graph_matrices, copy=False)
+    assert bma.nodes is graph_matrices.nodes
+    result = rpq_result_by_automata(bma, Regex("a* b"))
+    assert list(result.nodes) == list(graph_matrices.nodes)
+    assert result.to_set() == {("x", "x"), ("y", "x"), ("z", "x")}
+
+
+def with_reversed_edges(graph):
+    reversed_graph = graph.copy()
+    reversed_graph.add_edges_from(
+        (v, u, {"label": f"{label}_r"}) for u, v, label in graph.edges(data="label")
+    )
+    return reversed_graph
+
+
+def test_inverse_labels_are_transposed_views():
+    graph_matrices = build_graph_matrices(
+        cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    )
+    matrices = graph_matrices.matrices
+    assert "a_r" in matrices and "c_r" not in matrices
+    assert sorted(matrices) == ["a", "b"]
+    inverse = matrices["a_r"]
+    assert np.shares_memory(inverse.indices, matrices["a"].indices)
+    assert (inverse != matrices["a"].T).nnz == 0
+
+    rows = LabelMatrices({"a": matrices["a"]}, csr_matrix)
+    assert rows["a_r"].format == "csr" and rows["a_r"] is rows["a_r"]
+    rows["a"] = matrices["b"]
+    assert (rows["a_r"] != matrices["b"].T).nnz == 0
+    with pytest.raises(KeyError):
+        rows["b_r"]
+
+    # Automata of shared matrices share the transposes
+    first, second = (
+        BooleanMatrixAutomata.from_graph_matrices(
+            graph_matrices, tom=csr_matrix, copy=False
+        )
+        for _ in range(2)
+    )
+    assert first.boolean_matrix["b_r"] is second.boolean_matrix["b_r"]
+
+
+@pytest.mark.parametrize("type_of_matrix", [csr_matrix, BitMatrix])
+def test_inverse_labels_match_reversed_edges(type_of_matrix):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    reversed_graph = with_reversed_edges(graph)
+    cfg = CFG.from_text("S -> a_r S a | b_r b | a_r a", Variable("S"))
+    expected = cfpg_by_hellings(reversed_graph, cfg)
+    assert cfpg_by_hellings(graph, cfg) == expected
+    assert cfpg_by_matrix(graph, cfg, type_of_matrix=type_of_matrix) == expected
+    assert cfpg_by_tensor_product(graph, cfg, type_of_matrix=type_of_matrix) == expected
+    assert rpq(graph, Regex("a_r* b")) == rpq(reversed_graph, Regex("a_r* b"))
+
+    index = DynamicCfpq(graph, cfg)
+    index.add_edge(0, 5, "b")
+    index.remove_edge(0, 1, "a")
+    reversed_graph.add_edges_from([(0, 5, {"label": "b"}), (5, 0, {"label": "b_r"})])
+    reversed_graph.remove_edges_from([(0, 1), (1, 0)])
+    assert index.query() == cfpg_by_hellings(reversed_graph, cfg)
+
+
+def test_dynamic_inverse_labels_after_new_nodes():
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from(
+        (u, v, {"label": label})
+        for u, v, label in [(0, 1, "a"), (1, 2, "b"), (2, 3, "b"), (3, 0, "a")]
+    )
+    cfg = CFG.from_text("S -> a_r | b", Variable("S"))
+    index = DynamicCfpq(graph, cfg)
+    index.remove_edge(1, 2, "b")
+    index.add_edge(5, 6, "a")
+    index.remove_edge(2, 3, "b")
+    assert index.query() == {(1, 0), (0, 3), (6, 5)}
+
+
+@pytest.mark.parametrize(
+    "grammar", ["S -> a_r | b", "S -> a_r S a | b_r b | a_r a", "S -> a S a_r | $"]
+)
+def test_dynamic_inverse_labels_match_recompute(grammar):
+    cfg = CFG.from_text(grammar, Variable("S"))
+    rnd = random.Random(grammar)
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from(range(4))
+    for _ in range(5):
+        graph.add_edge(rnd.randrange(4), rnd.randrange(4), label=rnd.choice("ab"))
+    index = DynamicCfpq(graph, cfg)
+    # Explicit x_r edges replace the transpose of x until they are removed
+    for _ in range(30):
+        if rnd.random() < 0.55 or not graph.number_of_edges():
+            u, v = rnd.randrange(7), rnd.randrange(7)
+            label = rnd.choice(["a", "b", "a_r", "b_r"])
+            graph.add_edge(u, v, label=label)
+            index.add_edge(u, v, label)
+        else:
+            u, v, key, label = rnd.choice(list(graph.edges(keys=True, data="label")))
+            graph.remove_edge(u, v, key)
+            index.remove_edge(u, v, label)
+        assert index.query() == cfpg_by_matrix(graph, cfg)
@@ -0,0 +1,56 @@
+import cfpq_data
+import networkx as nx
+import pytest
+from pyformlang.regular_expression import PythonRegex
+
+from project.graph_cache import build_graph_matrices
+from project.graph_store import (
+    GraphFormatError,
+    load_graph_automata,
+    load_graph_matrices,
+    save_graph,
+)
+from project.rpq import rpq, rpq_by_automata
+
+
+def test_round_trip_is_memory_mapped(tmp_path):
+    graph = cfpq_data.labeled_two_cycles_graph(40, 30, labels=("a", "b"))
+    path = tmp_path / "graph.cfpqg"
+    save_graph(graph, path)
+
+    loaded = load_graph_matrices(path)
+    expected = build_graph_matrices(graph)
+    assert list(loaded.nodes) == expected.nodes
+    assert loaded.node_indexes[7] == expected.node_indexes[7]
+    for label, matrix in loaded.matrices.items():
+        assert (expected.matrices[label] != matrix).nnz == 0
+        # Arrays are read-only views of the file, not copies
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            assert not array.flags.writeable and not array.flags.owndata
+
+    regex = PythonRegex("a*b")
+    bma = load_graph_automata(path, start_states={0, 1})
+    assert rpq_by_automata(bma, regex) == rpq(graph, regex, {0, 1})
+
+
+def test_string_nodes(tmp_path):
+    graph = nx.MultiDiGraph()
+    graph.add_edge("alice", "bob", label="knows")
+    graph.add_edge("bob", "café", label="likes")
+    path = tmp_path / "graph.cfpqg"
+    save_graph(graph, path)
+
+    loaded = load_graph_matrices(path)
+    assert list(loaded.nodes) == ["alice", "bob", "café"]
+    assert loaded.node_indexes["café"] == 2
+    assert loaded.matrices["likes"][1, 2]
+
+
+def test_rejects_other_versions(tmp_path):
+    path = tmp_path / "graph.cfpqg"
+    save_graph(cfpq_data.labeled_two_cycles_graph(2, 2, labels=("a", "b")), path)
+    content = bytearray(path.read_bytes())
+    content[8] += 1
+    path.write_bytes(bytes(content))
+    with pytest.raises(GraphFormatError):
+        load_graph_matrices(path)
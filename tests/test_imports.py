@@ -0,0 +1,45 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+# Seconds for a cold import of a solver module in a fresh interpreter
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "2.5"))
+HEAVY_MODULES = ("matplotlib", "tabulate", "scipy.stats", "cfpq_data", "pydot")
+ROOT = pathlib.Path(__file__).parent.parent
+
+
+def cold_import(module: str) -> dict:
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        "print(json.dumps({'time': elapsed, 'modules': sorted(sys.modules)}))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    ).stdout
+    return {**json.loads(output.splitlines()[-1]), "stdout": output}
+
+
+def test_package_import_is_lazy():
+    result = cold_import("project")
+    assert result["stdout"].count("\n") == 1
+    assert "numpy" not in result["modules"]
+    assert "project.rpq" not in result["modules"]
+
+
+@pytest.mark.parametrize("module", ["project.rpq", "project.cfpq"])
+def test_solver_import_budget(module):
+    result = cold_import(module)
+    assert not [name for name in HEAVY_MODULES if name in result["modules"]]
+    assert "concurrent.futures.process" not in result["modules"]
+    assert result["time"] < IMPORT_TIME_BUDGET
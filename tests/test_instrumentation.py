@@ -0,0 +1,95 @@
+import json
+
+import cfpq_data
+import pytest
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix
+
+from project.bit_matrix import BitMatrix
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import eval_hellings, eval_matrix, eval_tensor_product
+from project.finite_automata import build_minimal_dfa_from_regex, build_nfa_from_graph
+from project.instrumentation import (
+    NO_INSTRUMENTATION,
+    ChromeTrace,
+    IterationStats,
+    JsonLinesLog,
+    measure,
+)
+from project.rpq import rpq
+
+GRAPH = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+CFG_DYCK = CFG.from_text("S -> a S b S | $", Variable("S"))
+
+
+def test_default_is_noop():
+    tracker = NO_INSTRUMENTATION.tracker("eval_matrix")
+    assert tracker is NO_INSTRUMENTATION.tracker("rpq")
+    tracker.record(None, None)
+
+
+@pytest.mark.parametrize(
+    "solver, name",
+    [
+        (eval_matrix, "eval_matrix"),
+        (eval_hellings, "eval_hellings"),
+        (eval_tensor_product, "eval_tensor_product"),
+    ],
+)
+def test_cfpq_records(solver, name):
+    stats = IterationStats()
+    expected = solver(GRAPH, CFG_DYCK)
+    assert solver(GRAPH, CFG_DYCK, instrumentation=stats) == expected
+
+    records = [record for record in stats.records if record.solver == name]
+    assert [record.iteration for record in records] == list(range(len(records)))
+    # The last round finds nothing new
+    assert records[-1].delta_nnz == 0
+    assert all(record.time >= 0 and record.nbytes > 0 for record in records)
+    if name != "eval_tensor_product":
+        assert records[-1].nnz == len(expected)
+
+
+@pytest.mark.parametrize("method", ["squaring", "linear", "naive"])
+def test_transitive_closure_records(method):
+    bma = BooleanMatrixAutomata(build_nfa_from_graph(GRAPH), csr_matrix)
+    records = []
+    closure = bma.transitive_closure(method, instrumentation=records.append)
+    assert records and records[-1].nnz == closure.nnz
+    assert records[-1].matrix_format == "csr"
+    # Deltas hold only pairs found by the rounds
+    adjacency = sum(bma.boolean_matrix.values())
+    assert sum(record.delta_nnz for record in records) == closure.nnz - adjacency.nnz
+
+
+def test_bfs_and_rpq_records():
+    stats = IterationStats()
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(GRAPH))
+    bma_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(Regex("a* b")))
+    bma_graph.bfs_based_rpq(bma_regex, True, shard_size=3, instrumentation=stats)
+    rpq(GRAPH, Regex("a* b"), instrumentation=stats)
+    assert set(stats.summary()) == {"bfs_based_rpq", "transitive_closure"}
+
+
+def test_exports(tmp_path):
+    log_path, trace_path = tmp_path / "log.jsonl", tmp_path / "trace.json"
+    with JsonLinesLog(log_path, extra={"query": 7}) as log:
+        eval_matrix(GRAPH, CFG_DYCK, instrumentation=log)
+    with ChromeTrace(trace_path) as trace:
+        eval_matrix(GRAPH, CFG_DYCK, instrumentation=trace)
+
+    lines = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert lines and all(line["query"] == 7 for line in lines)
+    assert lines[-1]["solver"] == "eval_matrix"
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    assert len(events) == len(lines) and events[0]["ph"] == "X"
+
+
+def test_measure():
+    matrix = csr_matrix([[1, 0], [1, 1]], dtype=bool)
+    assert measure(matrix)[:2] == (3, "csr")
+    assert measure(BitMatrix(matrix))[:2] == (3, "bit")
+    assert measure({"a": matrix, "b": matrix})[:2] == (6, "csr")
+    assert measure({(0, 1), (1, 1)})[:2] == (2, "set")
+    assert measure(5) == (5, "count", 0)
@@ -0,0 +1,68 @@
+import cfpq_data
+import numpy as np
+import pytest
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix, kron
+from scipy.sparse import random as sparse_random
+
+from project.bit_matrix import BitMatrix
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import eval_tensor_product
+from project.kron_operator import KronOperator
+from project.rpq import rpq
+
+
+def random_factors(first_n, second_n):
+    return [
+        (
+            sparse_random(first_n, first_n, density=0.3, random_state=i) > 0,
+            sparse_random(second_n, second_n, density=0.4, random_state=i + 10) > 0,
+        )
+        for i in range(3)
+    ]
+
+
+@pytest.mark.parametrize("first_n, second_n", [(7, 3), (3, 7)])
+def test_vec_trick(first_n, second_n):
+    factors = random_factors(first_n, second_n)
+    operator = KronOperator(factors, first_n, second_n)
+    product = sum(kron(a.astype(int), b.astype(int)) for a, b in factors).toarray()
+    x = np.random.RandomState(0).randint(0, 3, (first_n * second_n, 4))
+    assert (operator @ x == product @ x).all()
+    assert (operator @ x[:, 0] == product @ x[:, 0]).all()
+    assert (operator.rmatmul(x.T) == x.T @ product).all()
+
+
+@pytest.mark.parametrize("first_n, second_n", [(7, 3), (3, 7)])
+def test_reachable_matches_closure(first_n, second_n):
+    operator = KronOperator(random_factors(first_n, second_n), first_n, second_n)
+    bma = BooleanMatrixAutomata()
+    bma.number_of_states = first_n * second_n
+    bma.boolean_matrix = {"all": operator.to_sparse()}
+    closure = bma.transitive_closure().toarray()
+    sources = np.array([0, 5, 11, 20])
+    assert (operator.reachable(sources).toarray() == closure[sources]).all()
+
+
+def test_implicit_rpq():
+    graph = cfpq_data.labeled_two_cycles_graph(6, 5, labels=("a", "b"))
+    regex = Regex("a* b b*")
+    for tom in (csr_matrix, BitMatrix):
+        assert rpq(graph, regex, type_of_matrix=tom, closure_method="implicit") == (
+            rpq(graph, regex, type_of_matrix=tom)
+        )
+    assert rpq(graph, regex, {0, 3}, {1, 6}, closure_method="implicit") == rpq(
+        graph, regex, {0, 3}, {1, 6}
+    )
+
+
+@pytest.mark.parametrize(
+    "text", ["S -> a S b S | $", "S -> a S b | a b", "S -> A B\nA -> a A | a\nB -> b"]
+)
+def test_implicit_tensor_product(text):
+    graph = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    cfg = CFG.from_text(text, Variable("S"))
+    assert eval_tensor_product(graph, cfg, implicit=True) == eval_tensor_product(
+        graph, cfg
+    )
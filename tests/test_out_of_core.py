@@ -0,0 +1,46 @@
+import cfpq_data
+import numpy as np
+from pyformlang.regular_expression import Regex
+from scipy.sparse import random as sparse_random
+
+from project.bit_matrix import BitMatrix
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.instrumentation import IterationStats
+from project.out_of_core import blocked_transitive_closure
+from project.rpq import rpq
+
+
+def test_blocked_closure_matches_in_memory(tmp_path):
+    adjacency = sparse_random(150, 150, density=0.01, format="csr", random_state=3)
+    adjacency = adjacency > 0
+    bma = BooleanMatrixAutomata()
+    bma.number_of_states = 150
+    bma.boolean_matrix = {"a": adjacency}
+    expected = bma.transitive_closure("squaring")
+
+    stats = IterationStats()
+    # A tiny budget gives panels of a few rows
+    closure = blocked_transitive_closure(adjacency, 2048, tmp_path, stats)
+    assert (closure != expected).nnz == 0
+    # Arrays are read-only views of the files, not copies
+    for array in (closure.data, closure.indices):
+        assert not array.flags.writeable and not array.flags.owndata
+    # Files are unlinked once mapped
+    assert not list(tmp_path.iterdir())
+    assert stats.records
+
+
+def test_bit_matrix_and_empty_closure():
+    closure = blocked_transitive_closure(BitMatrix.identity(5))
+    assert (closure.toarray() == np.eye(5, dtype=bool)).all()
+    empty = blocked_transitive_closure(BitMatrix((4, 4)))
+    assert empty.nnz == 0 and empty.shape == (4, 4)
+
+
+def test_out_of_core_rpq():
+    graph = cfpq_data.labeled_two_cycles_graph(6, 5, labels=("a", "b"))
+    regex = Regex("a* b b*")
+    assert rpq(graph, regex, closure_method="out_of_core") == rpq(graph, regex)
+    assert rpq(graph, regex, {0, 3}, {1, 6}, closure_method="out_of_core") == rpq(
+        graph, regex, {0, 3}, {1, 6}
+    )
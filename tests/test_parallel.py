@@ -0,0 +1,94 @@
+import cfpq_data
+import numpy as np
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from scipy.sparse import random as sparse_random
+
+from project import parallel
+from project.bit_matrix import BitMatrix
+from project.boolean_matrix_automata import BooleanMatrixAutomata
+from project.cfpq import eval_matrix, eval_matrix_from_sources
+from project.finite_automata import build_minimal_dfa_from_regex, build_nfa_from_graph
+from project.parallel import MatrixPool
+
+
+def random_csr(n, seed):
+    return sparse_random(n, n, density=0.1, format="csr", random_state=seed) > 0
+
+
+def replica_product(replica, task):
+    left, right = task
+    return replica.deltas.get(left, replica.matrices.get(left)) @ (
+        replica.matrices[right]
+    )
+
+
+def test_replicated_matrices_follow_deltas():
+    matrices = {"a": random_csr(30, 1), "b": random_csr(30, 2)}
+    with MatrixPool(2, min_parallel_nnz=0) as pool:
+        with pool.replicate(matrices, dict(matrices)) as shared:
+            for i in range(3):
+                tasks = [("a", "b"), ("b", "a"), ("a", "a")]
+                products = shared.map(replica_product, tasks)
+                for (left, right), product in zip(tasks, products):
+                    expected = shared.deltas.get(left, matrices[left]) @ matrices[right]
+                    assert np.array_equal(product.toarray(), expected.toarray())
+                # Accumulated deltas are added to the matrices by the caller
+                delta = random_csr(30, 10 + i)
+                matrices["a"] = matrices["a"] + delta
+                shared.advance({"a": delta})
+            shared.advance({"b": random_csr(30, 20)}, accumulate=False)
+            product = shared.map(replica_product, [("b", "a"), ("a", "b")])[0]
+            expected = shared.deltas["b"] @ matrices["a"]
+            assert np.array_equal(product.toarray(), expected.toarray())
+
+
+def test_replicated_matrices_without_fork(monkeypatch):
+    monkeypatch.setattr(parallel, "_fork_context", lambda: None)
+    matrices = {"a": random_csr(30, 1), "b": random_csr(30, 2)}
+    with MatrixPool(2, min_parallel_nnz=0) as pool:
+        with pool.replicate(matrices, dict(matrices)) as shared:
+            products = shared.map(replica_product, [("a", "b"), ("b", "a")])
+            assert not shared._processes
+    expected = matrices["a"] @ matrices["b"]
+    assert np.array_equal(products[0].toarray(), expected.toarray())
+
+
+def test_parallel_eval_matrix_is_deterministic(monkeypatch):
+    # Every round goes to the workers, however small
+    monkeypatch.setattr(parallel, "PARALLEL_MIN_NNZ", 0)
+    graph = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    cfg = CFG.from_text("S -> a S b S | $", Variable("S"))
+    assert eval_matrix(graph, cfg, workers=2) == eval_matrix(graph, cfg)
+    assert eval_matrix(graph, cfg, type_of_matrix=BitMatrix, workers=2) == (
+        eval_matrix(graph, cfg)
+    )
+    assert eval_matrix_from_sources(graph, cfg, {0, 5}, workers=2) == (
+        eval_matrix_from_sources(graph, cfg, {0, 5})
+    )
+
+
+def test_parallel_bfs_based_rpq(monkeypatch):
+    monkeypatch.setattr(parallel, "PARALLEL_MIN_NNZ", 0)
+    graph = cfpq_data.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph))
+    bma_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(Regex("a* b")))
+    for separately in (False, True):
+        assert bma_graph.bfs_based_rpq(
+            bma_regex, separately, workers=2
+        ) == bma_graph.bfs_based_rpq(bma_regex, separately)
+
+
+def test_sharded_bfs_based_rpq():
+    graph = cfpq_data.labeled_two_cycles_graph(5, 4, labels=("a", "b"))
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph))
+    bma_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(Regex("a* b")))
+    for separately in (False, True):
+        expected = bma_graph.bfs_based_rpq(bma_regex, separately)
+        for workers, shard_size in ((1, 3), (2, 4)):
+            assert (
+                bma_graph.bfs_based_rpq(
+                    bma_regex, separately, workers=workers, shard_size=shard_size
+                )
+                == expected
+            )
@@ -0,0 +1,44 @@
+import cfpq_data
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import PythonRegex, Regex
+
+from project.query_cache import QueryCache, cfg_text, query_cache, regex_text
+from project.rpq import rpq
+
+
+def test_canonical_texts():
+    first = CFG.from_text("S -> a S b | $\nS -> c", Variable("S"))
+    second = CFG.from_text("S -> c\nS -> $ | a S b", Variable("S"))
+    assert cfg_text(first) == cfg_text(second)
+    assert cfg_text(first) != cfg_text(CFG.from_text("S -> a S b | c"))
+    assert regex_text(Regex("a* b")) == regex_text(Regex("a*  b"))
+    assert regex_text(Regex("a b")) != regex_text(Regex("ab"))
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    builds = []
+
+    def build():
+        builds.append(1)
+        return CFG.from_text("S -> a S b | $").to_normal_form()
+
+    cache = QueryCache(maxsize=1, directory=tmp_path)
+    first = cache.get("cnf", "grammar", build)
+    assert cache.get("cnf", "grammar", build) is first
+    cache.get("cnf", "other", build)
+    assert len(cache) == 1 and len(builds) == 2
+
+    reloaded = QueryCache(directory=tmp_path).get("cnf", "grammar", build)
+    assert len(builds) == 2
+    assert reloaded.productions == first.productions
+
+    cache.clear(disk=True)
+    assert not list(tmp_path.glob("*.pickle"))
+
+
+def test_solvers_share_compiled_queries():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    rpq(graph, PythonRegex("a*b"))
+    hits = query_cache.hits
+    rpq(graph, PythonRegex("a*b"))
+    assert query_cache.hits == hits + 1
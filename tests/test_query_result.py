@@ -0,0 +1,44 @@
+import cfpq_data
+import numpy as np
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import PythonRegex
+from scipy.sparse import csr_matrix
+
+from project.cfpq import (
+    eval_hellings_result,
+    eval_matrix,
+    eval_matrix_result,
+    eval_tensor_product_result,
+)
+from project.query_result import QueryResult
+from project.rpq import rpq, rpq_result
+
+
+def test_iter_pairs_covers_relation_in_chunks():
+    dense = np.random.default_rng(0).random((30, 30)) < 0.3
+    result = QueryResult.from_matrices(
+        [f"v{i}" for i in range(30)], {"S": csr_matrix(dense)}
+    )
+    chunks = list(result.iter_pairs("S", chunk_size=7))
+    assert all(len(starts) <= 7 or len(set(starts)) == 1 for starts, _ in chunks)
+    pairs = {pair for starts, finals in chunks for pair in zip(starts, finals)}
+    assert pairs == result.to_set("S")
+    assert len(pairs) == result.nnz == np.count_nonzero(dense)
+    assert result.to_set("missing") == set()
+
+
+def test_rpq_result_matches_rpq():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 7, labels=("a", "b"))
+    regex = PythonRegex("a*b")
+    result = rpq_result(graph, regex, {0, 1})
+    assert isinstance(result.relations[None], csr_matrix)
+    assert result.to_set() == rpq(graph, regex, {0, 1})
+
+
+def test_cfpq_results_agree():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    cfg = CFG.from_text("S -> a S b S | $", Variable("S"))
+    expected = eval_matrix_result(graph, cfg).to_set("S")
+    assert eval_hellings_result(graph, cfg).to_set("S") == expected
+    assert eval_tensor_product_result(graph, cfg).to_set("S") == expected
+    assert eval_matrix_result(graph, cfg).to_triples() == eval_matrix(graph, cfg)
@@ -0,0 +1,127 @@
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import cfpq_data
+import pytest
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+
+from project.cfpq import cfpg_by_matrix
+from project.graph_store import save_graph
+from project.rpq import rpq
+from project import server as server_module
+from project.server import QueryServer
+
+GRAMMAR = "S -> a S b | a b"
+
+
+def pairs(response):
+    assert response["ok"], response
+    return {tuple(pair) for pair in response["result"]["pairs"]}
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = tmp_path / "graph.cfpqg"
+    save_graph(cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b")), path)
+    with QueryServer(workers=2) as server:
+        server.load_graph("cycles", {"path": str(path)})
+        yield server
+
+
+def test_queries_match_solvers(server):
+    graph = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    response = server.handle({"id": 1, "op": "rpq", "graph": "cycles", "regex": "a*b"})
+    assert response["id"] == 1 and response["time"]["run"] >= 0
+    assert pairs(response) == rpq(graph, Regex("a*b"))
+
+    cfg = CFG.from_text(GRAMMAR, Variable("S"))
+    for algorithm in ("matrix", "tensor", "hellings"):
+        request = {"op": "cfpq", "graph": "cycles", "grammar": GRAMMAR}
+        assert pairs(server.handle({**request, "algorithm": algorithm})) == (
+            cfpg_by_matrix(graph, cfg)
+        )
+        restricted = {**request, "algorithm": algorithm, "start": [0], "final": [0]}
+        assert pairs(server.handle(restricted)) == cfpg_by_matrix(graph, cfg, {0}, {0})
+
+
+@pytest.mark.parametrize("share", [0, 1])
+def test_rpq_from_start_nodes(server, monkeypatch, share):
+    monkeypatch.setattr(server_module, "RPQ_SEARCH_START_SHARE", share)
+    graph = cfpq_data.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    request = {"op": "rpq", "graph": "cycles", "regex": "a* b"}
+    for start, final in (([0, 5], None), ([1], [0, 7]), (None, [6])):
+        response = server.handle({**request, "start": start, "final": final})
+        assert pairs(response) == rpq(graph, Regex("a* b"), start, final)
+
+
+def test_errors_are_responses(server):
+    for request in (
+        {"id": 1, "op": "rpq", "graph": "missing", "regex": "a"},
+        {"id": 2, "op": "rpq", "graph": "cycles"},
+        {"id": 3, "op": "rpq", "graph": "cycles", "regex": "a", "start": [100]},
+        {"id": 4, "op": "nothing"},
+    ):
+        response = server.handle(request)
+        assert response["id"] == request["id"] and not response["ok"]
+    assert server.handle({"op": "ping"})["ok"]
+    assert server.stats()["errors"] == 4
+
+
+def test_reload_swaps_graph(server, tmp_path):
+    old = server.graph("cycles")
+    save_graph(
+        cfpq_data.labeled_two_cycles_graph(6, 3, labels=("a", "b")),
+        tmp_path / "graph.cfpqg",
+    )
+    assert server.handle({"op": "reload"})["result"] == ["cycles"]
+    assert server.graph("cycles") is not old
+    assert server.graph("cycles").graph_matrices.number_of_nodes == 10
+    # Matrices held by requests in flight stay usable
+    assert old.graph_matrices.number_of_nodes == 8
+
+
+def test_stream(server):
+    requests = [
+        {"id": i, "op": "rpq", "graph": "cycles", "regex": "a*", "count_only": True}
+        for i in range(6)
+    ]
+    lines = [json.dumps(request) for request in requests] + ["not json"]
+    lines += [json.dumps({"id": "last", "op": "shutdown"}), json.dumps({"op": "ping"})]
+    output = io.StringIO()
+    server.serve_stream(io.StringIO("\n".join(lines) + "\n"), output)
+
+    responses = [json.loads(line) for line in output.getvalue().splitlines()]
+    # Shutdown is answered last and stops reading
+    assert [r["id"] for r in responses[:-1]].count(None) == 1
+    assert {r["id"] for r in responses[:-1]} == set(range(6)) | {None}
+    assert responses[-1]["id"] == "last"
+    assert len({r["result"]["count"] for r in responses if r["id"] in range(6)}) == 1
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_unix_socket(server, tmp_path):
+    path = str(tmp_path / "query.sock")
+    thread = threading.Thread(target=server.serve_unix_socket, args=(path,))
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(path)
+        stream = client.makefile("rw", encoding="utf-8")
+        stream.write(json.dumps({"id": 1, "op": "graphs"}) + "\n")
+        stream.flush()
+        response = json.loads(stream.readline())
+        assert response["result"][0]["nodes"] == 8
+        stream.write(json.dumps({"id": 2, "op": "shutdown"}) + "\n")
+        stream.flush()
+        assert json.loads(stream.readline())["id"] == 2
+    thread.join(10)
+    assert not thread.is_alive() and not os.path.exists(path)
@@ -1,8 +1,10 @@
 import pytest
 from pyformlang.cfg import Variable, CFG
 import cfpq_data
+from scipy.sparse import csr_matrix, dok_matrix
 
-from project.cfpq import cfpg_by_matrix
+from project.bit_matrix import BitMatrix
+from project.cfpq import DynamicCfpq, cfpg_by_matrix
 
 
 @pytest.mark.parametrize(
@@ -45,3 +47,55 @@ def test_hellings(cfg_text, expected_edges):
     cfg = CFG.from_text(cfg_text, Variable("S"))
 
     assert cfpg_by_matrix(graph, cfg) == expected_edges
+
+
+@pytest.mark.parametrize(
+    "cfg_text", ["""S -> a S b S | $""", """S -> a S b | a b""", """S -> S S | a | b"""]
+)
+@pytest.mark.parametrize("start_nodes", [{0}, {3}, {2, 5, 8}])
+@pytest.mark.parametrize("type_of_matrix", [dok_matrix, csr_matrix, BitMatrix])
+def test_matrix_from_sources(cfg_text, start_nodes, type_of_matrix):
+    graph = cfpq_data.labeled_two_cycles_graph(6, 4, labels=("a", "b"))
+    cfg = CFG.from_text(cfg_text, Variable("S"))
+
+    all_pairs = cfpg_by_matrix(graph, cfg)
+    assert cfpg_by_matrix(graph, cfg, start_nodes, type_of_matrix=type_of_matrix) == {
+        (x, y) for (x, y) in all_pairs if x in start_nodes
+    }
+
+
+@pytest.mark.parametrize(
+    "cfg_text", ["""S -> a S b S | $""", """S -> a S | P\nP -> b P | b"""]
+)
+def test_dynamic_cfpq_follows_updates(cfg_text):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    cfg = CFG.from_text(cfg_text, Variable("S"))
+    index = DynamicCfpq(graph, cfg)
+    assert index.query() == cfpg_by_matrix(graph, cfg)
+
+    updates = [
+        ("add", [(3, 6, "b"), (6, 1, "a")]),
+        ("remove", [(0, 1, "a")]),
+        ("add", [(0, 1, "a"), (0, 1, "a")]),
+        ("remove", [(0, 1, "a"), (3, 6, "b")]),
+    ]
+    for action, edges in updates:
+        for u, v, label in edges:
+            if action == "add":
+                graph.add_edge(u, v, label=label)
+            else:
+                key = next(
+                    key
+                    for key, data in graph.get_edge_data(u, v).items()
+                    if data["label"] == label
+                )
+                graph.remove_edge(u, v, key)
+        if action == "add":
+            index.add_edges(edges)
+        else:
+            index.remove_edges(edges)
+        assert index.query() == cfpg_by_matrix(graph, cfg)
+
+    assert index.has_path(6, 1) == ((6, 1) in index.query())
+    with pytest.raises(ValueError):
+        index.remove_edge(0, 2, "b")
@@ -2,7 +2,7 @@ import pytest
 from pyformlang.cfg import Variable, CFG
 import cfpq_data
 
-from project.cfpq import cfpg_by_tensor_product
+from project.cfpq import cfpg_by_matrix, cfpg_by_tensor_product
 
 
 @pytest.mark.parametrize(
@@ -45,3 +45,13 @@ def test_tensor_product(cfg_text, expected_edges):
     graph = cfpq_data.labeled_two_cycles_graph(2, 1, labels=("a", "b"))
     cfg = CFG.from_text(cfg_text, Variable("S"))
     assert cfpg_by_tensor_product(graph, cfg) == expected_edges
+
+
+@pytest.mark.parametrize(
+    "cfg_text", ["""S -> a S b | a b""", """S -> a S b S | $""", """S -> S S | a"""]
+)
+def test_tensor_product_agrees_with_matrix(cfg_text):
+    graph = cfpq_data.labeled_two_cycles_graph(5, 4, labels=("a", "b"))
+    cfg = CFG.from_text(cfg_text, Variable("S"))
+
+    assert cfpg_by_tensor_product(graph, cfg) == cfpg_by_matrix(graph, cfg)
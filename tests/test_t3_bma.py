@@ -1,6 +1,10 @@
+import cfpq_data
+import pytest
 from pyformlang.finite_automaton import EpsilonNFA
+from pyformlang.regular_expression import Regex
 
 from project.finite_automata import *
+from project.bit_matrix import BitMatrix
 from project.boolean_matrix_automata import BooleanMatrixAutomata
 
 
@@ -37,3 +41,44 @@ def test_intersect_two_automata():
     assert actual_intersected_nfa.start_states == expected_intersected_nfa.start_states
     assert actual_intersected_nfa.final_states == expected_intersected_nfa.final_states
     assert actual_intersected_nfa.symbols == expected_intersected_nfa.symbols
+
+
+@pytest.mark.parametrize("method", ["squaring", "linear", "out_of_core"])
+def test_semi_naive_transitive_closure(method):
+    graph = cfpq_data.labeled_two_cycles_graph(5, 4, labels=("a", "b"))
+    bma = BooleanMatrixAutomata(build_nfa_from_graph(graph))
+    expected = bma.transitive_closure("naive").toarray().astype(bool)
+    assert (bma.transitive_closure(method).toarray() == expected).all()
+    bit_bma = BooleanMatrixAutomata(build_nfa_from_graph(graph), BitMatrix)
+    assert (bit_bma.transitive_closure(method).toarray() == expected).all()
+
+
+@pytest.mark.parametrize("method", ["squaring", "linear"])
+def test_transitive_closure_of_intersection(method):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph))
+    regex = build_minimal_dfa_from_regex(Regex("(a | b)* a"))
+    product = bma_graph.intersect(BooleanMatrixAutomata(regex))
+    expected = product.transitive_closure("naive").toarray().astype(bool)
+    closure = product.transitive_closure(method).toarray().astype(bool)
+    assert (closure == expected).all()
+
+
+def test_intersect_state_index_arrays():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    bma_graph = BooleanMatrixAutomata(build_nfa_from_graph(graph, [0, 1], [2]))
+    bma_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(Regex("a*")))
+    product = bma_graph.intersect(bma_regex)
+    regex_n = bma_regex.number_of_states
+
+    expected_start = {
+        bma_graph.states_indexes[State(g)] * regex_n + bma_regex.states_indexes[r]
+        for g in (0, 1)
+        for r in bma_regex.states_indexes
+        if r in bma_regex.start_state_indexes
+    }
+    assert set(product.start_state_indexes.tolist()) == expected_start
+    assert len(product.final_state_indexes) == len(bma_regex.final_state_indexes)
+    assert len(product.indexes_states) == product.number_of_states
+    assert product.indexes_states[5] == State(5)
+    assert product.states_indexes[State(5)] == 5
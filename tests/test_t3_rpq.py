@@ -10,3 +10,21 @@ def test_rpq():
     regex = PythonRegex("aa|aaa|(bb)*")
     result = rpq(graph, regex, {0}, {0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11}, lil_matrix)
     assert result == {(0, 0), (0, 2), (0, 3), (0, 6), (0, 8), (0, 10)}
+
+
+def test_rpq_batch():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 7, labels=("a", "b"))
+    queries = [
+        (PythonRegex("aa|aaa|(bb)*"), {0}, set(range(12))),
+        PythonRegex("a*b"),
+        (PythonRegex("b+"), {0, 5}, None),
+    ]
+    batch = rpq_batch(graph, queries)
+
+    assert batch.results == [
+        rpq(graph, PythonRegex("aa|aaa|(bb)*"), {0}, set(range(12))),
+        rpq(graph, PythonRegex("a*b")),
+        rpq(graph, PythonRegex("b+"), {0, 5}),
+    ]
+    assert len(batch.query_times) == len(queries)
+    assert batch.setup_time >= 0
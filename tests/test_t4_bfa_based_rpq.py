@@ -19,3 +19,17 @@ def test_rpq_without_separated():
     expected_result = {0, 1, 2, 3, 4, 5, 6}
 
     assert result == expected_result
+
+
+def test_rpq_separated():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+    regex = Regex("a b*")
+    bool_matrix_for_graph = BooleanMatrixAutomata(
+        build_nfa_from_graph(graph, [0, 2, 3], None)
+    )
+    bool_matrix_for_regex = BooleanMatrixAutomata(build_minimal_dfa_from_regex(regex))
+    result = bool_matrix_for_graph.bfs_based_rpq(bool_matrix_for_regex, True)
+
+    expected_result = {0: {1}, 2: {3}, 3: {0, 4, 5, 6}}
+
+    assert {start: set(states) for start, states in result.items()} == expected_result
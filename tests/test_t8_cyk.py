@@ -25,3 +25,12 @@ def test_is_string_deducible_from_grammar(cfg_text, right_strings, wrong_strings
     cfg = CFG.from_text(cfg_text, Variable("S"))
     assert all(cfpq_cyk(s, cfg) for s in right_strings)
     assert all(not cfpq_cyk(s, cfg) for s in wrong_strings)
+
+
+@pytest.mark.parametrize("method", ["bitset", "matrix"])
+def test_cyk_methods(method):
+    cfg = CFG.from_text("""S -> a S b S | x S y S | $""", Variable("S"))
+    right_strings = ["ab", "abxyaxybxaby", "ax" * 150 + "yb" * 150]
+    wrong_strings = ["a", "yx", "ax" * 150 + "by" * 150]
+    assert all(cfpq_cyk(s, cfg, method) for s in right_strings)
+    assert all(not cfpq_cyk(s, cfg, method) for s in wrong_strings)
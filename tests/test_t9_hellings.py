@@ -2,7 +2,7 @@ import pytest
 from pyformlang.cfg import Variable, CFG
 import cfpq_data
 
-from project.cfpq import cfpg_by_hellings
+from project.cfpq import cfpg_by_hellings, cfpg_by_matrix
 
 
 @pytest.mark.parametrize(
@@ -45,3 +45,13 @@ def test_hellings(cfg_text, expected_edges):
     cfg = CFG.from_text(cfg_text, Variable("S"))
 
     assert cfpg_by_hellings(graph, cfg) == expected_edges
+
+
+@pytest.mark.parametrize(
+    "cfg_text", ["""S -> a S b | a b""", """S -> a S b S | $""", """S -> S S | a"""]
+)
+def test_hellings_agrees_with_matrix(cfg_text):
+    graph = cfpq_data.labeled_two_cycles_graph(7, 5, labels=("a", "b"))
+    cfg = CFG.from_text(cfg_text, Variable("S"))
+
+    assert cfpg_by_hellings(graph, cfg) == cfpg_by_matrix(graph, cfg)